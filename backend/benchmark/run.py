@@ -0,0 +1,214 @@
+"""
+    RecipeSearchEngine 的離線 benchmark
+
+    以合成語料、確定性的 stub 模型與 in-process ChromaDB 量測各種資料量下的
+    啟動時間、peak RSS 以及各搜尋方法的延遲 (p50/p95/p99) 與吞吐量。
+    每個資料量在獨立的子行程中執行，peak RSS 才不會互相影響。
+
+    > cd backend
+    > python -m benchmark.run --sizes 1000,10000,100000 --output bench.json
+    > python -m benchmark.run --compare old.json new.json
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from PIL import Image
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OPERATIONS = ['text_search', 'ingredient_based_search', 'get_similar_ingredients', 'image_search', 'multimodal_search',
+              'image_search_filtered', 'multimodal_search_filtered']
+
+
+def peak_rss_mb() -> float:
+    # Linux 的 ru_maxrss 單位為 KB，macOS 為 bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BACKEND_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(latencies: list, elapsed: float) -> dict:
+    ms = np.asarray(latencies) * 1000
+    return {
+        'count': len(ms),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p95_ms': float(np.percentile(ms, 95)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'mean_ms': float(ms.mean()),
+        'throughput_qps': len(ms) / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def populate_image_vectors(engine, clip_model, seed: int = 0, chunk_size: int = 5000):
+    """
+        以隨機像素經 stub CLIP 投影產生圖片向量，直接批次寫入 collection
+
+        metadata 與實際的預計算流程相同 (含料理時間與份量)，篩選的圖片搜尋才會走 ChromaDB 的 where。
+    """
+    from image_pipeline import image_metadata
+
+    rng = np.random.default_rng(seed)
+    recipes = engine.iter_recipes()
+    while True:
+        chunk = list(itertools.islice(recipes, chunk_size))
+        if not chunk:
+            break
+        pixels = rng.random((len(chunk), clip_model.projection.shape[0]), dtype=np.float32)
+        features = clip_model.get_image_features(pixel_values=pixels).numpy()
+        engine.collection.add(ids=[r['id'] for r in chunk], embeddings=features.tolist(),
+                              metadatas=[image_metadata(r) for r in chunk])
+
+
+def run_size(size: int, queries: int, top_k: int, workdir: str) -> dict:
+    """在目前行程中對單一資料量執行 benchmark"""
+    sys.path.insert(0, BACKEND_DIR)
+    import chromadb
+    from benchmark.stubs import StubCLIPModel, StubCLIPProcessor, StubSentenceModel
+    from benchmark.synthetic_corpus import sample_queries, write_corpus
+    from recipe_filter import RecipeFilter
+    from search_engine import RecipeSearchEngine
+
+    data_path = os.path.join(workdir, f"recipe_data_{size}.json")
+    write_corpus(data_path, size)
+
+    clip_model = StubCLIPModel()
+    client = chromadb.EphemeralClient()
+
+    # 啟動: 載入語料並建置所有模態 (無快取的冷啟動)
+    start = time.perf_counter()
+    engine = RecipeSearchEngine(data_path, cache_dir=os.path.join(workdir, f"cache_{size}"),
+                                modalities=['text', 'ingredient', 'image'],
+                                sentence_model=StubSentenceModel(), clip_model=clip_model,
+                                clip_processor=StubCLIPProcessor(), chroma_client=client)
+    engine.warmup(background=False)
+    startup_seconds = time.perf_counter() - start
+
+    populate_start = time.perf_counter()
+    populate_image_vectors(engine, clip_model)
+    populate_seconds = time.perf_counter() - populate_start
+
+    # 關閉結果與嵌入快取，量測的是實際的搜尋路徑
+    engine.result_cache.maxsize = 0
+    engine.query_embedding_cache.maxsize = 0
+
+    query_set = sample_queries(queries)
+    rng = np.random.default_rng(2)
+    # 料理時間與份量的條件交給 ChromaDB 的 where 篩選
+    image_filter = RecipeFilter(max_duration=30, min_servings=2)
+    images = [Image.fromarray(rng.integers(0, 255, (64, 64, 3), dtype=np.uint8)) for _ in range(min(queries, 32))]
+    calls = {
+        'text_search': lambda i: engine.text_search(query_set['text'][i], top_k),
+        'ingredient_based_search': lambda i: engine.ingredient_based_search(query_set['ingredient'][i], top_k),
+        'get_similar_ingredients': lambda i: engine.get_similar_ingredients(query_set['similar'][i]),
+        'image_search': lambda i: engine.image_search(images[i % len(images)], top_k),
+        'multimodal_search': lambda i: engine.multimodal_search(images[i % len(images)], query_set['text'][i], top_k),
+        'image_search_filtered': lambda i: engine.image_search(images[i % len(images)], top_k, filters=image_filter),
+        'multimodal_search_filtered': lambda i: engine.multimodal_search(
+            images[i % len(images)], query_set['text'][i], top_k, filters=image_filter),
+    }
+
+    operations = {}
+    for name in OPERATIONS:
+        calls[name](0)  # 預熱
+        latencies = []
+        op_start = time.perf_counter()
+        for i in range(queries):
+            t = time.perf_counter()
+            calls[name](i)
+            latencies.append(time.perf_counter() - t)
+        operations[name] = summarize(latencies, time.perf_counter() - op_start)
+
+    status = engine.modality_status()
+    return {
+        'size': size,
+        'recipes': len(engine.store.live_rows()),
+        'startup_seconds': startup_seconds,
+        'corpus_load_seconds': status['corpus_load_seconds'],
+        'modality_load_seconds': {name: m['load_seconds'] for name, m in status['modalities'].items()},
+        'image_populate_seconds': populate_seconds,
+        'peak_rss_mb': peak_rss_mb(),
+        'operations': operations,
+    }
+
+
+def run_all(sizes: list, queries: int, top_k: int) -> dict:
+    """每個資料量在獨立子行程中執行並彙整結果"""
+    results = []
+    for size in sizes:
+        print(f"benchmark: {size} 筆食譜...", file=sys.stderr)
+        output = subprocess.check_output(
+            [sys.executable, '-m', 'benchmark.run', '--single-size', str(size),
+             '--queries', str(queries), '--top-k', str(top_k)],
+            cwd=BACKEND_DIR, text=True)
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'queries': queries,
+        'top_k': top_k,
+        'results': results,
+    }
+
+
+def compare(old_path: str, new_path: str):
+    """比較兩次 benchmark 結果 (顯示新/舊比值，<1 代表變快或變小)"""
+    with open(old_path, "r", encoding='utf-8') as f:
+        old = {r['size']: r for r in json.load(f)['results']}
+    with open(new_path, "r", encoding='utf-8') as f:
+        new = {r['size']: r for r in json.load(f)['results']}
+    for size in sorted(set(old) & set(new)):
+        o, n = old[size], new[size]
+        print(f"== {size} 筆食譜")
+        for key in ('startup_seconds', 'peak_rss_mb'):
+            print(f"  {key:<26} {o[key]:>10.2f} -> {n[key]:>10.2f}  x{n[key] / o[key]:.2f}")
+        for name in OPERATIONS:
+            # 較早的結果沒有後來新增的查詢
+            if name not in o['operations'] or name not in n['operations']:
+                continue
+            for metric in ('p50_ms', 'p99_ms'):
+                a, b = o['operations'][name][metric], n['operations'][name][metric]
+                print(f"  {name + ' ' + metric:<26} {a:>10.2f} -> {b:>10.2f}  x{b / a if a else float('nan'):.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RecipeSearchEngine 離線 benchmark")
+    parser.add_argument("--sizes", default="1000,10000", help="以逗號分隔的語料大小")
+    parser.add_argument("--queries", type=int, default=200, help="每種搜尋的查詢次數")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--output", default=None, help="結果 JSON 檔 (預設輸出到 stdout)")
+    parser.add_argument("--single-size", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    elif args.single_size is not None:
+        with tempfile.TemporaryDirectory() as workdir:
+            result = run_size(args.single_size, args.queries, args.top_k, workdir)
+        # 子行程的結果以單行 JSON 輸出在最後一行
+        print(json.dumps(result, ensure_ascii=False))
+    else:
+        report = run_all([int(s) for s in args.sizes.split(",")], args.queries, args.top_k)
+        text = json.dumps(report, ensure_ascii=False, indent=2)
+        if args.output:
+            with open(args.output, "w", encoding='utf-8') as f:
+                f.write(text)
+        else:
+            print(text)
@@ -0,0 +1,68 @@
+"""
+    Benchmark 用的確定性 stub 模型，不需下載任何權重
+
+    輸出維度與真實模型相同 (MiniLM 384 維、CLIP ViT-B/32 512 維)，
+    相同輸入永遠得到相同向量。
+"""
+import numpy as np
+
+TEXT_DIM = 384
+IMAGE_DIM = 512
+_PIXELS = 8
+
+
+class StubSentenceModel:
+    """以字元雜湊的詞袋向量取代 SentenceTransformer"""
+
+    model_name = 'stub-sentence-model'
+
+    def __init__(self, dim: int = TEXT_DIM, seed: int = 0):
+        self.dim = dim
+        rng = np.random.default_rng(seed)
+        self._signs = rng.choice([-1.0, 1.0], size=dim).astype(np.float32)
+
+    def encode(self, texts, batch_size: int = 32, **kwargs) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+            if len(codes):
+                vectors[i] = np.bincount((codes * 2654435761) % self.dim, minlength=self.dim)
+        vectors *= self._signs
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+class _Features:
+    """模仿 torch.Tensor 的 detach().numpy() 介面"""
+
+    def __init__(self, array: np.ndarray):
+        self.array = array
+
+    def detach(self):
+        return self
+
+    def numpy(self) -> np.ndarray:
+        return self.array
+
+
+class StubCLIPProcessor:
+    """把圖片縮成 8x8 的像素向量"""
+
+    def __call__(self, images=None, return_tensors=None, **kwargs) -> dict:
+        if not isinstance(images, (list, tuple)):
+            images = [images]
+        pixels = [np.asarray(image.convert('RGB').resize((_PIXELS, _PIXELS)), dtype=np.float32).ravel() / 255
+                  for image in images]
+        return {'pixel_values': np.stack(pixels)}
+
+
+class StubCLIPModel:
+    """以固定的隨機投影把像素向量映射到 CLIP 特徵空間"""
+
+    def __init__(self, dim: int = IMAGE_DIM, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.projection = rng.standard_normal((_PIXELS * _PIXELS * 3, dim)).astype(np.float32)
+
+    def get_image_features(self, pixel_values=None, **kwargs) -> _Features:
+        return _Features(np.asarray(pixel_values, dtype=np.float32) @ self.projection)
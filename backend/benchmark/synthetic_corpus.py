@@ -0,0 +1,88 @@
+"""
+    產生合成的 recipe_data.json 語料 (離線 benchmark 用)
+
+    > python -m benchmark.synthetic_corpus --size 10000 --out ./benchmark/data/recipe_data_10000.json
+"""
+import argparse
+import json
+import random
+from typing import Iterator
+
+INGREDIENTS = [
+    '雞胸肉', '雞腿', '雞蛋', '豬絞肉', '五花肉', '梅花肉', '豬排', '牛肉', '牛腩', '羊肉',
+    '鮭魚', '鯛魚', '蝦仁', '透抽', '蛤蜊', '干貝', '豆腐', '板豆腐', '豆干', '豆皮',
+    '番茄', '洋蔥', '青蔥', '蒜頭', '薑', '辣椒', '九層塔', '香菜', '芹菜', '韭菜',
+    '高麗菜', '大白菜', '青江菜', '空心菜', '菠菜', '花椰菜', '紅蘿蔔', '白蘿蔔', '馬鈴薯', '地瓜',
+    '南瓜', '茄子', '青椒', '甜椒', '小黃瓜', '櫛瓜', '玉米', '香菇', '杏鮑菇', '金針菇',
+    '木耳', '絲瓜', '苦瓜', '冬瓜', '芋頭', '蓮藕', '四季豆', '毛豆', '豆芽菜', '海帶',
+    '醬油', '蠔油', '米酒', '味醂', '烏醋', '白醋', '糖', '鹽', '胡椒粉', '太白粉',
+    '麻油', '沙拉油', '豆瓣醬', '甜麵醬', '沙茶醬', '咖哩塊', '奶油', '牛奶', '起司', '麵粉',
+    '白飯', '麵條', '冬粉', '米粉', '年糕', '水餃皮', '吐司', '雞高湯', '柴魚片', '昆布',
+]
+UNITS = ['克', '公克', '條', '片', '個', '顆', '適量', '少許', '大匙', '小匙', '湯匙', '茶匙', '杯', '毫升', '把', '200g']
+METHODS = ['炒', '燉', '滷', '蒸', '煎', '烤', '涼拌', '紅燒', '三杯', '糖醋', '清炒', '乾煸', '焗烤', '香煎', '爆炒']
+DISHES = ['', '湯', '飯', '麵', '燴飯', '蓋飯', '煲', '鍋', '粥', '捲']
+HASHTAGS = ['家常菜', '快速料理', '便當菜', '下飯', '減脂', '高蛋白', '素食', '宴客菜', '懶人料理', '氣炸鍋',
+            '電鍋料理', '一人份', '親子料理', '台式', '日式', '韓式', '中式', '西式', '湯品', '小菜']
+PHRASES = ['簡單又美味', '十分鐘上桌', '大人小孩都愛吃', '超級下飯', '冰箱剩菜大變身', '媽媽的味道',
+           '清爽不油膩', '香氣十足', '便當必備', '宴客也體面', '零失敗', '鮮嫩多汁']
+
+
+def generate_recipe(i: int, rng: random.Random) -> dict:
+    ingredients = rng.sample(INGREDIENTS, rng.randint(3, 10))
+    main = ingredients[0]
+    name = f"{rng.choice(METHODS)}{main}{rng.choice(DISHES)}"
+    if rng.random() < 0.4:
+        name = f"{ingredients[1]}{name}"
+    return {
+        'id': str(100000 + i),
+        'name': name,
+        'description': f"{rng.choice(PHRASES)}，{main}{rng.choice(PHRASES)}",
+        'image': f"https://example.invalid/recipes/{100000 + i}.jpg",
+        'duration': f"{rng.choice([5, 10, 15, 20, 30, 45, 60, 90, 120])}分鐘",
+        'servings': f"{rng.randint(1, 6)}人份",
+        'hashtags': rng.sample(HASHTAGS, rng.randint(0, 4)),
+        'ingredients': [
+            {'name': ing, 'amount': f"{rng.randint(1, 500)}{rng.choice(UNITS)}"} for ing in ingredients
+        ],
+        'steps': [
+            {'id': step, 'image': None, 'description': f"步驟{step}: 將{rng.choice(ingredients)}{rng.choice(METHODS)}熟", 'tips': None}
+            for step in range(1, rng.randint(3, 7))
+        ],
+    }
+
+
+def generate_recipes(size: int, seed: int = 0) -> Iterator[dict]:
+    rng = random.Random(seed)
+    for i in range(size):
+        yield generate_recipe(i, rng)
+
+
+def write_corpus(path: str, size: int, seed: int = 0):
+    """以串流方式寫出 JSON 陣列，不需把整個語料放在記憶體中"""
+    with open(path, "w", encoding='utf-8') as f:
+        f.write("[")
+        for i, recipe in enumerate(generate_recipes(size, seed)):
+            if i:
+                f.write(",\n")
+            f.write(json.dumps(recipe, ensure_ascii=False))
+        f.write("]")
+
+
+def sample_queries(count: int, seed: int = 1) -> dict:
+    """各種搜尋的合成查詢"""
+    rng = random.Random(seed)
+    return {
+        'text': [f"{rng.choice(METHODS)}{rng.choice(INGREDIENTS)}" for _ in range(count)],
+        'ingredient': [rng.sample(INGREDIENTS, rng.randint(1, 4)) for _ in range(count)],
+        'similar': [rng.choice(INGREDIENTS) for _ in range(count)],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="產生合成食譜語料")
+    parser.add_argument("--size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="./recipe_data_synthetic.json")
+    args = parser.parse_args()
+    write_corpus(args.out, args.size, args.seed)
@@ -0,0 +1,56 @@
+"""
+    快取檔案的跨行程鎖與原子寫入
+
+    多個 uvicorn worker 同時冷啟動 (非共用模式) 時會建置同一份快取，
+    以 file_lock 讓同一時間只有一個行程建置，其他行程等待後直接載入建置好的檔案；
+    寫入時使用每個行程各自的暫存檔，不會互相覆蓋寫到一半的內容。
+"""
+import contextlib
+import os
+import tempfile
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    """以 path + '.lock' 作為跨行程 (與執行緒) 的獨占鎖"""
+    with open(path + ".lock", "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                # LK_LOCK 重試約 10 秒後仍拿不到鎖時拋出 OSError，繼續等待
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextlib.contextmanager
+def atomic_write(path: str, mode: str = "wb", **kwargs):
+    """寫入同目錄下唯一的暫存檔，成功後才以 os.replace 替換 path (失敗時刪除暫存檔)"""
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                    dir=os.path.dirname(path) or ".")
+    try:
+        with open(fd, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,83 @@
+"""
+    服務設定，皆可由環境變數覆寫
+"""
+import os
+
+
+def _int(name: str, default: int) -> int:
+    return int(os.environ.get(name, default))
+
+
+def _float(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+# 模型推論專用執行緒數
+INFERENCE_WORKERS = _int("RECIPE_INFERENCE_WORKERS", 1)
+
+# 動態 micro-batching: 同時到達的查詢最多合併幾筆、最多等待幾毫秒
+TEXT_BATCH_MAX_SIZE = _int("RECIPE_TEXT_BATCH_MAX_SIZE", 32)
+TEXT_BATCH_MAX_WAIT_MS = _float("RECIPE_TEXT_BATCH_MAX_WAIT_MS", 5.0)
+IMAGE_BATCH_MAX_SIZE = _int("RECIPE_IMAGE_BATCH_MAX_SIZE", 8)
+IMAGE_BATCH_MAX_WAIT_MS = _float("RECIPE_IMAGE_BATCH_MAX_WAIT_MS", 10.0)
+
+# 搜尋結果快取 (文字、食材、相似食材) 與查詢嵌入快取
+RESULT_CACHE_SIZE = _int("RECIPE_RESULT_CACHE_SIZE", 2048)
+RESULT_CACHE_TTL = _float("RECIPE_RESULT_CACHE_TTL", 600.0)
+EMBEDDING_CACHE_SIZE = _int("RECIPE_EMBEDDING_CACHE_SIZE", 4096)
+EMBEDDING_CACHE_TTL = _float("RECIPE_EMBEDDING_CACHE_TTL", 3600.0)
+
+# 上傳圖片大小上限 (位元組)
+MAX_UPLOAD_BYTES = _int("RECIPE_MAX_UPLOAD_BYTES", 10 * 1024 * 1024)
+
+# 啟用的搜尋模態 (text, ingredient, image)，未列出的模態不會載入模型
+MODALITIES = [m.strip() for m in os.environ.get("RECIPE_MODALITIES", "text,ingredient,image").split(",") if m.strip()]
+# 啟動後是否在背景預先載入模型 (否則在第一次查詢時才載入)
+WARMUP = os.environ.get("RECIPE_WARMUP", "1").lower() not in ("0", "false", "no")
+# 模態載入失敗後，經過這段時間 (秒) 才會在下一次查詢時重新嘗試載入
+MODALITY_RETRY_SECONDS = _float("RECIPE_MODALITY_RETRY_SECONDS", 60.0)
+
+# 各搜尋階段與啟動階段的延遲量測 (/metrics)，關閉時計時器為 no-op
+METRICS_ENABLED = os.environ.get("RECIPE_METRICS", "1").lower() not in ("0", "false", "no")
+# 是否同時產生 OpenTelemetry span (需另外設定 TracerProvider / exporter)
+OTEL_ENABLED = os.environ.get("RECIPE_OTEL", "0").lower() not in ("0", "false", "no")
+
+# 分頁時 offset + top_k 的上限，避免深分頁對整個語料排序
+MAX_RESULT_WINDOW = _int("RECIPE_MAX_RESULT_WINDOW", 500)
+# /api/suggest 每次最多回傳的建議數
+SUGGEST_MAX_LIMIT = _int("RECIPE_SUGGEST_MAX_LIMIT", 50)
+
+# 嵌入矩陣的儲存格式 (float32, float16, int8)，量化後 recall@10 低於門檻時退回 float32
+# 可先以 python quantization.py --cache-dir ./cache 比較各模態的 recall 與記憶體用量
+# (numpy 的 float16 轉換較慢，int8 的記憶體更小且查詢速度接近 float32)
+TEXT_VECTOR_DTYPE = os.environ.get("RECIPE_TEXT_VECTOR_DTYPE", "float32")
+INGREDIENT_VECTOR_DTYPE = os.environ.get("RECIPE_INGREDIENT_VECTOR_DTYPE", "float32")
+QUANTIZATION_MIN_RECALL = _float("RECIPE_QUANTIZATION_MIN_RECALL", 0.95)
+
+# 文字與食材向量的搜尋索引: exact (暴力內積)、hnsw (近似最近鄰) 或 auto (資料量達 ANN_MIN_ROWS 時使用 hnsw)
+VECTOR_INDEX = os.environ.get("RECIPE_VECTOR_INDEX", "auto")
+ANN_MIN_ROWS = _int("RECIPE_ANN_MIN_ROWS", 100000)
+# HNSW 參數: M 與 ef_construction 影響建置品質與記憶體，ef 為查詢時的搜尋廣度
+HNSW_M = _int("RECIPE_HNSW_M", 16)
+HNSW_EF_CONSTRUCTION = _int("RECIPE_HNSW_EF_CONSTRUCTION", 200)
+HNSW_EF = _int("RECIPE_HNSW_EF", 64)
+# 有篩選條件時，符合的列不超過此數量就直接計算這些列的精確分數，不走 HNSW
+FILTER_EXACT_MAX_ROWS = _int("RECIPE_FILTER_EXACT_MAX_ROWS", 20000)
+
+# 食材斷詞: jieba 自訂詞典 (空字串表示只用內建詞典) 與建置食材產物時的斷詞行程數
+INGREDIENT_DICT = os.environ.get(
+    "RECIPE_INGREDIENT_DICT", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ingredient_dict.txt"))
+TOKENIZE_WORKERS = _int("RECIPE_TOKENIZE_WORKERS", os.cpu_count() or 1)
+
+# 多 worker 部署: shared_corpus.py 發佈的唯讀資料目錄 (空字串表示各 worker 自行載入語料)
+SHARED_DIR = os.environ.get("RECIPE_SHARED_DIR", "")
+# 獨立推論行程的 UNIX socket (remote_inference.py，空字串表示在 worker 內載入模型)
+INFERENCE_SOCKET = os.environ.get("RECIPE_INFERENCE_SOCKET", "")
+
+# 查詢與語料的編碼器: torch (sentence-transformers / transformers) 或 onnx (onnx_export.py 匯出的模型)
+ENCODER_BACKEND = os.environ.get("RECIPE_ENCODER_BACKEND", "torch")
+ONNX_DIR = os.environ.get("RECIPE_ONNX_DIR", "./cache/onnx")
+# 使用 int8 動態量化的 ONNX 模型 (匯出時需加上 --int8)
+ONNX_INT8 = os.environ.get("RECIPE_ONNX_INT8", "0").lower() not in ("0", "false", "no")
+# onnxruntime 的 intra-op 執行緒數，0 表示由 onnxruntime 決定
+ONNX_THREADS = _int("RECIPE_ONNX_THREADS", 0)
@@ -0,0 +1,110 @@
+"""
+    串流讀取與寫出食譜資料檔
+
+    支援 JSON 陣列 (recipe_data.json) 與 JSON Lines，逐筆解析、驗證並去除重複的 id，
+    不需要先把整個檔案讀成一個大的 list。解析後的食譜直接放進 RecipeStore
+    (搜尋欄位留在記憶體，完整內容寫入磁碟檔)。
+"""
+import itertools
+import json
+import os
+import time
+from typing import Iterable, Iterator
+import orjson
+from recipe_store import RecipeBodyFile, RecipeStore, normalize_recipe
+
+# 每次從檔案讀取的字元數
+CHUNK_SIZE = 1 << 20
+
+_WHITESPACE = " \t\r\n"
+
+
+def _iter_json_array(f, first: str, chunk_size: int) -> Iterator:
+    decoder = json.JSONDecoder()
+    buf, pos, eof = first, 1, False
+    while True:
+        # 略過元素之間的空白與逗號
+        while pos < len(buf) and buf[pos] in _WHITESPACE + ",":
+            pos += 1
+        if pos < len(buf) and buf[pos] == "]":
+            return
+        if pos < len(buf):
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+                # 解析到緩衝區結尾時，數字之類的值可能還沒讀完
+                if end < len(buf) or eof:
+                    yield value
+                    pos = end
+                    continue
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+        elif eof:
+            raise ValueError("unexpected end of JSON array")
+        # 記錄比緩衝區大時每次加倍讀取量，避免重複解析同一筆記錄太多次
+        chunk = f.read(max(chunk_size, len(buf) - pos))
+        eof = not chunk
+        buf, pos = buf[pos:] + chunk, 0
+
+
+def _iter_json_lines(f, first_line: str) -> Iterator:
+    for line in itertools.chain([first_line], f):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield orjson.loads(line)
+        except orjson.JSONDecodeError:
+            print(f"Error parsing JSON line: {line[:80]!r}")
+
+
+def iter_records(path: str, chunk_size: int = CHUNK_SIZE) -> Iterator:
+    """依檔案開頭判斷格式 ([ 為 JSON 陣列，其餘為 JSON Lines)，逐筆回傳解析後的值"""
+    with open(path, "r", encoding='utf-8-sig') as f:
+        # 逐字略過開頭的空白 (整個語料可能只有一行，不能用 readline 判斷格式)
+        first = f.read(1)
+        while first and first in _WHITESPACE:
+            first = f.read(1)
+        if first == "[":
+            yield from _iter_json_array(f, first, chunk_size)
+        elif first:
+            yield from _iter_json_lines(f, first + f.readline())
+
+
+def load_store(path: str, body_dir: str | None = None) -> RecipeStore:
+    """
+        串流載入食譜資料檔到 RecipeStore
+
+        不是物件、缺少 id 或欄位格式錯誤的食譜會被略過，重複的 id 以後出現者為準。
+        body_dir 為完整食譜內容磁碟檔的目錄 (None 表示系統暫存目錄)。
+    """
+    store = RecipeStore(bodies=RecipeBodyFile(body_dir))
+    start = time.perf_counter()
+    count = invalid = duplicates = 0
+    for record in iter_records(path):
+        count += 1
+        try:
+            recipe = normalize_recipe(record)
+        except ValueError as e:
+            invalid += 1
+            print(f"Error loading recipe #{count}: {e}")
+            continue
+        if recipe['id'] in store:
+            duplicates += 1
+        store.put(recipe)
+    print(f"載入 {len(store)} 筆食譜 (讀取 {count} 筆, 無效 {invalid} 筆, 重複 {duplicates} 筆), "
+          f"耗時 {time.perf_counter() - start:.1f} 秒")
+    return store
+
+
+def write_json_array(recipes: Iterable[dict], path: str):
+    """逐筆寫出 JSON 陣列 (先寫入暫存檔再替換)"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(b"[")
+        for i, recipe in enumerate(recipes):
+            if i:
+                f.write(b",\n")
+            f.write(orjson.dumps(recipe))
+        f.write(b"]")
+    os.replace(tmp_path, path)
@@ -0,0 +1,227 @@
+"""
+    搜尋用資料的快照與增量更新
+
+    食譜的新增、更新與刪除不會修改正在使用的資料結構，而是複製受影響的部分、
+    建立新的 CorpusSnapshot 後一次替換 (copy-on-write)。每個查詢開始時取得當下的快照
+    並全程使用，因此不會看到只套用一半的更新。
+
+    更新同時寫入 journal (JSON Lines)，重新啟動時依序重播；重新建置 (rebuild) 時
+    寫回食譜資料檔，journal 只留下建置期間才進來的更新。
+"""
+import json
+import os
+from typing import Dict, List
+import numpy as np
+import ingredient_model
+from recipe_filter import FilterIndex
+from recipe_store import RecipeStore
+from suggest_index import SuggestIndex
+from vector_index import OverlayIndex
+
+
+class IngredientState:
+    """
+        食材搜尋所需的資料
+
+        artifact 為上次建置的 Word2Vec 產物 (不可變)，其倒排索引只涵蓋建置時的食譜；
+        之後新增或更新的食譜記錄在 delta_tokens (store 列號 -> 每個食材的 (位置, 詞集合))，
+        食譜向量則在 vectors 的 delta 中 (vectors.dirty 同時標示倒排索引中已失效的列)。
+        Word2Vec 詞彙外的新食材詞以 oov_vectors 中的估計向量代替，直到下次重新建置。
+    """
+
+    def __init__(self, artifact: ingredient_model.IngredientArtifact, vectors: OverlayIndex,
+                 ingredient_offsets: np.ndarray, delta_tokens: Dict[int, list] | None = None,
+                 oov_vectors: Dict[str, np.ndarray] | None = None):
+        self.artifact = artifact
+        self.wv = artifact.wv
+        self.vectors = vectors
+        # 依 store 列號排列的食材編號範圍: 第 row 列的食材編號為 [ingredient_offsets[row], ingredient_offsets[row + 1])
+        self.ingredient_offsets = ingredient_offsets
+        self.ingredient_row = np.repeat(np.arange(len(ingredient_offsets) - 1, dtype=np.int64),
+                                        np.diff(ingredient_offsets))
+        self.delta_tokens = delta_tokens or {}
+        self.oov_vectors = oov_vectors or {}
+
+    def token_vector(self, token: str) -> np.ndarray | None:
+        """取得食材詞的向量 (包含詞彙外的估計向量)，沒有時回傳 None"""
+        if token in self.wv:
+            return self.wv[token]
+        return self.oov_vectors.get(token)
+
+    def match(self, token_lists: List[List[str]]):
+        """
+            找出含有查詢食材的食譜食材
+
+            回傳 (建置時就存在且未被更新的全域食材編號 (已排序), {store 列號: 匹配到的食材位置})
+        """
+        matched_ids = []
+        for tokens in token_lists:
+            ids = self.artifact.ingredient_ids(tokens[0])
+            for token in tokens[1:]:
+                ids = np.intersect1d(ids, self.artifact.ingredient_ids(token), assume_unique=True)
+            matched_ids.append(ids)
+        matched = np.unique(np.concatenate(matched_ids)) if matched_ids else np.empty(0, dtype=np.int64)
+        if len(self.vectors.dirty) and len(matched):
+            # 已刪除或更新的食譜以 delta 中的版本為準
+            matched = matched[~self.vectors.is_dirty(self.ingredient_row[matched])]
+
+        delta_matches = {}
+        query_sets = [set(tokens) for tokens in token_lists]
+        for row, ingredients in self.delta_tokens.items():
+            positions = [position for position, tokens in ingredients
+                         if any(query <= tokens for query in query_sets)]
+            if positions:
+                delta_matches[row] = positions
+        return matched, delta_matches
+
+    def recipe_refs(self, token: str, limit: int, mask: np.ndarray | None = None) -> List[tuple]:
+        """
+            使用該食材詞的前 limit 個食譜 [(store 列號, 食材位置)]，每個食譜只列一次
+
+            沒有篩選遮罩 (mask) 且預先取出的食譜都沒有更新時直接查表，否則掃描倒排索引；
+            建置後新增或更新的食譜接在後面。
+        """
+        ids = self.artifact.first_ingredient_ids(token)
+        rows = self.ingredient_row[ids]
+        if mask is not None or limit > self.artifact.first_ids.shape[1] or self.vectors.is_dirty(rows).any():
+            ids = self.artifact.ingredient_ids(token)
+            rows = self.ingredient_row[ids]
+            keep = ~self.vectors.is_dirty(rows)
+            if mask is not None:
+                keep &= mask[rows]
+            ids, rows = ids[keep], rows[keep]
+            # 食材編號依列號排序，同一食譜只取第一個食材
+            first = np.flatnonzero(np.diff(rows, prepend=-1) != 0)[:limit]
+            ids, rows = ids[first], rows[first]
+        refs = list(zip(rows[:limit].tolist(), (ids[:limit] - self.ingredient_offsets[rows[:limit]]).tolist()))
+
+        for row, ingredients in self.delta_tokens.items():
+            if len(refs) >= limit:
+                break
+            if mask is not None and not mask[row]:
+                continue
+            position = next((position for position, tokens in ingredients if token in tokens), None)
+            if position is not None:
+                refs.append((row, position))
+        return refs
+
+    def with_updates(self, changes: List[tuple]):
+        """
+            回傳套用更新後的新狀態
+
+            changes 中每一項為 (store 列號, 新版本的食材)，新版本的食材為 [(位置, 詞列表)]，刪除時為 None。
+        """
+        delta_tokens = dict(self.delta_tokens)
+        oov_vectors = dict(self.oov_vectors)
+
+        rows, vectors, deleted_rows = [], [], []
+        for row, ingredients in changes:
+            delta_tokens.pop(row, None)
+            if ingredients is None:
+                deleted_rows.append(row)
+                continue
+
+            for _, tokens in ingredients:
+                for token in tokens:
+                    if token not in self.wv and token not in oov_vectors:
+                        vector = ingredient_model.oov_vector(self.wv, token)
+                        if vector is not None:
+                            oov_vectors[token] = vector
+            delta_tokens[row] = [(position, frozenset(tokens)) for position, tokens in ingredients]
+
+            vector = ingredient_model.recipe_vector(
+                [tokens for _, tokens in ingredients],
+                lambda token: self.wv[token] if token in self.wv else oov_vectors.get(token))
+            if vector is not None:
+                norm = np.linalg.norm(vector)
+                vector = vector / norm if norm > 0 else None
+            rows.append(row)
+            vectors.append(vector)
+
+        return IngredientState(self.artifact, self.vectors.with_updates(rows, vectors, deleted_rows),
+                               self.ingredient_offsets, delta_tokens, oov_vectors)
+
+
+class CorpusSnapshot:
+    """
+        某一時間點的食譜與搜尋索引
+
+        store: RecipeStore
+        text: 文字嵌入索引 (OverlayIndex)，文字模態尚未載入時為 None
+        ingredient: IngredientState，食材模態尚未載入時為 None
+        suggest: 自動完成的 SuggestIndex，第一次查詢前為 None
+        filters: 屬性篩選的 FilterIndex，第一次使用篩選條件前為 None
+    """
+
+    def __init__(self, store: RecipeStore, text: OverlayIndex | None = None,
+                 ingredient: IngredientState | None = None, suggest: SuggestIndex | None = None,
+                 filters: FilterIndex | None = None):
+        self.store = store
+        self.text = text
+        self.ingredient = ingredient
+        self.suggest = suggest
+        self.filters = filters
+
+    def replace(self, **changes):
+        """回傳替換部分欄位後的新快照"""
+        fields = {'store': self.store, 'text': self.text, 'ingredient': self.ingredient, 'suggest': self.suggest,
+                  'filters': self.filters}
+        fields.update(changes)
+        return CorpusSnapshot(**fields)
+
+
+def apply_update(store: RecipeStore, op: str, payload):
+    """將一筆 journal 更新 ('put' 食譜列表或 'delete' id 列表) 套用到 store"""
+    if op == 'put':
+        for recipe in payload:
+            store.put(recipe)
+    elif op == 'delete':
+        for recipe_id in payload:
+            store.delete(recipe_id)
+
+
+class UpdateJournal:
+    """以 JSON Lines 記錄尚未寫回食譜資料檔的更新"""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def append(self, op: str, payload):
+        with open(self.path, "a", encoding='utf-8') as f:
+            f.write(json.dumps({'op': op, 'data': payload}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def reset(self, entries: List[tuple]):
+        """以 entries [(op, payload)] 取代 journal 的內容 (先寫暫存檔再替換)"""
+        if not entries:
+            self.clear()
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            for op, payload in entries:
+                f.write(json.dumps({'op': op, 'data': payload}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def replay(self, store: RecipeStore) -> int:
+        """將 journal 中的更新依序套用到 store，回傳套用的筆數"""
+        if not os.path.exists(self.path):
+            return 0
+        count = 0
+        with open(self.path, "r", encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 寫入到一半中斷的最後一行
+                    print(f"Error reading update journal: {line[:80]!r}")
+                    continue
+                apply_update(store, entry['op'], entry['data'])
+                count += 1
+        return count
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import time
+from typing import Callable, List
+import numpy as np
+from cache_files import atomic_write, file_lock
+
+
+def text_key(model_name: str, text: str) -> str:
+    """以模型名稱與文字內容計算快取鍵"""
+    return hashlib.sha1(f"{model_name}\0{text}".encode('utf-8')).hexdigest()
+
+
+class TextEmbeddingCache:
+    """
+        以內容雜湊為鍵的文字嵌入磁碟快取
+
+        嵌入矩陣存成 .npy 並以 memory-map 方式載入，旁邊的 keys 檔記錄每一列對應的
+        雜湊值。啟動時只有新增或內容有變動的食譜需要重新編碼。
+        讀取、編碼與寫入都持有跨行程的檔案鎖，多個 worker 同時冷啟動時只有一個會編碼。
+    """
+
+    def __init__(self, cache_dir: str, model_name: str):
+        self.model_name = model_name
+        os.makedirs(cache_dir, exist_ok=True)
+        slug = model_name.replace('/', '_')
+        self.matrix_path = os.path.join(cache_dir, f"text_embeddings_{slug}.npy")
+        self.keys_path = os.path.join(cache_dir, f"text_embeddings_{slug}.keys.json")
+
+    def quantized_prefix(self, mode: str) -> str:
+        """量化矩陣的檔名前綴"""
+        return self.matrix_path[:-len(".npy")] + f".{mode}"
+
+    def index_prefix(self) -> str:
+        """向量索引的檔名前綴"""
+        return self.matrix_path[:-len(".npy")] + ".index"
+
+    def digest(self) -> str:
+        """目前快取內容的雜湊 (由每一列的鍵決定)"""
+        with open(self.keys_path, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def load_published(self, digest: str) -> np.ndarray:
+        """以 mmap 載入 loader 已建立的嵌入矩陣，快取內容與發佈時不同時拋出 RuntimeError"""
+        if not os.path.exists(self.keys_path) or self.digest() != digest:
+            raise RuntimeError("text embedding cache does not match the shared corpus, re-run shared_corpus.py")
+        return np.load(self.matrix_path, mmap_mode='r')
+
+    def _load_existing(self):
+        if not (os.path.exists(self.matrix_path) and os.path.exists(self.keys_path)):
+            return [], None
+        try:
+            with open(self.keys_path, "r", encoding='utf-8') as f:
+                keys = json.load(f)
+            matrix = np.load(self.matrix_path, mmap_mode='r')
+        except (OSError, ValueError) as e:
+            print(f"Error loading text embedding cache: {e}")
+            return [], None
+        if len(keys) != matrix.shape[0]:
+            return [], None
+        return keys, matrix
+
+    def _save(self, keys: List[str], matrix: np.ndarray):
+        # 先寫入各行程唯一的暫存檔再替換，避免中斷時留下損毀的快取 (需持有 file_lock)
+        with atomic_write(self.matrix_path) as f:
+            np.save(f, matrix)
+        with atomic_write(self.keys_path, "w", encoding='utf-8') as f:
+            json.dump(keys, f)
+
+    def load(self,
+             texts: List[str],
+             encode: Callable[[List[str]], np.ndarray],
+             batch_size: int = 256) -> np.ndarray:
+        """
+            取得所有文字的嵌入矩陣，列順序與 texts 相同
+
+            參數:
+            texts: 要編碼的文字
+            encode: 將一批文字轉為嵌入矩陣的函式
+            batch_size: 每批重新編碼的文字數量
+        """
+        keys = [text_key(self.model_name, text) for text in texts]
+        with file_lock(self.matrix_path):
+            return self._load_locked(texts, keys, encode, batch_size)
+
+    def _load_locked(self, texts: List[str], keys: List[str], encode: Callable[[List[str]], np.ndarray],
+                     batch_size: int) -> np.ndarray:
+        cached_keys, cached = self._load_existing()
+
+        # 快取完全吻合時直接回傳 memory-map 的矩陣
+        if cached is not None and cached_keys == keys:
+            print(f"文字嵌入快取命中: {len(keys)} 筆")
+            return cached
+
+        cached_rows = {key: row for row, key in enumerate(cached_keys)}
+        missing = [i for i, key in enumerate(keys) if key not in cached_rows]
+
+        new_vectors = {}
+        start = time.perf_counter()
+        for begin in range(0, len(missing), batch_size):
+            batch = missing[begin:begin + batch_size]
+            vectors = np.asarray(encode([texts[i] for i in batch]), dtype=np.float32)
+            for i, vector in zip(batch, vectors):
+                new_vectors[i] = vector
+            done = begin + len(batch)
+            elapsed = time.perf_counter() - start
+            print(f"文字嵌入編碼: {done}/{len(missing)} "
+                  f"({done / len(missing):.1%}, {done / max(elapsed, 1e-9):.1f} 筆/秒)")
+
+        if cached is not None and cached.shape[0]:
+            dim = cached.shape[1]
+        elif new_vectors:
+            dim = next(iter(new_vectors.values())).shape[0]
+        else:
+            dim = 0
+        matrix = np.empty((len(keys), dim), dtype=np.float32)
+        for i, key in enumerate(keys):
+            matrix[i] = new_vectors[i] if i in new_vectors else cached[cached_rows[key]]
+
+        print(f"文字嵌入快取: 重用 {len(keys) - len(missing)} 筆, 重新編碼 {len(missing)} 筆")
+        # 釋放舊的 memory-map 再覆寫檔案
+        del cached
+        self._save(keys, matrix)
+        return np.load(self.matrix_path, mmap_mode='r')
@@ -0,0 +1,159 @@
+"""
+    文字與圖片編碼器
+
+    查詢與語料的編碼可使用 PyTorch 模型或 onnx_export.py 匯出的 ONNX 模型 (由 RECIPE_ENCODER_BACKEND 選擇)。
+    文字編碼器與 SentenceTransformer 相同，提供 encode(texts, batch_size)；
+    圖片編碼器提供 encode(images)，回傳 CLIP 圖片特徵矩陣。
+
+    ONNX 模型只需要 onnxruntime 與 tokenizers，不必載入 torch / transformers。
+"""
+import contextlib
+import json
+import os
+from typing import List
+import numpy as np
+from PIL import Image
+
+BACKENDS = ('torch', 'onnx')
+
+
+def model_path(model_dir: str, quantized: bool = False) -> str:
+    return os.path.join(model_dir, "model.int8.onnx" if quantized else "model.onnx")
+
+
+def _load_meta(model_dir: str) -> dict:
+    with open(os.path.join(model_dir, "encoder.json"), "r", encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _session(path: str, threads: int = 0):
+    import onnxruntime as ort
+
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} not found, run onnx_export.py first")
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if threads:
+        options.intra_op_num_threads = threads
+    return ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+
+class OnnxTextEncoder:
+    """
+        ONNX 文字編碼器 (paraphrase-multilingual-MiniLM 或 CLIP 文字塔)
+
+        匯出的模型輸入 input_ids / attention_mask，直接輸出句向量 (池化已包含在模型中)。
+    """
+
+    def __init__(self, model_dir: str, quantized: bool = False, threads: int = 0):
+        from tokenizers import Tokenizer
+
+        self.meta = _load_meta(model_dir)
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(self.meta['max_length'])
+        self.tokenizer.enable_padding(pad_id=self.meta['pad_id'], pad_token=self.meta['pad_token'])
+        self.session = _session(model_path(model_dir, quantized), threads)
+
+    def encode(self, texts: List[str], batch_size: int = 64, **kwargs) -> np.ndarray:
+        texts = list(texts)
+        outputs = []
+        for begin in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(texts[begin:begin + batch_size])
+            feed = {
+                'input_ids': np.array([e.ids for e in encodings], dtype=np.int64),
+                'attention_mask': np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            }
+            outputs.append(self.session.run(None, feed)[0])
+        if not outputs:
+            return np.empty((0, self.session.get_outputs()[0].shape[-1]), dtype=np.float32)
+        return np.concatenate(outputs).astype(np.float32, copy=False)
+
+
+class OnnxImageEncoder:
+    """
+        ONNX CLIP 圖片編碼器
+
+        前處理與 CLIPImageProcessor 相同: 短邊縮放到 size (bicubic)、中央裁切、依 mean / std 正規化。
+    """
+
+    def __init__(self, model_dir: str, quantized: bool = False, threads: int = 0):
+        self.meta = _load_meta(model_dir)
+        self.mean = np.asarray(self.meta['mean'], dtype=np.float32).reshape(3, 1, 1)
+        self.std = np.asarray(self.meta['std'], dtype=np.float32).reshape(3, 1, 1)
+        self.session = _session(model_path(model_dir, quantized), threads)
+
+    def preprocess(self, images: List[Image.Image]) -> np.ndarray:
+        size, crop = self.meta['size'], self.meta['crop_size']
+        pixels = np.empty((len(images), 3, crop, crop), dtype=np.float32)
+        for i, image in enumerate(images):
+            image = image.convert("RGB")
+            width, height = image.size
+            if width <= height:
+                resized = (size, int(size * height / width))
+            else:
+                resized = (int(size * width / height), size)
+            image = image.resize(resized, Image.BICUBIC)
+            left, top = (resized[0] - crop) // 2, (resized[1] - crop) // 2
+            image = image.crop((left, top, left + crop, top + crop))
+            array = np.asarray(image, dtype=np.float32).transpose(2, 0, 1) / 255.0
+            pixels[i] = (array - self.mean) / self.std
+        return pixels
+
+    def encode(self, images: List[Image.Image]) -> np.ndarray:
+        return self.session.run(None, {'pixel_values': self.preprocess(images)})[0]
+
+
+class ClipImageEncoder:
+    """以 transformers 的 CLIPModel / CLIPProcessor (或相同介面的 stub) 編碼圖片"""
+
+    def __init__(self, clip_model, clip_processor):
+        self.clip_model = clip_model
+        self.clip_processor = clip_processor
+
+    def encode(self, images: List[Image.Image]) -> np.ndarray:
+        inputs = self.clip_processor(images=images, return_tensors="pt")
+        with _inference_mode():
+            return self.clip_model.get_image_features(**inputs).detach().numpy()
+
+
+def _inference_mode():
+    # 沒有安裝 torch 時 (例如 benchmark 使用 stub 模型) 不需要關閉 autograd
+    try:
+        import torch
+    except ImportError:
+        return contextlib.nullcontext()
+    return torch.inference_mode()
+
+
+def text_cache_name(model_name: str, backend: str, quantized: bool) -> str:
+    """
+        文字嵌入快取使用的模型名稱
+
+        ONNX float32 模型與 PyTorch 的輸出一致 (見 onnx_export.py 的比對)，共用同一份快取；
+        int8 模型的向量略有差異，另外建立快取，讓語料與查詢使用同一個模型編碼。
+    """
+    return f"{model_name}@int8" if backend == 'onnx' and quantized else model_name
+
+
+def load_text_encoder(model_name: str, backend: str = 'torch', onnx_dir: str = "./cache/onnx",
+                      quantized: bool = False, threads: int = 0):
+    """依 backend 載入文字編碼器"""
+    if backend == 'onnx':
+        return OnnxTextEncoder(os.path.join(onnx_dir, "text"), quantized, threads)
+    if backend != 'torch':
+        raise ValueError(f"unknown encoder backend: {backend}")
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(model_name)
+
+
+def load_image_encoder(model_name: str, backend: str = 'torch', onnx_dir: str = "./cache/onnx",
+                       quantized: bool = False, threads: int = 0):
+    """依 backend 載入 CLIP 圖片編碼器"""
+    if backend == 'onnx':
+        return OnnxImageEncoder(os.path.join(onnx_dir, "clip_vision"), quantized, threads)
+    if backend != 'torch':
+        raise ValueError(f"unknown encoder backend: {backend}")
+    from transformers import CLIPModel, CLIPProcessor
+
+    return ClipImageEncoder(CLIPModel.from_pretrained(model_name), CLIPProcessor.from_pretrained(model_name))
@@ -0,0 +1,56 @@
+"""
+    多模態搜尋的候選融合
+
+    每個模態提供一組有限的候選 (store 列號, 分數)，分數越高越相似。
+    融合在陣列上進行，回傳依融合分數排序的前 top_k 個列號。
+"""
+from typing import List, Tuple
+import numpy as np
+
+Candidates = Tuple[np.ndarray, np.ndarray]
+
+
+def minmax_normalize(scores: np.ndarray) -> np.ndarray:
+    """將分數正規化到 0-1 範圍 (全部相同時為 1)"""
+    if len(scores) == 0:
+        return scores.astype(np.float64)
+    low, high = scores.min(), scores.max()
+    if high == low:
+        return np.ones(len(scores), dtype=np.float64)
+    return (scores - low) / (high - low)
+
+
+def _modality_matrix(candidates: List[Candidates], transform) -> Tuple[np.ndarray, np.ndarray]:
+    """合併所有模態的候選，回傳 (唯一列號, 每個模態對每個列號的分數矩陣)"""
+    all_rows = np.concatenate([rows for rows, _ in candidates])
+    rows, inverse = np.unique(all_rows, return_inverse=True)
+    matrix = np.zeros((len(candidates), len(rows)), dtype=np.float64)
+    begin = 0
+    for m, (modality_rows, scores) in enumerate(candidates):
+        end = begin + len(modality_rows)
+        matrix[m, inverse[begin:end]] = transform(np.asarray(scores, dtype=np.float64))
+        begin = end
+    return rows, matrix
+
+
+def weighted_score_fusion(candidates: List[Candidates], weights: List[float]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """各模態分數先在候選內做 min-max 正規化，再加權相加 (未出現的候選該模態分數為 0)"""
+    rows, matrix = _modality_matrix(candidates, minmax_normalize)
+    return rows, np.asarray(weights, dtype=np.float64) @ matrix, matrix
+
+
+def reciprocal_rank_fusion(candidates: List[Candidates], weights: List[float], k: int = 60) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Reciprocal Rank Fusion: 每個模態貢獻 weight / (k + 名次)，候選需已依分數由高到低排序"""
+    rows, ranks = _modality_matrix(candidates, lambda scores: 1.0 / (k + np.arange(1, len(scores) + 1)))
+    # 回傳的模態分數仍為正規化後的原始分數，方便前端顯示
+    _, matrix = _modality_matrix(candidates, minmax_normalize)
+    return rows, np.asarray(weights, dtype=np.float64) @ ranks, matrix
+
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """以 argpartition 取出分數最高的 top_k 個位置，並由高到低排序"""
+    k = min(top_k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind='stable')]
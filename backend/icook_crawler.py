@@ -1,43 +1,52 @@
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import threading
+import random
 import time
 import json
+import os
 
-def getRecipeIdTopPage(top: int) -> list[str]:
-    recipe_ids = []
-    headers = {'user-agent': 'Mozilla/5.0'}
+HEADERS = {'user-agent': 'Mozilla/5.0'}
+SEARCH_URL = "https://icook.tw/search/%E5%AE%B6%E5%B8%B8%E8%8F%9C/?page={page}"
+RECIPE_URL = "https://icook.tw/recipes/{id}"
 
-    for i in range(1, top + 1):
-        url = f"https://icook.tw/search/%E5%AE%B6%E5%B8%B8%E8%8F%9C/?page={i}"
-        try:
-            page = requests.get(url, headers=headers)
-            page.raise_for_status()  # Raise an error for bad responses (4xx or 5xx)
-        except requests.exceptions.RequestException as e:
-            print(f"Error fetching page {i}: {e}")
-            continue
 
-        soup = BeautifulSoup(page.text, 'lxml')
-        recipe_cards = soup.find_all('article', 'browse-recipe-card')
+class TokenBucket:
+    """執行緒安全的 token bucket，限制每秒請求數"""
 
-        if recipe_cards:
-            recipe_ids.extend([card['data-recipe-id'] for card in recipe_cards if 'data-recipe-id' in card.attrs])
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
 
-        time.sleep(1)
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
 
-    return recipe_ids
 
-def getRecipeData(id: str):
-    headers = {'user-agent': 'Mozilla/5.0'}
-    url = f"https://icook.tw/recipes/{id}"
+def parseRecipeIds(html: str) -> list[str]:
+    """從搜尋結果頁面的 HTML 取出食譜 id"""
+    soup = BeautifulSoup(html, 'lxml')
+    recipe_cards = soup.find_all('article', 'browse-recipe-card')
+    return [card['data-recipe-id'] for card in recipe_cards if 'data-recipe-id' in card.attrs]
 
-    try:
-        page = requests.get(url, headers=headers)
-        page.raise_for_status()  # Raise an error for bad responses
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching recipe {id}: {e}")
-        return None  # Return None if there's an error
 
-    soup = BeautifulSoup(page.text, 'lxml')
+def parseRecipe(id: str, html: str) -> dict:
+    """從食譜頁面的 HTML 取出食譜資料"""
+    soup = BeautifulSoup(html, 'lxml')
 
     # 菜名
     recipeName = soup.find('h1', {'id': 'recipe-name'})
@@ -62,11 +71,11 @@ def getRecipeData(id: str):
     # 食材
     ingredients = []
     ingredient_li_list = soup.find_all('li', 'ingredient')
-    
+
     for li in ingredient_li_list:
         ingredientName = li.find('div', 'ingredient-name').find('a')
         ingredientUnit = li.find('div', 'ingredient-unit')
-        
+
         ingredients.append({
             "name": ingredientName.text.strip() if ingredientName else None,
             "amount": ingredientUnit.text.strip() if ingredientUnit else None,
@@ -75,20 +84,20 @@ def getRecipeData(id: str):
     # 步驟
     recipeSteps = []
     step_li_list = soup.find_all('li', 'recipe-details-step-item')
-    
+
     for i, li in enumerate(step_li_list, start=1):
         img = li.find('img')
-        
+
         recipeStepCover = img['data-src'] if img else None
         recipeStepDescription = img['alt'] if img else None
-        
+
         recipeSteps.append({
             "id": i,
             "image": recipeStepCover,
             "description": recipeStepDescription,
             "tips": None
         })
-    
+
     # 份量
     servings_info = soup.find('div','servings-info')
     if servings_info:
@@ -126,14 +135,187 @@ def getRecipeData(id: str):
         "steps": recipeSteps,
     }
 
+
+class RecipeCrawler:
+    """
+        多執行緒的 icook 爬蟲
+
+        參數:
+        concurrency: 同時進行的請求數 (也是連線池大小)
+        rate: 每秒最多請求數
+        retries: 失敗時的重試次數 (指數退避)
+        window: 每批送出的食譜數 (預設為 concurrency 的 8 倍)
+    """
+
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, concurrency: int = 4, rate: float = 2.0, retries: int = 3, backoff: float = 1.0,
+                 window: int | None = None):
+        self.concurrency = concurrency
+        # 每批送出的食譜數，避免一次把全部 id 排進執行緒池
+        self.window = window or concurrency * 8
+        self.retries = retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(rate)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(HEADERS)
+
+    def fetch(self, url: str) -> str | None:
+        """取得頁面內容，失敗時以指數退避重試，仍失敗則回傳 None"""
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            try:
+                page = self.session.get(url, timeout=15)
+                if page.status_code not in self.RETRY_STATUS:
+                    page.raise_for_status()  # Raise an error for bad responses (4xx)
+                    return page.text
+                error = f"HTTP {page.status_code}"
+            except requests.exceptions.HTTPError as e:
+                print(f"Error fetching {url}: {e}")
+                return None
+            except requests.exceptions.RequestException as e:
+                error = e
+            if attempt < self.retries:
+                time.sleep(self.backoff * (2 ** attempt) + random.uniform(0, self.backoff))
+        print(f"Error fetching {url}: {error}")
+        return None
+
+    def getRecipeIds(self, top: int) -> list[str]:
+        """並行抓取前 top 頁搜尋結果的食譜 id (保留頁面順序並去除重複)"""
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            pages = executor.map(self.fetch, [SEARCH_URL.format(page=i) for i in range(1, top + 1)])
+            recipe_ids = []
+            for html in pages:
+                if html:
+                    recipe_ids.extend(parseRecipeIds(html))
+        return list(dict.fromkeys(recipe_ids))
+
+    def getRecipe(self, id: str) -> dict | None:
+        """抓取並解析單一食譜，抓取或解析失敗時回傳 None (不影響其他食譜)"""
+        html = self.fetch(RECIPE_URL.format(id=id))
+        if not html:
+            return None
+        try:
+            return parseRecipe(id, html)
+        except Exception as e:
+            print(f"Error parsing recipe {id}: {e!r}")
+            return None
+
+    def crawl(self, recipe_ids: list[str], output_path: str) -> int:
+        """
+            抓取食譜並逐筆附加寫入 JSONL，已存在於輸出檔中的 id 會被略過
+
+            回傳本次新寫入的食譜數
+        """
+        done = set(readJsonlIds(output_path))
+        todo = [id for id in recipe_ids if id not in done]
+        print(f"共 {len(recipe_ids)} 筆食譜，已完成 {len(recipe_ids) - len(todo)} 筆，待抓取 {len(todo)} 筆")
+
+        # 上次中斷時最後一行可能沒寫完，補上換行避免與新資料黏在一起
+        if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+            with open(output_path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    with open(output_path, "a", encoding='utf-8') as out:
+                        out.write("\n")
+
+        written = 0
+        start = time.perf_counter()
+        with open(output_path, "a", encoding='utf-8') as f, ThreadPoolExecutor(self.concurrency) as executor:
+            # 分批送出，並依完成順序寫入，較慢的請求不會擋住同批其他食譜的寫入
+            for i in range(0, len(todo), self.window):
+                futures = [executor.submit(self.getRecipe, id) for id in todo[i:i + self.window]]
+                for future in as_completed(futures):
+                    recipe = future.result()
+                    if recipe is None:
+                        continue
+                    # 只有主執行緒寫檔，每筆寫入後立即 flush 以便中斷後續抓
+                    f.write(json.dumps(recipe, ensure_ascii=False) + "\n")
+                    f.flush()
+                    written += 1
+                    if written % 50 == 0:
+                        print(f"已抓取 {written}/{len(todo)} 筆 ({written / (time.perf_counter() - start):.1f} 筆/秒)")
+        return written
+
+
+def readJsonlIds(path: str) -> list[str]:
+    """讀取 JSONL 檔中已完成的食譜 id (忽略中斷時寫到一半的最後一行)"""
+    if not os.path.exists(path):
+        return []
+    ids = []
+    with open(path, "r", encoding='utf-8') as f:
+        for line in f:
+            try:
+                ids.append(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                continue
+    return ids
+
+
+def jsonlToJson(jsonl_path: str, json_path: str):
+    """將 JSONL 逐行轉為 JSON 陣列，不需把所有食譜載入記憶體"""
+    with open(jsonl_path, "r", encoding='utf-8') as src, open(json_path, "w", encoding='utf-8') as dst:
+        dst.write("[")
+        first = True
+        for line in src:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                json.loads(line)
+            except ValueError:
+                continue
+            if not first:
+                dst.write(",")
+            dst.write(line)
+            first = False
+        dst.write("]")
+
+
+def getRecipeIdTopPage(top: int) -> list[str]:
+    return RecipeCrawler().getRecipeIds(top)
+
+
+def getRecipeData(id: str):
+    return RecipeCrawler().getRecipe(id)
+
+
 if __name__ == "__main__":
-    recipe_ids = getRecipeIdTopPage(10)
-    
-    # Filtering out None values from getRecipeData
-    recipe_data = [getRecipeData(recipe_id) for recipe_id in recipe_ids if getRecipeData(recipe_id) is not None]
-    
-    with open("./icook_recipe/recipe_data.json", "w", encoding='utf-8') as f:
-        json.dump(recipe_data, f, ensure_ascii=False)
-
-    # data = getRecipeData("470231")
-    # print(data)
+    parser = argparse.ArgumentParser(description="icook 食譜爬蟲")
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=2.0, help="每秒最多請求數")
+    parser.add_argument("--retries", type=int, default=3)
+    parser.add_argument("--output", default="./icook_recipe/recipe_data.jsonl")
+    parser.add_argument("--json", default="./icook_recipe/recipe_data.json", help="另存為 JSON 陣列")
+    parser.add_argument("--parse", nargs="+", metavar="HTML", help="只解析已存的食譜 HTML 並計時")
+    args = parser.parse_args()
+
+    if args.parse:
+        for path in args.parse:
+            with open(path, "r", encoding='utf-8') as f:
+                html = f.read()
+            start = time.perf_counter()
+            data = parseRecipe(os.path.splitext(os.path.basename(path))[0], html)
+            elapsed = time.perf_counter() - start
+            print(json.dumps(data, ensure_ascii=False))
+            print(f"{path}: {elapsed * 1000:.2f} ms")
+    else:
+        crawler = RecipeCrawler(args.concurrency, args.rate, args.retries)
+
+        # 搜尋頁的 id 清單存成 checkpoint，續抓時不需重新抓取搜尋頁
+        ids_path = args.output + ".ids.json"
+        if os.path.exists(ids_path):
+            with open(ids_path, "r", encoding='utf-8') as f:
+                recipe_ids = json.load(f)
+        else:
+            recipe_ids = crawler.getRecipeIds(args.pages)
+            with open(ids_path, "w", encoding='utf-8') as f:
+                json.dump(recipe_ids, f)
+
+        crawler.crawl(recipe_ids, args.output)
+        if args.json:
+            jsonlToJson(args.output, args.json)
@@ -0,0 +1,327 @@
+"""
+    食譜圖片向量的批次預計算流程
+
+    下載 (多執行緒、連線池) -> 有界佇列 -> 批次 CLIP 推論 -> 批次寫入 ChromaDB
+
+    已存在於 collection 中的 id 會被略過，中斷後重新執行即可從上次的進度繼續
+    (checkpoint 只是進度紀錄，以 collection 為準；collection 被清空或重建時 checkpoint 會一併修剪)。
+    既有項目的 metadata (篩選用的料理時間與份量) 過期時只更新 metadata，不重新計算向量。
+    下載來源可以是原始網址、本機目錄或替代的 HTTP 伺服器 (例如離線測試用的 stub server)。
+
+    > python image_pipeline.py --data ./icook_recipe/recipe_data.json --workers 16 --batch-size 32
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+from typing import Iterable, List
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image
+from recipe_store import parse_duration, parse_servings
+
+COLLECTION_NAME = "recipe_image_vectors"
+# collection metadata 中的標記: 所有項目都已寫入篩選用的 duration / servings metadata
+FILTER_METADATA_KEY = "filter_metadata_version"
+FILTER_METADATA_VERSION = 1
+
+# 下載執行緒結束的標記
+_DONE = object()
+
+
+def image_metadata(recipe: dict) -> dict:
+    """
+        寫入 collection 的 metadata
+
+        duration (分鐘) 與 servings (人數) 供圖片搜尋以 where 篩選，無法解析時不寫入該欄位
+        (ChromaDB 的 metadata 不接受 None，缺少欄位的項目不符合任何數值條件)。
+    """
+    metadata = {"name": recipe["name"], "description": recipe["description"]}
+    duration, servings = parse_duration(recipe.get("duration")), parse_servings(recipe.get("servings"))
+    if duration is not None:
+        metadata["duration"] = duration
+    if servings is not None:
+        metadata["servings"] = servings
+    return metadata
+
+
+def filter_metadata_synced(collection) -> bool:
+    """collection 的項目是否都已有篩選用的 metadata (舊版建立的 collection 只有名稱與描述)"""
+    return (collection.metadata or {}).get(FILTER_METADATA_KEY) == FILTER_METADATA_VERSION
+
+
+class ImageFetcher:
+    """
+        取得食譜圖片的原始位元組
+
+        參數:
+        image_dir: 本機圖片目錄，依序尋找 <recipe id>.<副檔名> 與網址中的檔名
+        base_url: 以此網址取代原始圖片網址的 scheme 與 host (例如 http://127.0.0.1:8765)
+        pool_size: HTTP 連線池大小，建議與下載執行緒數相同
+    """
+
+    EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+    def __init__(self, image_dir: str | None = None, base_url: str | None = None,
+                 pool_size: int = 8, timeout: float = 10.0):
+        self.image_dir = image_dir
+        self.base_url = base_url.rstrip('/') if base_url else None
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=2)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers['user-agent'] = 'Mozilla/5.0'
+
+    def _local_path(self, recipe: dict) -> str | None:
+        candidates = [os.path.join(self.image_dir, f"{recipe['id']}{ext}") for ext in self.EXTENSIONS]
+        candidates.append(os.path.join(self.image_dir, os.path.basename(urlsplit(recipe['image']).path)))
+        for path in candidates:
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def fetch(self, recipe: dict) -> bytes:
+        if self.image_dir:
+            path = self._local_path(recipe)
+            if path is None:
+                raise FileNotFoundError(f"no local image for recipe {recipe['id']}")
+            with open(path, "rb") as f:
+                return f.read()
+
+        url = recipe['image']
+        if self.base_url:
+            parts = urlsplit(url)
+            url = self.base_url + parts.path + (f"?{parts.query}" if parts.query else "")
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+
+
+class ImageVectorPipeline:
+    """
+        並行下載、批次推論與批次寫入的圖片向量預計算流程
+
+        參數:
+        image_encoder: CLIP 圖片編碼器 (encoders.py，提供 encode(images))
+        collection: ChromaDB collection
+        fetcher: 圖片下載器 (ImageFetcher)
+        download_workers: 下載執行緒數
+        batch_size: 每次 CLIP 推論與寫入的圖片數
+        queue_size: 已下載但尚未推論的圖片上限
+        checkpoint_path: 記錄已完成 id 的檔案 (只作為進度紀錄，是否完成以 collection 為準)，None 表示不使用
+    """
+
+    def __init__(self, image_encoder, collection, fetcher: ImageFetcher,
+                 download_workers: int = 8, batch_size: int = 32, queue_size: int = 128,
+                 checkpoint_path: str | None = None):
+        self.image_encoder = image_encoder
+        self.collection = collection
+        self.fetcher = fetcher
+        self.download_workers = download_workers
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.checkpoint_path = checkpoint_path
+
+    def _load_checkpoint(self) -> set:
+        if not self.checkpoint_path or not os.path.exists(self.checkpoint_path):
+            return set()
+        with open(self.checkpoint_path, "r", encoding='utf-8') as f:
+            return {line.strip() for line in f if line.strip()}
+
+    def _write_checkpoint(self, ids: List[str]):
+        if not self.checkpoint_path:
+            return
+        with open(self.checkpoint_path, "a", encoding='utf-8') as f:
+            f.write("".join(f"{recipe_id}\n" for recipe_id in ids))
+
+    def _prune_checkpoint(self, existing: set):
+        """移除 checkpoint 中已不在 collection 的 id (collection 被清空、重建或項目被刪除)"""
+        done = self._load_checkpoint()
+        missing = done - existing
+        if not missing:
+            return
+        print(f"圖片向量: checkpoint 中有 {len(missing)} 筆不在 collection 中，將重新計算")
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            f.write("".join(f"{recipe_id}\n" for recipe_id in sorted(done & existing)))
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _existing_ids(self, ids: List[str], chunk_size: int = 1000) -> set:
+        """查詢 collection 中已存在的 id"""
+        existing = set()
+        for begin in range(0, len(ids), chunk_size):
+            result = self.collection.get(ids=ids[begin:begin + chunk_size], include=[])
+            existing.update(result["ids"])
+        return existing
+
+    def sync_metadata(self, recipes: Iterable[dict], chunk_size: int = 1000) -> int:
+        """
+            更新 collection 中 metadata 與食譜不一致的項目 (不重新計算向量)，回傳更新的筆數
+
+            recipes 可以是串流，每次只取出 chunk_size 筆比對。
+        """
+        updated = 0
+        recipes = iter(recipes)
+        while True:
+            chunk = {recipe["id"]: recipe for recipe in itertools.islice(recipes, chunk_size)}
+            if not chunk:
+                break
+            result = self.collection.get(ids=list(chunk), include=["metadatas"])
+            stale = []
+            for recipe_id, current in zip(result["ids"], result["metadatas"]):
+                metadata = image_metadata(chunk[recipe_id])
+                if metadata != current:
+                    stale.append((recipe_id, metadata))
+            if stale:
+                self.collection.update(ids=[recipe_id for recipe_id, _ in stale],
+                                       metadatas=[metadata for _, metadata in stale])
+                updated += len(stale)
+        if updated:
+            print(f"圖片向量: 更新 {updated} 筆 metadata")
+        return updated
+
+    def mark_metadata_synced(self):
+        # hnsw:* 設定建立後不能修改，不放進 modify 的參數中
+        metadata = {key: value for key, value in (self.collection.metadata or {}).items()
+                    if not key.startswith("hnsw:")}
+        metadata[FILTER_METADATA_KEY] = FILTER_METADATA_VERSION
+        self.collection.modify(metadata=metadata)
+
+    def pending(self, recipes: Iterable[dict]) -> List[dict]:
+        """篩選出有圖片且不在 collection 中的食譜"""
+        recipes = [r for r in recipes if r.get("image")]
+        existing = self._existing_ids([r["id"] for r in recipes])
+        if self.checkpoint_path:
+            self._prune_checkpoint(existing)
+        return [r for r in recipes if r["id"] not in existing]
+
+    def _download_worker(self, work: queue.Queue, out: queue.Queue):
+        while True:
+            recipe = work.get()
+            if recipe is _DONE:
+                out.put(_DONE)
+                return
+            try:
+                image = Image.open(io.BytesIO(self.fetcher.fetch(recipe))).convert("RGB")
+                out.put((recipe, image))
+            except Exception as e:
+                print(f"Error processing image for recipe {recipe['id']}: {e}")
+                out.put((recipe, None))
+
+    def _embed_and_write(self, batch: List[tuple]):
+        recipes = [recipe for recipe, _ in batch]
+        images = [image for _, image in batch]
+        features = self.image_encoder.encode(images)
+        self.collection.upsert(
+            ids=[recipe["id"] for recipe in recipes],
+            embeddings=features.tolist(),
+            metadatas=[image_metadata(recipe) for recipe in recipes]
+        )
+        self._write_checkpoint([recipe["id"] for recipe in recipes])
+
+    def run(self, recipes: Iterable[dict], force: bool = False) -> dict:
+        """
+            執行預計算，回傳處理統計 (force 為 True 時不略過已完成的食譜，用於圖片更新)
+
+            force 時下載或推論失敗的食譜會從 collection 移除舊的向量 (舊圖片已不是食譜的圖片)，
+            下次不帶 force 執行時再重新計算。
+        """
+        recipes = [r for r in recipes if r.get("image")]
+        if not force:
+            self.sync_metadata(recipes)
+            if not filter_metadata_synced(self.collection):
+                self.mark_metadata_synced()
+        todo = recipes if force else self.pending(recipes)
+        stats = {'total': len(todo), 'processed': 0, 'failed': 0, 'seconds': 0.0, 'images_per_sec': 0.0}
+        if not todo:
+            print("圖片向量: 沒有需要處理的圖片")
+            return stats
+
+        work = queue.Queue()
+        for recipe in todo:
+            work.put(recipe)
+        workers = min(self.download_workers, len(todo))
+        for _ in range(workers):
+            work.put(_DONE)
+
+        # 有界佇列讓下載速度受推論速度牽制，避免圖片堆積在記憶體中
+        downloaded = queue.Queue(maxsize=self.queue_size)
+        threads = [threading.Thread(target=self._download_worker, args=(work, downloaded), daemon=True)
+                   for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+
+        start = time.perf_counter()
+        batch = []
+        failed_ids = []
+        finished_workers = 0
+        while finished_workers < workers:
+            item = downloaded.get()
+            if item is _DONE:
+                finished_workers += 1
+            elif item[1] is None:
+                failed_ids.append(item[0]["id"])
+            else:
+                batch.append(item)
+
+            if batch and (len(batch) >= self.batch_size or finished_workers == workers):
+                try:
+                    self._embed_and_write(batch)
+                    stats['processed'] += len(batch)
+                except Exception as e:
+                    print(f"Error embedding image batch: {e}")
+                    failed_ids.extend(recipe["id"] for recipe, _ in batch)
+                batch = []
+                elapsed = time.perf_counter() - start
+                print(f"圖片向量: {stats['processed'] + len(failed_ids)}/{stats['total']} "
+                      f"({stats['processed'] / max(elapsed, 1e-9):.1f} 張/秒)")
+
+        for thread in threads:
+            thread.join()
+        stats['failed'] = len(failed_ids)
+        if force and failed_ids:
+            print(f"Warning: {len(failed_ids)} 筆圖片更新失敗，移除舊的圖片向量: {failed_ids[:10]}")
+            try:
+                self.collection.delete(ids=failed_ids)
+            except Exception as e:
+                print(f"Error deleting stale image vectors: {e}")
+        stats['seconds'] = time.perf_counter() - start
+        stats['images_per_sec'] = stats['processed'] / max(stats['seconds'], 1e-9)
+        print(f"圖片向量完成: 成功 {stats['processed']} 張, 失敗 {stats['failed']} 張, "
+              f"{stats['images_per_sec']:.1f} 張/秒")
+        return stats
+
+
+if __name__ == "__main__":
+    from chromadb import PersistentClient
+    import config
+    import encoders
+    from corpus_loader import load_store
+
+    parser = argparse.ArgumentParser(description="預計算食譜圖片向量並寫入 ChromaDB")
+    parser.add_argument("--data", default="./icook_recipe/recipe_data.json")
+    parser.add_argument("--image-dir", default=None, help="從本機目錄讀取圖片")
+    parser.add_argument("--base-url", default=None, help="以此網址取代圖片網址的 host")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--checkpoint", default="./cache/image_vectors.checkpoint")
+    args = parser.parse_args()
+
+    store = load_store(args.data)
+    os.makedirs(os.path.dirname(args.checkpoint) or ".", exist_ok=True)
+    pipeline = ImageVectorPipeline(
+        encoders.load_image_encoder("openai/clip-vit-base-patch32", config.ENCODER_BACKEND, config.ONNX_DIR,
+                                    config.ONNX_INT8, config.ONNX_THREADS),
+        PersistentClient().get_or_create_collection(COLLECTION_NAME),
+        ImageFetcher(image_dir=args.image_dir, base_url=args.base_url, pool_size=args.workers),
+        download_workers=args.workers,
+        batch_size=args.batch_size,
+        checkpoint_path=args.checkpoint,
+    )
+    pipeline.run(store)
@@ -0,0 +1,53 @@
+"""
+    查詢圖片的快速前處理
+
+    使用者上傳的照片常是上千萬像素，完整解碼再交給 CLIPProcessor 縮小的成本遠高於
+    CLIP 推論本身。這裡直接以 JPEG draft 模式解碼到接近 CLIP 輸入的解析度，
+    並處理 EXIF 旋轉與色彩模式。
+"""
+import hashlib
+import io
+from PIL import Image, ImageOps
+
+# CLIP (ViT-B/32) 的輸入解析度，處理器會把短邊縮放到此大小再中心裁切
+CLIP_INPUT_SIZE = 224
+
+
+class ImageTooLargeError(ValueError):
+    """上傳的圖片超過大小上限"""
+
+
+def image_digest(data: bytes) -> str:
+    """圖片內容雜湊，作為查詢嵌入快取的鍵"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def check_upload_size(data: bytes, max_bytes: int):
+    if len(data) > max_bytes:
+        raise ImageTooLargeError(f"image exceeds {max_bytes} bytes")
+
+
+def load_query_image(data: bytes, size: int = CLIP_INPUT_SIZE) -> Image.Image:
+    """解碼上傳的圖片並縮小到短邊為 size 的 RGB 圖片"""
+    image = Image.open(io.BytesIO(data))
+    # JPEG 可在解碼時直接以 1/2、1/4、1/8 比例縮小，只保留短邊不小於 size 的最小尺寸
+    if image.format == "JPEG":
+        image.draft("RGB", (size, size))
+    image = ImageOps.exif_transpose(image)
+
+    if image.mode != "RGB":
+        if image.mode in ("RGBA", "LA", "P"):
+            # 透明背景以白色填滿
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        else:
+            image = image.convert("RGB")
+
+    width, height = image.size
+    scale = size / min(width, height)
+    if scale < 1:
+        image = image.resize((max(size, round(width * scale)), max(size, round(height * scale))),
+                             Image.Resampling.BICUBIC, reducing_gap=2.0)
+    return image
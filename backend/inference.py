@@ -0,0 +1,113 @@
+"""
+    將模型推論移出 event loop，並把同時到達的查詢合併成一次批次推論
+"""
+import asyncio
+import time
+from collections import Counter
+from concurrent.futures import Executor
+from typing import Any, Callable, List
+
+
+class MicroBatcher:
+    """
+        動態 micro-batching 排程器
+
+        第一筆查詢到達後最多等待 max_wait_ms，期間到達的查詢 (最多 max_batch_size 筆)
+        會合併成一次 encode 呼叫，並在專用的 executor 中執行。
+
+        參數:
+        encode: 將一批輸入轉為嵌入矩陣的函式 (第 i 列對應第 i 筆輸入)
+        executor: 執行推論的 executor
+        max_batch_size: 單批最大筆數
+        max_wait_ms: 湊批的最長等待時間 (毫秒)
+        concurrency: 同時進行中的批次數，通常與 executor 的執行緒數相同
+    """
+
+    def __init__(self, encode: Callable[[List[Any]], Any], executor: Executor,
+                 max_batch_size: int = 32, max_wait_ms: float = 5.0, concurrency: int = 1):
+        self.encode = encode
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.concurrency = concurrency
+        self._queue: asyncio.Queue | None = None
+        self._workers: List[asyncio.Task] = []
+
+        # 統計
+        self.submitted = 0
+        self.batches = 0
+        self.in_flight = 0
+        self.batch_sizes = Counter()
+        self.encode_seconds = 0.0
+
+    def _ensure_workers(self):
+        if self._workers and not all(worker.done() for worker in self._workers):
+            return
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._workers = [loop.create_task(self._run()) for _ in range(self.concurrency)]
+
+    async def submit(self, item: Any):
+        """送出一筆查詢，等待並回傳其嵌入"""
+        self._ensure_workers()
+        future = asyncio.get_running_loop().create_future()
+        self.submitted += 1
+        await self._queue.put((item, future))
+        return await future
+
+    async def _collect(self) -> list:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # 已在佇列中的查詢不需等待
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            items = [item for item, _ in batch]
+            self.batches += 1
+            self.batch_sizes[len(batch)] += 1
+            self.in_flight += len(batch)
+            start = time.perf_counter()
+            try:
+                vectors = await loop.run_in_executor(self.executor, self.encode, items)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finally:
+                self.in_flight -= len(batch)
+                self.encode_seconds += time.perf_counter() - start
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+
+    def stats(self) -> dict:
+        """佇列深度與批次大小統計"""
+        return {
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'in_flight': self.in_flight,
+            'submitted': self.submitted,
+            'batches': self.batches,
+            'avg_batch_size': (sum(size * n for size, n in self.batch_sizes.items()) / self.batches
+                               if self.batches else 0.0),
+            'max_batch_size_seen': max(self.batch_sizes, default=0),
+            'batch_size_histogram': dict(sorted(self.batch_sizes.items())),
+            'avg_encode_ms': self.encode_seconds / self.batches * 1000 if self.batches else 0.0,
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+        }
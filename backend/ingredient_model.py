@@ -0,0 +1,367 @@
+"""
+    食材 Word2Vec 模型的建置與載入
+
+    訓練好的模型、食材倒排索引、每個食譜的食材向量以及每個食材詞的相似詞表會存成一份建置產物，
+    啟動時以 mmap 方式載入，多個 worker 可以共用同一份記憶體分頁。
+    詞彙只在重新訓練時改變，相似詞在建置時以批次矩陣乘法一次算好，查詢相似食材時只需查表。
+    語料內容改變時 (以 fingerprint 判斷) 產物會自動失效並重新建置。
+
+    重新建置:
+    > python ingredient_model.py --data ./icook_recipe/recipe_data.json --out ./cache/ingredient_model
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from collections import defaultdict
+from typing import Callable, List
+import numpy as np
+from gensim.models import KeyedVectors, Word2Vec
+from cache_files import file_lock
+from recipe_store import RecipeFields
+from tokenization import INGREDIENT_UNITS, IngredientTokenizer
+
+# 產物格式或訓練參數變動時調整版本，使舊的產物失效
+ARTIFACT_VERSION = 3
+
+# 固定種子並使用單一 worker，確保每次重新建置的結果都相同
+WORD2VEC_PARAMS = {
+    'vector_size': 100,
+    'window': 5,
+    'min_count': 1,
+    'workers': 1,
+    'seed': 42,
+}
+
+# 每個食材詞預先計算的相似詞數，以及預先取出的食譜數 (查詢相似食材時每個食材列出的食譜)
+NEIGHBOR_COUNT = 50
+RECIPES_PER_INGREDIENT = 5
+
+
+def corpus_fingerprint(recipes: List[RecipeFields], tokenizer_signature: str = '') -> str:
+    """以食譜 id、食材名稱與斷詞規則計算語料指紋"""
+    digest = hashlib.sha1()
+    digest.update(json.dumps([ARTIFACT_VERSION, WORD2VEC_PARAMS, NEIGHBOR_COUNT, RECIPES_PER_INGREDIENT,
+                              tokenizer_signature]).encode('utf-8'))
+    for recipe in recipes:
+        names = list(recipe.ingredient_names)
+        digest.update(json.dumps([recipe.id, names], ensure_ascii=False).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class IngredientArtifact:
+    """
+        食材模型建置產物
+
+        recipe_vectors 為已正規化 (L2) 的食譜食材向量矩陣，列順序與 recipe_ids 相同。
+        食材倒排索引以 CSR 形式存放: 每個食材詞對應 index_ids[indptr[i]:indptr[i + 1]]，
+        內容為全域食材編號 (第 r 個食譜的第 p 個食材編號為 ingredient_offsets[r] + p)。
+        first_ids 的第 i 列為 index_tokens[i] 前 RECIPES_PER_INGREDIENT 個不同食譜的食材編號 (不足時補 -1)，
+        食譜與份量都由食材編號取得，不必另存每個食材的 {recipe_id, amount}。
+        neighbor_ids / neighbor_scores 的第 i 列為 wv 中第 i 個詞最相似的詞 (wv 的詞編號) 與 cosine，由高到低排列。
+    """
+
+    def __init__(self,
+                 wv: KeyedVectors,
+                 recipe_ids: List[str],
+                 recipe_vectors: np.ndarray,
+                 ingredient_offsets: np.ndarray,
+                 index_tokens: List[str],
+                 index_indptr: np.ndarray,
+                 index_ids: np.ndarray,
+                 first_ids: np.ndarray,
+                 neighbor_ids: np.ndarray,
+                 neighbor_scores: np.ndarray,
+                 fingerprint: str):
+        self.wv = wv
+        self.recipe_ids = recipe_ids
+        self.recipe_vectors = recipe_vectors
+        self.ingredient_offsets = ingredient_offsets
+        self.index_tokens = index_tokens
+        self.index_indptr = index_indptr
+        self.index_ids = index_ids
+        self.first_ids = first_ids
+        self.neighbor_ids = neighbor_ids
+        self.neighbor_scores = neighbor_scores
+        self.fingerprint = fingerprint
+        self.token_to_slot = {token: i for i, token in enumerate(index_tokens)}
+
+    def ingredient_ids(self, token: str) -> np.ndarray:
+        """取得含有該食材詞的全域食材編號"""
+        slot = self.token_to_slot.get(token)
+        if slot is None:
+            return self.index_ids[:0]
+        return self.index_ids[self.index_indptr[slot]:self.index_indptr[slot + 1]]
+
+    def first_ingredient_ids(self, token: str) -> np.ndarray:
+        """含有該食材詞的前 RECIPES_PER_INGREDIENT 個不同食譜的食材編號"""
+        slot = self.token_to_slot.get(token)
+        if slot is None:
+            return self.index_ids[:0]
+        ids = self.first_ids[slot]
+        return ids[ids >= 0]
+
+    def neighbors(self, token: str, topn: int) -> List[tuple] | None:
+        """最相似的 topn 個食材詞 [(詞, cosine)] (不含自己)，詞不在詞彙中時回傳 None"""
+        index = self.wv.key_to_index.get(token)
+        if index is None:
+            return None
+        width = self.neighbor_ids.shape[1]
+        if topn > width and width < len(self.wv) - 1:
+            # 超過預先計算的數量時才掃描整個詞彙
+            return self.wv.most_similar(token, topn=topn)
+        words = self.wv.index_to_key
+        return [(words[i], float(score))
+                for i, score in zip(self.neighbor_ids[index, :topn].tolist(), self.neighbor_scores[index, :topn])]
+
+    def save(self, out_dir: str):
+        """寫入產物目錄 (先寫入唯一的暫存目錄再替換，多個行程時需持有 file_lock(out_dir))"""
+        out_dir = out_dir.rstrip('/\\')
+        parent = os.path.dirname(os.path.abspath(out_dir))
+        name = os.path.basename(out_dir)
+        os.makedirs(parent, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=name + ".", suffix=".tmp", dir=parent)
+        try:
+            self._write(tmp_dir)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        if os.path.exists(out_dir):
+            # 舊的產物先移到唯一的名稱再刪除，out_dir 不會出現新舊檔案混在一起的狀態
+            old_dir = tempfile.mkdtemp(prefix=name + ".", suffix=".old", dir=parent)
+            os.rmdir(old_dir)
+            os.rename(out_dir, old_dir)
+            os.rename(tmp_dir, out_dir)
+            shutil.rmtree(old_dir, ignore_errors=True)
+        else:
+            os.rename(tmp_dir, out_dir)
+
+    def _write(self, tmp_dir: str):
+        self.wv.save(os.path.join(tmp_dir, "ingredient.kv"))
+        np.save(os.path.join(tmp_dir, "recipe_vectors.npy"), self.recipe_vectors)
+        np.save(os.path.join(tmp_dir, "ingredient_offsets.npy"), self.ingredient_offsets)
+        np.save(os.path.join(tmp_dir, "index_indptr.npy"), self.index_indptr)
+        np.save(os.path.join(tmp_dir, "index_ids.npy"), self.index_ids)
+        np.save(os.path.join(tmp_dir, "first_ids.npy"), self.first_ids)
+        np.save(os.path.join(tmp_dir, "neighbor_ids.npy"), self.neighbor_ids)
+        np.save(os.path.join(tmp_dir, "neighbor_scores.npy"), self.neighbor_scores)
+        with open(os.path.join(tmp_dir, "recipe_ids.json"), "w", encoding='utf-8') as f:
+            json.dump(self.recipe_ids, f, ensure_ascii=False)
+        with open(os.path.join(tmp_dir, "index_tokens.json"), "w", encoding='utf-8') as f:
+            json.dump(self.index_tokens, f, ensure_ascii=False)
+        # manifest 最後寫入，作為產物完整的標記
+        with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding='utf-8') as f:
+            json.dump({'version': ARTIFACT_VERSION, 'fingerprint': self.fingerprint}, f)
+
+    @classmethod
+    def load(cls, out_dir: str, fingerprint: str | None = None):
+        """以 mmap 載入產物，不存在或指紋不符時回傳 None"""
+        manifest_path = os.path.join(out_dir, "manifest.json")
+        if not os.path.exists(manifest_path):
+            return None
+        try:
+            with open(manifest_path, "r", encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('version') != ARTIFACT_VERSION:
+                return None
+            if fingerprint is not None and manifest.get('fingerprint') != fingerprint:
+                return None
+            wv = KeyedVectors.load(os.path.join(out_dir, "ingredient.kv"), mmap='r')
+            arrays = {
+                name: np.load(os.path.join(out_dir, f"{name}.npy"), mmap_mode='r')
+                for name in ("recipe_vectors", "ingredient_offsets", "index_indptr", "index_ids",
+                             "first_ids", "neighbor_ids", "neighbor_scores")
+            }
+            with open(os.path.join(out_dir, "recipe_ids.json"), "r", encoding='utf-8') as f:
+                recipe_ids = json.load(f)
+            with open(os.path.join(out_dir, "index_tokens.json"), "r", encoding='utf-8') as f:
+                index_tokens = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error loading ingredient artifact: {e}")
+            return None
+        return cls(wv, recipe_ids,
+                   index_tokens=index_tokens, fingerprint=manifest['fingerprint'], **arrays)
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """將每一列正規化為單位長度 (零向量維持為零)"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def nearest_neighbors(vectors: np.ndarray, count: int, batch_size: int = 512):
+    """
+        以批次矩陣乘法計算每個向量 cosine 最相似的 count 個向量 (不含自己)
+
+        回傳 (編號, cosine) 兩個 (列數, count) 的矩陣，每一列由高到低排列；count 超過列數 - 1 時以列數 - 1 為準。
+    """
+    vectors = normalize_rows(vectors)
+    n_rows = len(vectors)
+    count = max(0, min(count, n_rows - 1))
+    ids = np.empty((n_rows, count), dtype=np.int32)
+    scores = np.empty((n_rows, count), dtype=np.float32)
+    if count == 0:
+        return ids, scores
+    for begin in range(0, n_rows, batch_size):
+        similarity = vectors[begin:begin + batch_size] @ vectors.T
+        batch = np.arange(len(similarity))
+        similarity[batch, begin + batch] = -np.inf
+        top = np.argpartition(-similarity, count - 1, axis=1)[:, :count]
+        top_scores = np.take_along_axis(similarity, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        ids[begin:begin + len(batch)] = np.take_along_axis(top, order, axis=1)
+        scores[begin:begin + len(batch)] = np.take_along_axis(top_scores, order, axis=1)
+    return ids, scores
+
+
+def recipe_vector(token_lists: List[List[str]], lookup: Callable[[str], np.ndarray | None]) -> np.ndarray | None:
+    """
+        計算食譜的食材向量 (未正規化): 每個食材取詞向量平均，再對食材取平均
+
+        lookup 回傳食材詞的向量，沒有向量時回傳 None；所有食材都沒有向量時回傳 None。
+    """
+    vectors = []
+    for tokens in token_lists:
+        token_vectors = [vector for vector in map(lookup, tokens) if vector is not None]
+        if token_vectors:
+            vectors.append(np.mean(token_vectors, axis=0))
+    if not vectors:
+        return None
+    return np.mean(vectors, axis=0)
+
+
+def oov_vector(wv: KeyedVectors, token: str) -> np.ndarray | None:
+    """
+        為 Word2Vec 詞彙外的新食材詞估計向量，直到下次重新訓練為止
+
+        取詞彙中包含該詞或被該詞包含的詞 (例如 "櫻花蝦" -> "蝦") 的向量平均，
+        都沒有時改用組成該詞的單字，仍找不到時回傳 None。
+    """
+    related = [word for word in wv.index_to_key if len(word) > 1 and (token in word or word in token)]
+    if not related:
+        related = [char for char in dict.fromkeys(token) if char in wv]
+    if not related:
+        return None
+    return np.mean([wv[word] for word in related], axis=0)
+
+
+def build_ingredient_artifact(recipes: List[RecipeFields],
+                              tokenizer: IngredientTokenizer,
+                              workers: int = 1) -> IngredientArtifact:
+    """訓練 Word2Vec、預計算每個食譜的食材向量與每個食材詞的相似詞，並建立食材倒排索引"""
+    # 每個不同的食材名稱只斷詞一次，訓練語句與食譜向量共用同一份 token table
+    table = tokenizer.token_table(
+        (name for recipe in recipes for name in recipe.ingredient_names), workers)
+    all_ingredients = []
+    recipe_tokens = []
+    token_postings = defaultdict(list)
+    first_postings = defaultdict(list)
+    ingredient_offsets = [0]
+
+    for recipe in recipes:
+        offset = ingredient_offsets[-1]
+        ingredient_offsets.append(offset + len(recipe.ingredient_names))
+        token_lists = []
+        for position, name in enumerate(recipe.ingredient_names):
+            if name:
+                tokens = table[name]
+                if tokens:
+                    token_lists.append(tokens)
+                    for token in set(tokens):
+                        token_postings[token].append(offset + position)
+                        # 每個食材詞的前幾個食譜 (同一食譜只取第一個含有該詞的食材)
+                        first = first_postings[token]
+                        if len(first) < RECIPES_PER_INGREDIENT and (not first or first[-1] < offset):
+                            first.append(offset + position)
+        if not recipe.ingredient_names:
+            continue
+        recipe_tokens.append((recipe.id, token_lists))
+        sentence = [token for tokens in token_lists for token in tokens]
+        if sentence:
+            all_ingredients.append(sentence)
+
+    # 訓練Word2Vec模型
+    model = Word2Vec(sentences=all_ingredients, **WORD2VEC_PARAMS)
+    wv = model.wv
+
+    # 預計算所有食譜的食材向量 (每個食材取詞向量平均，再對食材取平均)
+    recipe_ids = []
+    recipe_vectors = []
+    for recipe_id, token_lists in recipe_tokens:
+        vector = recipe_vector(token_lists, lambda token: wv[token] if token in wv else None)
+        if vector is not None:
+            recipe_ids.append(recipe_id)
+            recipe_vectors.append(vector)
+
+    recipe_vectors = np.asarray(recipe_vectors, dtype=np.float32).reshape(len(recipe_ids), wv.vector_size)
+
+    # 倒排索引轉為 CSR 陣列
+    index_tokens = sorted(token_postings)
+    index_indptr = np.zeros(len(index_tokens) + 1, dtype=np.int64)
+    index_indptr[1:] = np.cumsum([len(token_postings[t]) for t in index_tokens])
+    index_ids = np.fromiter(
+        (gid for t in index_tokens for gid in token_postings[t]), dtype=np.int64, count=int(index_indptr[-1]))
+    first_ids = np.full((len(index_tokens), RECIPES_PER_INGREDIENT), -1, dtype=np.int64)
+    for slot, token in enumerate(index_tokens):
+        first_ids[slot, :len(first_postings[token])] = first_postings[token]
+
+    # 所有食材詞的相似詞 (詞彙只在重新訓練時改變)
+    neighbor_ids, neighbor_scores = nearest_neighbors(wv.vectors, NEIGHBOR_COUNT)
+
+    return IngredientArtifact(wv, recipe_ids, normalize_rows(recipe_vectors),
+                              np.asarray(ingredient_offsets, dtype=np.int64),
+                              index_tokens, index_indptr, index_ids, first_ids, neighbor_ids, neighbor_scores,
+                              corpus_fingerprint(recipes, tokenizer.signature()))
+
+
+def load_or_build(recipes: List[RecipeFields],
+                  tokenizer: IngredientTokenizer,
+                  out_dir: str,
+                  workers: int = 1) -> IngredientArtifact:
+    """
+        載入與目前語料相符的產物，必要時重新建置並以 mmap 重新載入
+
+        建置時持有跨行程的檔案鎖，多個 worker 同時冷啟動時只有一個會訓練，其他等待後直接載入。
+    """
+    fingerprint = corpus_fingerprint(recipes, tokenizer.signature())
+    artifact = IngredientArtifact.load(out_dir, fingerprint)
+    if artifact is not None:
+        return artifact
+
+    out_dir = out_dir.rstrip('/\\')
+    os.makedirs(os.path.dirname(os.path.abspath(out_dir)), exist_ok=True)
+    with file_lock(out_dir):
+        # 等待鎖期間其他 worker 可能已建置完成
+        artifact = IngredientArtifact.load(out_dir, fingerprint)
+        if artifact is not None:
+            return artifact
+        print("食材模型產物不存在或已過期，重新建置...")
+        start = time.perf_counter()
+        build_ingredient_artifact(recipes, tokenizer, workers).save(out_dir)
+        print(f"食材模型建置完成，耗時 {time.perf_counter() - start:.1f} 秒")
+        return IngredientArtifact.load(out_dir, fingerprint)
+
+
+if __name__ == "__main__":
+    from corpus_loader import load_store
+
+    parser = argparse.ArgumentParser(description="重新建置食材 Word2Vec 產物")
+    parser.add_argument("--data", default="./icook_recipe/recipe_data.json")
+    parser.add_argument("--out", default="./cache/ingredient_model")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="語料斷詞的行程數")
+    args = parser.parse_args()
+
+    store = load_store(args.data)
+    start = time.perf_counter()
+    artifact = build_ingredient_artifact([store.fields(row) for row in store.live_rows()], IngredientTokenizer(),
+                                         args.workers)
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with file_lock(args.out.rstrip('/\\')):
+        artifact.save(args.out)
+    print(f"已建置 {len(artifact.wv)} 個食材詞、{len(artifact.recipe_ids)} 個食譜向量，"
+          f"耗時 {time.perf_counter() - start:.1f} 秒 -> {args.out}")
@@ -1,10 +1,41 @@
-from fastapi import FastAPI, File, UploadFile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import List, Literal
+import orjson
+from fastapi import Body, Depends, FastAPI, File, HTTPException, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 from search_engine import RecipeSearchEngine
-from PIL import Image
+from inference import MicroBatcher
+from modalities import ModalityUnavailableError
+from recipe_filter import InvalidFilterError, RecipeFilter
+from remote_inference import InferenceClient
+from shared_corpus import ReadOnlyCorpusError
+from image_preprocess import ImageTooLargeError, check_upload_size, image_digest, load_query_image
+from projection import InvalidCursorError, decode_cursor, paginate, paginate_groups, parse_fields
+from PIL import UnidentifiedImageError
+import config
+import metrics
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 模型在背景載入，服務可以立即接受連線 (/readyz 回報各模態是否已就緒)
+    if config.WARMUP:
+        search_engine.warmup()
+    yield
+
+
+class TimedJSONResponse(JSONResponse):
+    """以 orjson 序列化並量測序列化時間的 JSONResponse"""
+
+    def render(self, content) -> bytes:
+        with metrics.stage('serialization'):
+            return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
 
 # FastAPI 應用設置
-app = FastAPI(title="食譜搜尋引擎 API")
+app = FastAPI(title="食譜搜尋引擎 API", lifespan=lifespan, default_response_class=TimedJSONResponse)
 
 # CORS 設置
 origins = [
@@ -17,10 +48,115 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
-# 初始化搜尋引擎
-search_engine = RecipeSearchEngine("./icook_recipe/recipe_data.json")
+# 初始化搜尋引擎 (只載入食譜資料，模型延遲載入)
+# 設定 RECIPE_SHARED_DIR 時附加 loader 發佈的共用資料，設定 RECIPE_INFERENCE_SOCKET 時模型推論交給推論行程
+inference_client = InferenceClient(config.INFERENCE_SOCKET) if config.INFERENCE_SOCKET else None
+search_engine = RecipeSearchEngine("./icook_recipe/recipe_data.json",
+                                   shared_dir=config.SHARED_DIR or None,
+                                   inference_client=inference_client)
+
+# 模型推論在專用的執行緒中進行，並將同時到達的查詢合併為批次，避免阻塞 event loop
+inference_executor = ThreadPoolExecutor(max_workers=config.INFERENCE_WORKERS, thread_name_prefix="inference")
+text_batcher = MicroBatcher(search_engine.encode_texts, inference_executor,
+                            config.TEXT_BATCH_MAX_SIZE, config.TEXT_BATCH_MAX_WAIT_MS,
+                            concurrency=config.INFERENCE_WORKERS)
+image_batcher = MicroBatcher(search_engine.encode_images, inference_executor,
+                             config.IMAGE_BATCH_MAX_SIZE, config.IMAGE_BATCH_MAX_WAIT_MS,
+                             concurrency=config.INFERENCE_WORKERS)
+
+
+def decode_upload(data: bytes):
+    with metrics.stage('image.decode'):
+        return load_query_image(data)
+
+
+async def embed_upload(file: UploadFile):
+    """
+        讀取上傳圖片並取得其 CLIP 特徵
+
+        以內容雜湊快取特徵，重複上傳或重試時不需再解碼與推論。
+    """
+    data = await file.read(config.MAX_UPLOAD_BYTES + 1)
+    try:
+        check_upload_size(data, config.MAX_UPLOAD_BYTES)
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+    digest = image_digest(data)
+    image_embedding = search_engine.image_query_embedding(digest)
+    if image_embedding is None:
+        try:
+            image = await run_in_threadpool(decode_upload, data)
+        except (UnidentifiedImageError, OSError) as e:
+            raise HTTPException(status_code=400, detail=f"invalid image: {e}")
+        image_embedding = await image_batcher.submit(image)
+        search_engine.cache_image_embedding(digest, image_embedding)
+    return image_embedding
+
+
+def result_window(top_k: int, offset: int, cursor: str | None) -> int:
+    """
+        解析分頁參數並回傳起始位置 (cursor 優先於 offset)
+
+        搜尋時需取 offset + top_k + 1 筆結果，多的一筆用來判斷是否有下一頁。
+    """
+    if cursor:
+        try:
+            offset = decode_cursor(cursor)
+        except InvalidCursorError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    if top_k < 1 or offset < 0:
+        raise HTTPException(status_code=400, detail="top_k must be >= 1 and offset must be >= 0")
+    if offset + top_k > config.MAX_RESULT_WINDOW:
+        raise HTTPException(status_code=400, detail=f"offset + top_k must not exceed {config.MAX_RESULT_WINDOW}")
+    return offset
+
+
+def search_filters(max_duration: float | None = None, min_duration: float | None = None,
+                   servings: float | None = None, min_servings: float | None = None,
+                   max_servings: float | None = None, hashtags: str | None = None,
+                   with_ingredients: str | None = None) -> RecipeFilter | None:
+    """
+        各搜尋 API 共用的篩選參數
+
+        料理時間以分鐘為單位；servings 為指定人數 (同時設定 min / max_servings)；
+        hashtags 與 with_ingredients 以逗號分隔，需全部符合。
+    """
+    if servings is not None:
+        min_servings = max_servings = servings
+    try:
+        filters = RecipeFilter(max_duration, min_duration, min_servings, max_servings,
+                               (hashtags or "").split(","), (with_ingredients or "").split(","))
+    except InvalidFilterError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return filters or None
+
+
+def search_response(results: List[dict], offset: int, top_k: int) -> TimedJSONResponse:
+    """回傳一頁搜尋結果 (欄位已由搜尋引擎依 fields 參數取出)"""
+    return page_response(*paginate(results, offset, top_k))
+
+
+def page_response(page: List[dict], next_cursor: str | None) -> TimedJSONResponse:
+    """
+        內容仍為陣列 (與舊版相容)，下一頁的 cursor 放在 X-Next-Cursor 標頭。
+        直接回傳 Response 可略過 FastAPI 的 jsonable_encoder。
+    """
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else None
+    return TimedJSONResponse(page, headers=headers)
+
+
+@app.exception_handler(ModalityUnavailableError)
+async def modality_unavailable(request: Request, exc: ModalityUnavailableError):
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
+
+
+@app.exception_handler(ReadOnlyCorpusError)
+async def read_only_corpus(request: Request, exc: ReadOnlyCorpusError):
+    return JSONResponse(status_code=409, content={"detail": str(exc)})
 
 
 @app.get("/")
@@ -32,48 +168,186 @@ async def root():
             "/api/search": "文字搜尋",
             "/api/ingredient-search": "食材搜尋",
             "/api/similar-ingredients/{ingredient}": "相似食材查詢",
+            "/api/suggest": "搜尋框自動完成 (食譜名稱、標籤、食材)",
             "/api/image-search": "圖片搜尋",
-            "/api/recipe/{recipe_id}": "食譜詳情"
+            "/api/multimodal-search": "圖片 + 文字混合搜尋",
+            "/api/recipe/{recipe_id}": "食譜詳情 (GET)、更新 (PUT)、刪除 (DELETE)",
+            "/api/recipe": "新增食譜 (POST)",
+            "/api/admin/rebuild": "重新建置索引並寫回食譜資料 (POST)",
+            "/api/inference-stats": "推論佇列與批次統計",
+            "/api/cache-stats": "快取命中統計",
+            "/metrics": "Prometheus 延遲指標",
+            "/healthz": "存活檢查",
+            "/readyz": "各模態就緒狀態"
         }
     }
 
 
 
 @app.get("/api/search")
-async def text_search(query: str, top_k: int = 10):
+async def text_search(query: str, top_k: int = 10, offset: int = 0, cursor: str | None = None,
+                      fields: str | None = None, filters: RecipeFilter | None = Depends(search_filters)):
     """文字搜尋 API"""
-    return search_engine.text_search(query, top_k)
+    offset = result_window(top_k, offset, cursor)
+    if not query:
+        return search_response([], offset, top_k)
+    fetch_k = offset + top_k + 1
+    selected = parse_fields(fields)
+    # 熱門查詢直接由快取回應，不需經過模型
+    results = search_engine.cached_text_search(query, fetch_k, filters, selected)
+    if results is None:
+        query_embedding = search_engine.text_query_embedding(query)
+        if query_embedding is None:
+            query_embedding = await text_batcher.submit(query)
+        results = await run_in_threadpool(search_engine.text_search, query, fetch_k, query_embedding, filters,
+                                          selected)
+    return search_response(results, offset, top_k)
 
 
 @app.get("/api/ingredient-search")
-async def ingredient_search(ingredients: str, top_k: int = 10):
+async def ingredient_search(ingredients: str, top_k: int = 10, offset: int = 0, cursor: str | None = None,
+                            fields: str | None = None, filters: RecipeFilter | None = Depends(search_filters)):
     """食材搜尋 API"""
+    offset = result_window(top_k, offset, cursor)
     ingredient_list = ingredients.split(',')
-    return search_engine.ingredient_based_search(ingredient_list, top_k)
+    results = await run_in_threadpool(search_engine.ingredient_based_search, ingredient_list, offset + top_k + 1,
+                                      filters, parse_fields(fields))
+    return search_response(results, offset, top_k)
 
 
 @app.get("/api/similar-ingredients/{ingredient}")
-async def get_similar_ingredients(ingredient: str, top_k: int = 5):
-    """查詢相似食材 API"""
-    return search_engine.get_similar_ingredients(ingredient, top_k)
+async def get_similar_ingredients(ingredient: str, top_k: int = 5, offset: int = 0, cursor: str | None = None,
+                                  filters: RecipeFilter | None = Depends(search_filters)):
+    """
+        查詢相似食材 API (篩選條件套用在每個食材列出的食譜)
+
+        查詢中的每個詞各取 top_k 個相似食材，分頁也是每個詞各自往後取。
+    """
+    offset = result_window(top_k, offset, cursor)
+    groups = await run_in_threadpool(search_engine.similar_ingredient_groups, ingredient, offset + top_k + 1,
+                                     filters)
+    return page_response(*paginate_groups(groups, offset, top_k))
+
+
+@app.get("/api/suggest")
+async def suggest(q: str = "", limit: int = 10, type: Literal["recipe", "ingredient"] | None = None):
+    """搜尋框自動完成 API (前綴索引查詢，不經過模型)"""
+    limit = max(1, min(limit, config.SUGGEST_MAX_LIMIT))
+    if not q.strip():
+        return {"suggestions": []}
+    # 索引建立後查詢不到 1 毫秒，直接在 event loop 中執行；第一次查詢時才建立索引則交給執行緒
+    if search_engine.suggest_ready():
+        suggestions = search_engine.suggest(q, limit, type)
+    else:
+        suggestions = await run_in_threadpool(search_engine.suggest, q, limit, type)
+    return {"suggestions": suggestions}
 
 
 @app.post("/api/image-search")
-async def image_search(file: UploadFile = File(...), top_k: int = 10):
+async def image_search(file: UploadFile = File(...), top_k: int = 10, offset: int = 0, cursor: str | None = None,
+                       fields: str | None = None, filters: RecipeFilter | None = Depends(search_filters)):
     """圖片搜尋 API"""
-    image = Image.open(file.file)
-    return search_engine.image_search(image, top_k)
+    offset = result_window(top_k, offset, cursor)
+    image_embedding = await embed_upload(file)
+    results = await run_in_threadpool(search_engine.image_search, None, offset + top_k + 1, image_embedding,
+                                      filters, parse_fields(fields))
+    return search_response(results, offset, top_k)
 
 @app.post("/api/multimodal-search")
-async def multimodal_search(file: UploadFile = File(...), top_k: int = 10, text: str | None = None):
-    image = Image.open(file.file)
-    return search_engine.multimodal_search(image, text, top_k)
+async def multimodal_search(file: UploadFile = File(...), top_k: int = 10, text: str | None = None,
+                            image_weight: float = 0.5, text_weight: float = 0.5,
+                            fusion: Literal["weighted", "rrf"] = "weighted",
+                            offset: int = 0, cursor: str | None = None, fields: str | None = None,
+                            filters: RecipeFilter | None = Depends(search_filters)):
+    """圖片 + 文字混合搜尋 API"""
+    offset = result_window(top_k, offset, cursor)
+    image_embedding = await embed_upload(file)
+    text_embedding = None
+    if text:
+        text_embedding = search_engine.text_query_embedding(text)
+        if text_embedding is None:
+            text_embedding = await text_batcher.submit(text)
+    results = await run_in_threadpool(
+        search_engine.multimodal_search, None, text, offset + top_k + 1, image_weight, text_weight, fusion,
+        image_embedding=image_embedding, text_embedding=text_embedding, filters=filters,
+        fields=parse_fields(fields))
+    return search_response(results, offset, top_k)
 
 
 @app.get("/api/recipe/{recipe_id}")
 async def get_recipe(recipe_id: str):
     """獲取特定食譜詳情"""
-    for recipe in search_engine.data:
-        if recipe['id'] == recipe_id:
-            return recipe
-    return None
+    return search_engine.get_recipe(recipe_id)
+
+
+async def upsert_recipe(recipe: dict) -> dict:
+    try:
+        return (await run_in_threadpool(search_engine.upsert_recipes, [recipe]))[0]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/api/recipe", status_code=201)
+async def add_recipe(recipe: dict = Body(...)):
+    """新增食譜 (立即可被搜尋)"""
+    if search_engine.get_recipe(recipe.get('id')) is not None:
+        raise HTTPException(status_code=409, detail=f"recipe {recipe['id']} already exists")
+    return await upsert_recipe(recipe)
+
+
+@app.put("/api/recipe/{recipe_id}")
+async def update_recipe(recipe_id: str, recipe: dict = Body(...)):
+    """以新的內容取代食譜"""
+    if search_engine.get_recipe(recipe_id) is None:
+        raise HTTPException(status_code=404, detail=f"recipe {recipe_id} not found")
+    return await upsert_recipe({**recipe, 'id': recipe_id})
+
+
+@app.delete("/api/recipe/{recipe_id}")
+async def delete_recipe(recipe_id: str):
+    """刪除食譜"""
+    deleted = await run_in_threadpool(search_engine.delete_recipes, [recipe_id])
+    if not deleted:
+        raise HTTPException(status_code=404, detail=f"recipe {recipe_id} not found")
+    return {"deleted": recipe_id}
+
+
+@app.post("/api/admin/rebuild")
+async def rebuild_indexes():
+    """重新訓練食材模型、重建索引並將更新寫回食譜資料檔 (建置期間搜尋照常進行)"""
+    return await run_in_threadpool(search_engine.rebuild)
+
+
+
+@app.get("/api/inference-stats")
+async def inference_stats():
+    """推論佇列深度與批次大小統計"""
+    return {
+        "text": text_batcher.stats(),
+        "image": image_batcher.stats()
+    }
+
+
+@app.get("/api/cache-stats")
+async def cache_stats():
+    """搜尋結果與查詢嵌入快取的命中統計"""
+    return search_engine.cache_stats()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """各搜尋階段與啟動階段的延遲 histogram (Prometheus text format)"""
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/healthz")
+async def healthz():
+    """存活檢查"""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    """所有啟用的模態都載入完成時回傳 200，否則回傳 503"""
+    status = search_engine.modality_status()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
@@ -0,0 +1,120 @@
+"""
+    搜尋各階段的延遲量測
+
+    以 Prometheus histogram 匯出 (/metrics)，並可選擇同時產生 OpenTelemetry span。
+    量測關閉時 stage() 回傳共用的 no-op context manager，額外成本只有一次屬性檢查。
+
+    > with metrics.stage("text.encode"):
+    >     ...
+"""
+import bisect
+import threading
+import time
+from contextlib import nullcontext
+import config
+
+# 查詢階段 (毫秒等級) 與啟動階段 (秒到分鐘等級) 使用不同的 bucket
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+STARTUP_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+_NOOP = nullcontext()
+
+
+class Histogram:
+    """以 label 區分的 Prometheus histogram"""
+
+    def __init__(self, name: str, help: str, label: str, buckets: tuple):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, seconds: float):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * len(self.buckets), 0.0, 0]
+            # 只累加第一個符合的 bucket，輸出時再轉為累積數
+            index = bisect.bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = {value: (list(counts), total, count) for value, (counts, total, count) in self._series.items()}
+        for value, (counts, total, count) in sorted(snapshot.items()):
+            label = f'{self.label}="{value}"'
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+            lines.append(f'{self.name}_sum{{{label}}} {total}')
+            lines.append(f'{self.name}_count{{{label}}} {count}')
+        return lines
+
+
+STAGE_SECONDS = Histogram("recipe_search_stage_seconds", "Latency of each search stage",
+                          "stage", STAGE_BUCKETS)
+STARTUP_SECONDS = Histogram("recipe_startup_phase_seconds", "Duration of each startup phase",
+                            "phase", STARTUP_BUCKETS)
+
+
+def _load_tracer():
+    if not config.OTEL_ENABLED:
+        return None
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        print("opentelemetry is not installed, tracing disabled")
+        return None
+    return trace.get_tracer("recipe-search")
+
+
+_tracer = _load_tracer()
+
+
+class _Timer:
+    __slots__ = ('histogram', 'label', 'start', 'span')
+
+    def __init__(self, histogram: Histogram, label: str):
+        self.histogram = histogram
+        self.label = label
+        self.span = None
+
+    def __enter__(self):
+        if _tracer is not None:
+            self.span = _tracer.start_as_current_span(self.label)
+            self.span.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(self.label, time.perf_counter() - self.start)
+        if self.span is not None:
+            self.span.__exit__(exc_type, exc, tb)
+        return False
+
+
+def stage(name: str):
+    """量測一個查詢階段"""
+    if not config.METRICS_ENABLED:
+        return _NOOP
+    return _Timer(STAGE_SECONDS, name)
+
+
+def startup_phase(name: str):
+    """量測一個啟動階段"""
+    if not config.METRICS_ENABLED:
+        return _NOOP
+    return _Timer(STARTUP_SECONDS, name)
+
+
+def render_prometheus() -> str:
+    """以 Prometheus text exposition 格式輸出所有 histogram"""
+    return "\n".join(STAGE_SECONDS.render() + STARTUP_SECONDS.render()) + "\n"
@@ -0,0 +1,84 @@
+"""
+    各搜尋模態 (文字、食材、圖片) 的延遲載入與狀態追蹤
+"""
+import threading
+import time
+from typing import Callable
+
+MODALITIES = ('text', 'ingredient', 'image')
+
+
+class ModalityUnavailableError(RuntimeError):
+    """模態已停用或載入失敗"""
+
+
+class ModalityState:
+    """
+        單一模態的載入狀態
+
+        第一次呼叫 ensure() 時 (或背景 warmup 時) 執行 loader，並記錄載入時間。
+        同時間只有一個執行緒會執行 loader，其他呼叫者會等待載入完成。
+        載入失敗後的 retry_seconds 秒內直接拋出錯誤，不會在每個請求重跑 loader。
+    """
+
+    def __init__(self, name: str, loader: Callable[[], None], enabled: bool = True,
+                 retry_seconds: float = 60.0):
+        self.name = name
+        self.loader = loader
+        self.enabled = enabled
+        self.retry_seconds = retry_seconds
+        self.status = 'pending' if enabled else 'disabled'
+        self.load_seconds: float | None = None
+        self.error: str | None = None
+        self.failed_at: float | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.status == 'ready'
+
+    def ensure(self):
+        """確保模態已載入，停用或載入失敗時拋出 ModalityUnavailableError"""
+        if self.status == 'ready':
+            return
+        if not self.enabled:
+            raise ModalityUnavailableError(f"modality '{self.name}' is disabled")
+        self._check_backoff()
+        with self._lock:
+            if self.status == 'ready':
+                return
+            # 等待鎖期間其他執行緒可能剛載入失敗
+            self._check_backoff()
+            self.status = 'loading'
+            start = time.perf_counter()
+            try:
+                self.loader()
+            except Exception as e:
+                self.status = 'failed'
+                self.error = str(e)
+                self.failed_at = time.monotonic()
+                print(f"Error loading modality {self.name}: {e}")
+                raise ModalityUnavailableError(f"modality '{self.name}' failed to load: {e}") from e
+            self.load_seconds = time.perf_counter() - start
+            self.error = None
+            self.failed_at = None
+            self.status = 'ready'
+            print(f"模態 {self.name} 載入完成，耗時 {self.load_seconds:.1f} 秒")
+
+    def _check_backoff(self):
+        """上次載入失敗且尚未超過 retry_seconds 時拋出 ModalityUnavailableError"""
+        if self.status != 'failed':
+            return
+        remaining = self.failed_at + self.retry_seconds - time.monotonic()
+        if remaining > 0:
+            raise ModalityUnavailableError(
+                f"modality '{self.name}' failed to load: {self.error} (retry in {remaining:.1f}s)")
+
+    def to_dict(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'status': self.status,
+            'ready': self.ready,
+            'load_seconds': self.load_seconds,
+            'error': self.error,
+        }
@@ -0,0 +1,253 @@
+"""
+    將文字模型與 CLIP 的圖片 / 文字塔匯出為 ONNX，並與 PyTorch 的輸出比對
+
+    > python onnx_export.py --out ./cache/onnx --int8
+    > RECIPE_ENCODER_BACKEND=onnx RECIPE_ONNX_INT8=1 uvicorn main:app
+
+    輸出目錄:
+        text/         paraphrase-multilingual-MiniLM (mean pooling 包含在模型中，直接輸出句向量)
+        clip_vision/  CLIP 圖片塔 (輸出 get_image_features)
+        clip_text/    CLIP 文字塔 (輸出 get_text_features)
+    每個目錄包含 model.onnx、--int8 時的 model.int8.onnx、tokenizer.json 與前處理參數 encoder.json。
+
+    匯出後會以語料中的食譜文字與測試圖片比較兩種 backend 的向量，
+    任一模型的最小 cosine similarity 低於 1 - tolerance 時以非零狀態結束 (可用於 CI)。
+    只做比對: python onnx_export.py --out ./cache/onnx --check-only
+    pytest 版本的比對在 tests/test_onnx_parity.py (沒有安裝 torch / transformers 時略過)。
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from typing import List
+import numpy as np
+from PIL import Image
+import encoders
+
+OPSET = 17
+TEXT_MAX_LENGTH = 128
+CLIP_MAX_LENGTH = 77
+
+
+def _write_meta(model_dir: str, meta: dict):
+    with open(os.path.join(model_dir, "encoder.json"), "w", encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+
+def _tokenizer_meta(tokenizer, max_length: int) -> dict:
+    return {'max_length': max_length, 'pad_token': tokenizer.pad_token, 'pad_id': tokenizer.pad_token_id}
+
+
+def _export(module, inputs: tuple, path: str, input_names: List[str], output_name: str):
+    import torch
+
+    # 批次大小與文字長度可變，圖片固定為 crop_size
+    dynamic_axes = {name: {0: 'batch'} if name == 'pixel_values' else {0: 'batch', 1: 'sequence'}
+                    for name in input_names}
+    dynamic_axes[output_name] = {0: 'batch'}
+    with torch.inference_mode():
+        torch.onnx.export(module.eval(), inputs, path, input_names=input_names, output_names=[output_name],
+                          dynamic_axes=dynamic_axes, opset_version=OPSET, do_constant_folding=True)
+
+
+def export_text(model_name: str, out_dir: str):
+    """匯出 SentenceTransformer (Transformer + mean pooling)"""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device="cpu")
+    if len(model) != 2 or not getattr(model[1], 'pooling_mode_mean_tokens', False):
+        raise ValueError(f"{model_name} is not a Transformer + mean pooling model")
+    transformer = model[0].auto_model
+    tokenizer = model.tokenizer
+
+    class MeanPooling(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, input_ids, attention_mask):
+            hidden = self.transformer(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+            mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+            return (hidden * mask).sum(1) / mask.sum(1).clamp(min=1e-9)
+
+    os.makedirs(out_dir, exist_ok=True)
+    sample = tokenizer(["番茄炒蛋", "紅燒牛肉麵的做法"], padding=True, return_tensors="pt")
+    _export(MeanPooling(), (sample['input_ids'], sample['attention_mask']), encoders.model_path(out_dir),
+            ['input_ids', 'attention_mask'], 'embedding')
+    tokenizer.save_pretrained(out_dir)
+    max_length = min(model.max_seq_length or TEXT_MAX_LENGTH, TEXT_MAX_LENGTH)
+    _write_meta(out_dir, {'source': model_name, **_tokenizer_meta(tokenizer, max_length)})
+
+
+def export_clip(model_name: str, vision_dir: str, text_dir: str):
+    """匯出 CLIP 的圖片塔與文字塔"""
+    import torch
+    from transformers import CLIPModel, CLIPProcessor
+
+    model = CLIPModel.from_pretrained(model_name)
+    processor = CLIPProcessor.from_pretrained(model_name)
+
+    class VisionTower(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, pixel_values):
+            return self.model.get_image_features(pixel_values=pixel_values)
+
+    class TextTower(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model.get_text_features(input_ids=input_ids, attention_mask=attention_mask)
+
+    os.makedirs(vision_dir, exist_ok=True)
+    image_processor = processor.image_processor
+    pixels = processor(images=[Image.new("RGB", (256, 224), (200, 120, 40))], return_tensors="pt")['pixel_values']
+    _export(VisionTower(), (pixels,), encoders.model_path(vision_dir), ['pixel_values'], 'image_embeds')
+    _write_meta(vision_dir, {
+        'source': model_name,
+        'size': image_processor.size['shortest_edge'],
+        'crop_size': image_processor.crop_size['height'],
+        'mean': list(image_processor.image_mean),
+        'std': list(image_processor.image_std),
+    })
+
+    os.makedirs(text_dir, exist_ok=True)
+    tokenizer = processor.tokenizer
+    sample = tokenizer(["a photo of fried rice", "tomato and egg"], padding=True, return_tensors="pt")
+    _export(TextTower(), (sample['input_ids'], sample['attention_mask']), encoders.model_path(text_dir),
+            ['input_ids', 'attention_mask'], 'text_embeds')
+    tokenizer.save_pretrained(text_dir)
+    _write_meta(text_dir, {'source': model_name, **_tokenizer_meta(tokenizer, CLIP_MAX_LENGTH)})
+
+
+def quantize(model_dir: str):
+    """以 onnxruntime 的動態量化產生 int8 權重的模型 (只量化 MatMul / Gemm)"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    quantize_dynamic(encoders.model_path(model_dir), encoders.model_path(model_dir, quantized=True),
+                     op_types_to_quantize=['MatMul', 'Gemm'], weight_type=QuantType.QInt8)
+
+
+def sample_texts(data_path: str, count: int) -> List[str]:
+    """取語料中的食譜文字 (與建立文字嵌入時相同的格式) 加上幾個短查詢"""
+    texts = ["番茄炒蛋", "雞肉", "簡單的家常菜", "低卡 減脂 便當"]
+    if data_path and os.path.exists(data_path):
+        from corpus_loader import iter_records
+        from recipe_store import RecipeFields, normalize_recipe
+        from search_engine import recipe_text
+
+        texts += [recipe_text(RecipeFields.from_recipe(normalize_recipe(recipe)))
+                  for recipe in itertools.islice(iter_records(data_path), count)]
+    return texts
+
+
+def sample_images(image_dir: str | None, count: int, seed: int = 0) -> List[Image.Image]:
+    """從 image_dir 讀取圖片，沒有時產生不同大小與長寬比的測試圖片"""
+    if image_dir:
+        names = sorted(os.listdir(image_dir))[:count]
+        return [Image.open(os.path.join(image_dir, name)).convert("RGB") for name in names]
+    rng = np.random.default_rng(seed)
+    images = []
+    for i in range(count):
+        width, height = int(rng.integers(160, 640)), int(rng.integers(160, 640))
+        gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+        noise = rng.normal(0, 40, (height, width, 3))
+        pixels = np.clip(gradient * rng.random(3) + noise + rng.integers(0, 128, 3), 0, 255).astype(np.uint8)
+        images.append(Image.fromarray(pixels))
+    return images
+
+
+def compare(reference: np.ndarray, candidate: np.ndarray) -> dict:
+    """以每一列的 cosine similarity 與最大絕對誤差比較兩組向量"""
+    reference = np.asarray(reference, dtype=np.float32)
+    candidate = np.asarray(candidate, dtype=np.float32)
+    cosine = (reference * candidate).sum(1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1) + 1e-12)
+    return {'min_cosine': float(cosine.min()), 'mean_cosine': float(cosine.mean()),
+            'max_abs_diff': float(np.abs(reference - candidate).max())}
+
+
+def reference_vectors(text_model: str, clip_model: str, texts: List[str], images: List[Image.Image]) -> dict:
+    """以 PyTorch 模型編碼比對用的文字與圖片 (CLIP 文字塔只取前 16 筆文字)"""
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from transformers import CLIPModel, CLIPProcessor
+
+    model = CLIPModel.from_pretrained(clip_model)
+    processor = CLIPProcessor.from_pretrained(clip_model)
+    with torch.inference_mode():
+        clip_text_inputs = processor(text=texts[:16], padding=True, truncation=True, return_tensors="pt")
+        return {
+            'text': SentenceTransformer(text_model, device="cpu").encode(texts, batch_size=32),
+            'clip_vision': model.get_image_features(**processor(images=images, return_tensors="pt")).numpy(),
+            'clip_text': model.get_text_features(**clip_text_inputs).numpy(),
+        }
+
+
+def onnx_vectors(out_dir: str, texts: List[str], images: List[Image.Image], quantized: bool = False) -> dict:
+    """以 out_dir 中匯出的 ONNX 模型編碼與 reference_vectors 相同的輸入"""
+    return {
+        'text': encoders.OnnxTextEncoder(os.path.join(out_dir, "text"), quantized).encode(texts, 32),
+        'clip_vision': encoders.OnnxImageEncoder(os.path.join(out_dir, "clip_vision"), quantized).encode(images),
+        'clip_text': encoders.OnnxTextEncoder(os.path.join(out_dir, "clip_text"), quantized).encode(texts[:16]),
+    }
+
+
+def check_parity(out_dir: str, text_model: str, clip_model: str, texts: List[str], images: List[Image.Image],
+                 tolerance: float = 1e-4, int8_tolerance: float = 2e-2) -> bool:
+    """
+        比較 ONNX 與 PyTorch 的輸出，回傳是否全部在容許誤差內
+
+        float32 模型的 min cosine 需 >= 1 - tolerance，int8 模型需 >= 1 - int8_tolerance。
+    """
+    references = reference_vectors(text_model, clip_model, texts, images)
+
+    ok = True
+    variants = [(False, tolerance)]
+    if os.path.exists(encoders.model_path(os.path.join(out_dir, "text"), quantized=True)):
+        variants.append((True, int8_tolerance))
+    for quantized, limit in variants:
+        for name, vectors in onnx_vectors(out_dir, texts, images, quantized).items():
+            result = compare(references[name], vectors)
+            passed = result['min_cosine'] >= 1 - limit
+            ok &= passed
+            print(f"{'PASS' if passed else 'FAIL'} {name:<12} {'int8' if quantized else 'float32':<8} "
+                  f"min cos {result['min_cosine']:.6f}  mean cos {result['mean_cosine']:.6f}  "
+                  f"max |diff| {result['max_abs_diff']:.2e}")
+    return ok
+
+
+if __name__ == "__main__":
+    from search_engine import CLIP_MODEL_NAME, TEXT_MODEL_NAME
+
+    parser = argparse.ArgumentParser(description="匯出 ONNX 編碼器並與 PyTorch 比對輸出")
+    parser.add_argument("--out", default="./cache/onnx")
+    parser.add_argument("--int8", action="store_true", help="一併產生 int8 動態量化的模型")
+    parser.add_argument("--check-only", action="store_true", help="不匯出，只比對既有的模型")
+    parser.add_argument("--data", default="./icook_recipe/recipe_data.json", help="比對用的食譜資料")
+    parser.add_argument("--image-dir", default=None, help="比對用的圖片目錄 (預設產生測試圖片)")
+    parser.add_argument("--samples", type=int, default=64)
+    parser.add_argument("--tolerance", type=float, default=1e-4, help="float32 模型允許的 1 - min cosine")
+    parser.add_argument("--int8-tolerance", type=float, default=2e-2, help="int8 模型允許的 1 - min cosine")
+    args = parser.parse_args()
+
+    if not args.check_only:
+        start = time.perf_counter()
+        export_text(TEXT_MODEL_NAME, os.path.join(args.out, "text"))
+        export_clip(CLIP_MODEL_NAME, os.path.join(args.out, "clip_vision"), os.path.join(args.out, "clip_text"))
+        if args.int8:
+            for name in ("text", "clip_vision", "clip_text"):
+                quantize(os.path.join(args.out, name))
+        print(f"ONNX 模型已匯出到 {args.out}，耗時 {time.perf_counter() - start:.1f} 秒")
+
+    passed = check_parity(args.out, TEXT_MODEL_NAME, CLIP_MODEL_NAME,
+                          sample_texts(args.data, args.samples), sample_images(args.image_dir, 16),
+                          args.tolerance, args.int8_tolerance)
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,83 @@
+"""
+    搜尋結果的欄位投影與分頁
+
+    搜尋結果卡片只需要少數欄位，完整的食材與步驟由 /api/recipe/{id} 另外取得。
+    fields 參數以逗號分隔欄位名稱:
+        summary (預設): id, name, image, duration
+        full: 食譜的所有欄位
+    分數等搜尋相關的欄位 (similarity_score, distance ...) 一律保留。
+    搜尋引擎建立結果時就只取出這些欄位 (project_recipe)，不會先組出完整的食譜再裁切。
+"""
+import base64
+import binascii
+import json
+from typing import Dict, List
+
+SUMMARY_FIELDS = ('id', 'name', 'image', 'duration')
+# 各搜尋方法附加在結果上的欄位
+SCORE_FIELDS = ('similarity_score', 'matched_parts', 'similarity', 'matching_ingredients', 'total_ingredients',
+                'distance', 'combined_score', 'image_score', 'text_score')
+
+
+class InvalidCursorError(ValueError):
+    """無法解析的分頁 cursor"""
+
+
+def parse_fields(fields: str | None) -> tuple | None:
+    """解析 fields 參數，回傳要保留的欄位 (None 代表保留全部)"""
+    names = [name.strip() for name in (fields or 'summary').split(',') if name.strip()]
+    if 'full' in names:
+        return None
+    selected = []
+    for name in names:
+        for field in (SUMMARY_FIELDS if name == 'summary' else (name,)):
+            if field not in selected:
+                selected.append(field)
+    return tuple(selected) + tuple(field for field in SCORE_FIELDS if field not in selected)
+
+
+def project_recipe(recipe: Dict, fields: tuple | None) -> Dict:
+    """取出食譜中指定的欄位 (fields 為 None 時回傳原本的食譜)"""
+    if fields is None:
+        return recipe
+    return {field: recipe[field] for field in fields if field in recipe}
+
+
+def encode_cursor(offset: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({'o': offset}).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> int:
+    """將 cursor 還原為 offset"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        offset = json.loads(base64.urlsafe_b64decode(padded))['o']
+    except (binascii.Error, ValueError, KeyError, TypeError) as e:
+        raise InvalidCursorError(f"invalid cursor: {cursor}") from e
+    if not isinstance(offset, int) or offset < 0:
+        raise InvalidCursorError(f"invalid cursor: {cursor}")
+    return offset
+
+
+def paginate(results: List[Dict], offset: int, limit: int) -> tuple:
+    """
+        取出 [offset, offset + limit) 的結果
+
+        呼叫端應多取一筆 (offset + limit + 1)，以判斷是否還有下一頁。
+        回傳 (該頁結果, 下一頁的 cursor 或 None)
+    """
+    page = results[offset:offset + limit]
+    next_cursor = encode_cursor(offset + limit) if len(results) > offset + limit else None
+    return page, next_cursor
+
+
+def paginate_groups(groups: List[List[Dict]], offset: int, limit: int) -> tuple:
+    """
+        每一組各取 [offset, offset + limit) 後依序串接 (例如相似食材: 查詢中的每個詞各一組)
+
+        呼叫端應每組多取一筆，任一組還有結果時就有下一頁。
+        回傳 (該頁結果, 下一頁的 cursor 或 None)
+    """
+    page = [item for group in groups for item in group[offset:offset + limit]]
+    has_more = any(len(group) > offset + limit for group in groups)
+    return page, encode_cursor(offset + limit) if has_more else None
@@ -0,0 +1,260 @@
+"""
+    嵌入矩陣的量化儲存 (float16 / 每列一個縮放係數的 int8)
+
+    量化後的矩陣存成 .npy 並以 mmap 載入，查詢時分塊還原為 float32 再做內積，
+    暫存記憶體只有一個區塊的大小。量化時會以 float32 矩陣為基準計算 recall@k，
+    低於門檻時退回 float32。
+
+    比較各模態在不同量化方式下的 recall 與記憶體用量:
+    > python quantization.py --cache-dir ./cache --k 10
+"""
+import argparse
+import contextlib
+import json
+import os
+import tempfile
+import numpy as np
+from cache_files import atomic_write, file_lock
+
+MODES = ('float32', 'float16', 'int8')
+# 分塊還原時每塊的列數
+BLOCK_ROWS = 1024
+
+
+class QuantizedMatrix:
+    """
+        量化的嵌入矩陣
+
+        mode 為 float16 時 data 即為 float16 矩陣；
+        mode 為 int8 時第 i 列的原始向量約為 data[i] * scales[i]。
+    """
+
+    def __init__(self, data: np.ndarray, mode: str, scales: np.ndarray | None = None):
+        self.data = data
+        self.mode = mode
+        self.scales = scales
+
+    @classmethod
+    def quantize(cls, matrix: np.ndarray, mode: str):
+        matrix = np.asarray(matrix, dtype=np.float32)
+        if mode == 'float16':
+            return cls(matrix.astype(np.float16), mode)
+        if mode == 'int8':
+            scales = np.abs(matrix).max(axis=1) / 127.0 if len(matrix) else np.empty(0, dtype=np.float32)
+            scales = np.asarray(scales, dtype=np.float32)
+            safe = np.where(scales == 0, 1.0, scales).astype(np.float32)
+            data = np.clip(np.rint(matrix / safe[:, None]), -127, 127).astype(np.int8)
+            return cls(data, mode, scales)
+        raise ValueError(f"unknown quantization mode: {mode}")
+
+    @property
+    def shape(self) -> tuple:
+        return self.data.shape
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def block(self, start: int, end: int) -> np.ndarray:
+        """將 [start, end) 列還原為 float32"""
+        rows = self.data[start:end].astype(np.float32)
+        if self.scales is not None:
+            rows *= self.scales[start:end, None]
+        return rows
+
+    def take(self, positions: np.ndarray) -> np.ndarray:
+        """將指定的列還原為 float32"""
+        rows = self.data[positions].astype(np.float32)
+        if self.scales is not None:
+            rows *= self.scales[positions, None]
+        return rows
+
+    def dequantize(self) -> np.ndarray:
+        return self.block(0, len(self.data))
+
+    def dot(self, vector: np.ndarray) -> np.ndarray:
+        """與查詢向量的內積 (float32)，與 np.ndarray.dot 的結果形狀相同"""
+        vector = np.asarray(vector, dtype=np.float32)
+        out = np.empty(len(self.data), dtype=np.float32)
+        for start in range(0, len(self.data), BLOCK_ROWS):
+            end = min(start + BLOCK_ROWS, len(self.data))
+            # int8 只需在內積後乘上每列的縮放係數
+            scores = self.data[start:end].astype(np.float32) @ vector
+            if self.scales is not None:
+                scores *= self.scales[start:end]
+            out[start:end] = scores
+        return out
+
+    def __matmul__(self, vector: np.ndarray) -> np.ndarray:
+        return self.dot(vector)
+
+    def save(self, prefix: str, meta: dict):
+        """
+            寫入 {prefix}.data.*.npy / .scales.*.npy 與 {prefix}.json
+
+            資料與縮放係數每次都寫入新的唯一檔名，最後寫入的 .json 記錄這一次的檔名，
+            讀取端依 .json 開啟，不會拿到不同次寫入的資料與縮放係數。上一版的檔案在替換後刪除。
+        """
+        directory = os.path.dirname(prefix) or "."
+        previous = _data_files(prefix, _read_json(prefix))
+        arrays = {'data': self.data}
+        if self.scales is not None:
+            arrays['scales'] = self.scales
+        files = {}
+        for name, array in arrays.items():
+            fd, path = tempfile.mkstemp(prefix=f"{os.path.basename(prefix)}.{name}.", suffix=".npy", dir=directory)
+            with open(fd, "wb") as f:
+                np.save(f, array)
+            files[name] = os.path.basename(path)
+        with atomic_write(prefix + ".json", "w", encoding='utf-8') as f:
+            json.dump({**meta, 'mode': self.mode, 'files': files}, f)
+        for path in set(previous.values()) - set(_data_files(prefix, {'files': files}).values()):
+            # 已經 mmap 的讀取端不受影響 (Windows 上使用中的檔案刪不掉時留著)
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+    @classmethod
+    def load(cls, prefix: str):
+        """以 mmap 載入，回傳 (QuantizedMatrix, meta)，不存在時回傳 (None, None)"""
+        if not os.path.exists(prefix + ".json"):
+            return None, None
+        try:
+            meta = _read_json(prefix)
+            files = _data_files(prefix, meta)
+            data = np.load(files['data'], mmap_mode='r')
+            scales = np.load(files['scales'], mmap_mode='r') if meta['mode'] == 'int8' else None
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error loading quantized matrix: {e}")
+            return None, None
+        return cls(data, meta['mode'], scales), meta
+
+
+def _read_json(prefix: str) -> dict | None:
+    try:
+        with open(prefix + ".json", "r", encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _data_files(prefix: str, meta: dict | None) -> dict:
+    """meta 記錄的資料檔路徑 {'data', 'scales'} (舊版的 meta 沒有記錄檔名，使用固定的檔名)"""
+    if meta is None:
+        return {}
+    files = meta.get('files') or {'data': os.path.basename(prefix) + ".data.npy",
+                                  'scales': os.path.basename(prefix) + ".scales.npy"}
+    directory = os.path.dirname(prefix)
+    return {name: os.path.join(directory, filename) for name, filename in files.items()}
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    k = min(k, scores.shape[-1])
+    return np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+
+
+def sample_queries(matrix: np.ndarray, n: int = 200, seed: int = 0) -> np.ndarray:
+    """以語料中隨機的列加上少量雜訊作為評估用的查詢 (matrix 可為 ndarray 或 QuantizedMatrix)"""
+    rng = np.random.default_rng(seed)
+    positions = rng.choice(len(matrix), size=min(n, len(matrix)), replace=False)
+    if isinstance(matrix, QuantizedMatrix):
+        rows = matrix.take(positions)
+    else:
+        rows = np.asarray(matrix[positions], dtype=np.float32)
+    noise = rng.normal(size=rows.shape).astype(np.float32)
+    noise *= 0.1 * np.linalg.norm(rows, axis=1, keepdims=True) / np.sqrt(rows.shape[1])
+    return rows + noise
+
+
+def recall_at_k(baseline: np.ndarray, quantized, queries: np.ndarray, k: int = 10) -> float:
+    """量化矩陣的 top-k 與 float32 基準 top-k 的平均重疊比例"""
+    if len(baseline) == 0 or len(queries) == 0:
+        return 1.0
+    baseline = np.asarray(baseline, dtype=np.float32)
+    hits = 0
+    for query in queries:
+        expected = set(_top_k(baseline @ query, k).tolist())
+        hits += len(expected.intersection(_top_k(quantized.dot(query), k).tolist()))
+    return hits / (len(queries) * min(k, len(baseline)))
+
+
+def evaluate(matrix: np.ndarray, k: int = 10, queries: np.ndarray | None = None) -> dict:
+    """各量化方式的 recall@k 與記憶體用量"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if queries is None:
+        queries = sample_queries(matrix)
+    report = {'float32': {'recall': 1.0, 'bytes': int(matrix.nbytes)}}
+    for mode in MODES[1:]:
+        quantized = QuantizedMatrix.quantize(matrix, mode)
+        report[mode] = {'recall': recall_at_k(matrix, quantized, queries, k), 'bytes': int(quantized.nbytes)}
+    return report
+
+
+def load_or_quantize(matrix: np.ndarray, prefix: str, mode: str, source_id: str,
+                     min_recall: float, k: int = 10):
+    """
+        取得以 mode 儲存的矩陣
+
+        已量化過相同來源 (source_id) 時直接以 mmap 載入；否則重新量化並檢查 recall@k，
+        低於 min_recall 時印出警告並回傳原本的 float32 矩陣。
+    """
+    if mode == 'float32':
+        return matrix
+    if mode not in MODES:
+        raise ValueError(f"unknown quantization mode: {mode}")
+
+    def matches(quantized, meta):
+        return quantized is not None and meta.get('source_id') == source_id and meta.get('mode') == mode \
+            and tuple(quantized.shape) == tuple(matrix.shape)
+
+    quantized, meta = QuantizedMatrix.load(prefix)
+    if not matches(quantized, meta):
+        # 多個 worker 同時啟動時只有一個量化，其他等待後直接載入
+        with file_lock(prefix):
+            quantized, meta = QuantizedMatrix.load(prefix)
+            if not matches(quantized, meta):
+                quantized = QuantizedMatrix.quantize(matrix, mode)
+                recall = recall_at_k(matrix, quantized, sample_queries(matrix), k)
+                meta = {'source_id': source_id, 'recall': recall, 'k': k}
+                quantized.save(prefix, meta)
+                quantized, meta = QuantizedMatrix.load(prefix)
+
+    if meta['recall'] < min_recall:
+        print(f"{os.path.basename(prefix)}: {mode} recall@{meta['k']} = {meta['recall']:.3f} "
+              f"低於門檻 {min_recall}，改用 float32")
+        return matrix
+    print(f"{os.path.basename(prefix)}: 使用 {mode} ({quantized.nbytes / 2**20:.1f} MB, "
+          f"recall@{meta['k']} = {meta['recall']:.3f})")
+    return quantized
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="比較各模態嵌入矩陣在不同量化方式下的 recall@k")
+    parser.add_argument("--cache-dir", default="./cache")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--image", action="store_true", help="一併評估 ChromaDB 中的 CLIP 向量")
+    args = parser.parse_args()
+
+    matrices = {}
+    for name in sorted(os.listdir(args.cache_dir)):
+        # 略過量化後的 .data.npy / .scales.npy
+        if name.startswith("text_embeddings_") and name.endswith(".npy") and name.count(".") == 1:
+            matrices['text'] = np.load(os.path.join(args.cache_dir, name), mmap_mode='r')
+    ingredient_vectors = os.path.join(args.cache_dir, "ingredient_model", "recipe_vectors.npy")
+    if os.path.exists(ingredient_vectors):
+        matrices['ingredient'] = np.load(ingredient_vectors, mmap_mode='r')
+    if args.image:
+        from chromadb import PersistentClient
+        from image_pipeline import COLLECTION_NAME
+
+        collection = PersistentClient().get_or_create_collection(COLLECTION_NAME)
+        matrices['image'] = np.asarray(collection.get(include=['embeddings'])['embeddings'], dtype=np.float32)
+
+    for modality, matrix in matrices.items():
+        report = evaluate(matrix, args.k, sample_queries(matrix, args.queries))
+        print(f"== {modality} {matrix.shape}")
+        for mode, result in report.items():
+            print(f"  {mode:<8} recall@{args.k} {result['recall']:.4f}  {result['bytes'] / 2**20:>9.1f} MB")
@@ -0,0 +1,220 @@
+"""
+    食譜屬性篩選 (料理時間、份量、標籤、食材)
+
+    料理時間與份量在載入時解析為數字 (RecipeFields)，FilterIndex 將它們排成依 store 列號的
+    float32 陣列 (未知為 NaN)；標籤與食材詞則是每個值一個列集合，出現次數多的值存成 bitmap
+    (np.packbits，每列 1 bit)，少的存成列號陣列，查詢時展開為布林遮罩。
+    各搜尋模態在取 top-k 之前以遮罩篩選分數陣列，不需要多取結果再過濾；
+    圖片搜尋則將數值條件轉為 ChromaDB 的 where 條件。
+
+    增量更新與 CorpusSnapshot 一樣是 copy-on-write: 數值陣列複製後修改，列集合保持不變，
+    更新過的列記錄在 delta 中逐列比對，直到重新建置。
+"""
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List
+import numpy as np
+from query_cache import normalize_query
+from recipe_store import RecipeFields
+
+
+class InvalidFilterError(ValueError):
+    """篩選條件不合法"""
+
+
+def tag_key(tag: str) -> str:
+    """標籤比對用的鍵 (全形轉半形、合併空白、不分大小寫)"""
+    return normalize_query(tag).casefold()
+
+
+class RecipeFilter:
+    """
+        一組篩選條件 (全部都要符合)
+
+        max_duration / min_duration: 料理時間 (分鐘)
+        min_servings / max_servings: 份量 (人數)
+        hashtags: 必須有的標籤
+        ingredients: 必須有的食材 (清理與斷詞後，食譜的食材詞需包含每個食材的所有詞)
+        料理時間或份量未知的食譜不符合該項的條件。
+    """
+
+    def __init__(self, max_duration: float | None = None, min_duration: float | None = None,
+                 min_servings: float | None = None, max_servings: float | None = None,
+                 hashtags: Iterable[str] = (), ingredients: Iterable[str] = ()):
+        for name, value in (('max_duration', max_duration), ('min_duration', min_duration),
+                            ('min_servings', min_servings), ('max_servings', max_servings)):
+            if value is not None and not value >= 0:
+                raise InvalidFilterError(f"{name} must be >= 0")
+        if min_duration is not None and max_duration is not None and min_duration > max_duration:
+            raise InvalidFilterError("min_duration must not exceed max_duration")
+        if min_servings is not None and max_servings is not None and min_servings > max_servings:
+            raise InvalidFilterError("min_servings must not exceed max_servings")
+        self.max_duration = max_duration
+        self.min_duration = min_duration
+        self.min_servings = min_servings
+        self.max_servings = max_servings
+        self.hashtags = tuple(sorted({tag_key(tag) for tag in hashtags if tag and tag.strip()}))
+        self.ingredients = tuple(sorted({normalize_query(name) for name in ingredients if name and name.strip()}))
+
+    def __bool__(self) -> bool:
+        return self.key() != (None, None, None, None, (), ())
+
+    def key(self) -> tuple:
+        """作為快取鍵的一部分"""
+        return (self.max_duration, self.min_duration, self.min_servings, self.max_servings,
+                self.hashtags, self.ingredients)
+
+    @property
+    def has_sets(self) -> bool:
+        """是否有標籤或食材條件 (無法轉為 ChromaDB 的 where 條件)"""
+        return bool(self.hashtags or self.ingredients)
+
+    def chroma_where(self) -> dict | None:
+        """數值條件對應的 ChromaDB where (metadata 的 duration / servings)，沒有數值條件時為 None"""
+        conditions = []
+        for field, op, value in (('duration', '$lte', self.max_duration), ('duration', '$gte', self.min_duration),
+                                 ('servings', '$gte', self.min_servings), ('servings', '$lte', self.max_servings)):
+            if value is not None:
+                conditions.append({field: {op: float(value)}})
+        if not conditions:
+            return None
+        return conditions[0] if len(conditions) == 1 else {'$and': conditions}
+
+
+class ValueRows:
+    """
+        每個值 (標籤或食材詞) 對應的列集合
+
+        列數超過 n_rows / 32 的值存成 bitmap (此時比 int32 列號陣列小)，其餘存成排序後的列號陣列。
+    """
+
+    def __init__(self, n_rows: int, postings: Dict[str, List[int]]):
+        self.n_rows = n_rows
+        self.bitmaps: Dict[str, np.ndarray] = {}
+        self.rows: Dict[str, np.ndarray] = {}
+        for value, rows in postings.items():
+            if len(rows) * 32 > n_rows:
+                bitmap = np.zeros(n_rows, dtype=bool)
+                bitmap[rows] = True
+                self.bitmaps[value] = np.packbits(bitmap)
+            else:
+                self.rows[value] = np.asarray(rows, dtype=np.int32)
+
+    def mask(self, value: str) -> np.ndarray:
+        """含有 value 的列的布林遮罩"""
+        bitmap = self.bitmaps.get(value)
+        if bitmap is not None:
+            return np.unpackbits(bitmap, count=self.n_rows).view(bool)
+        mask = np.zeros(self.n_rows, dtype=bool)
+        rows = self.rows.get(value)
+        if rows is not None:
+            mask[rows] = True
+        return mask
+
+    def stats(self) -> dict:
+        return {'values': len(self.bitmaps) + len(self.rows), 'bitmaps': len(self.bitmaps),
+                'bytes': sum(a.nbytes for a in self.bitmaps.values()) + sum(a.nbytes for a in self.rows.values())}
+
+
+def _number(value: float | None) -> float:
+    return np.nan if value is None else value
+
+
+class FilterIndex:
+    """
+        篩選用的預先計算資料
+
+        duration / servings: 依 store 列號的料理時間與份量 (未知或已刪除為 NaN)
+        hashtags / tokens: 建置時的標籤與食材詞列集合 (ValueRows)
+        dirty: 建置後更新或刪除的列 (不再使用列集合)
+        delta: 更新後的列 -> (標籤鍵集合, 食材詞集合)
+    """
+
+    def __init__(self, duration: np.ndarray, servings: np.ndarray, hashtags: ValueRows, tokens: ValueRows,
+                 dirty: np.ndarray | None = None, delta: Dict[int, tuple] | None = None):
+        self.duration = duration
+        self.servings = servings
+        self.hashtags = hashtags
+        self.tokens = tokens
+        self.dirty = dirty if dirty is not None else np.zeros(0, dtype=bool)
+        self.delta = delta or {}
+
+    @classmethod
+    def build(cls, n_rows: int, records: Iterable[tuple], recipe_tokens: Callable[[RecipeFields], frozenset]):
+        """由 [(store 列號, RecipeFields)] 建立，recipe_tokens 回傳食譜所有食材的食材詞"""
+        duration = np.full(n_rows, np.nan, dtype=np.float32)
+        servings = np.full(n_rows, np.nan, dtype=np.float32)
+        tag_rows, token_rows = defaultdict(list), defaultdict(list)
+        for row, recipe in records:
+            duration[row] = _number(recipe.duration_minutes)
+            servings[row] = _number(recipe.servings_count)
+            for tag in {tag_key(tag) for tag in recipe.hashtags}:
+                tag_rows[tag].append(row)
+            for token in recipe_tokens(recipe):
+                token_rows[token].append(row)
+        return cls(duration, servings, ValueRows(n_rows, tag_rows), ValueRows(n_rows, token_rows))
+
+    def with_updates(self, changes: List[tuple], recipe_tokens: Callable[[RecipeFields], frozenset]):
+        """
+            回傳套用更新後的新索引
+
+            changes 中每一項為 (store 列號, 新版本的 RecipeFields)，刪除時新版本為 None。
+        """
+        n_rows = max([len(self.duration)] + [row + 1 for row, _ in changes])
+        duration = np.full(n_rows, np.nan, dtype=np.float32)
+        duration[:len(self.duration)] = self.duration
+        servings = np.full(n_rows, np.nan, dtype=np.float32)
+        servings[:len(self.servings)] = self.servings
+        dirty = np.zeros(n_rows, dtype=bool)
+        dirty[:len(self.dirty)] = self.dirty
+        delta = dict(self.delta)
+        for row, recipe in changes:
+            dirty[row] = True
+            if recipe is None:
+                duration[row] = servings[row] = np.nan
+                delta.pop(row, None)
+                continue
+            duration[row] = _number(recipe.duration_minutes)
+            servings[row] = _number(recipe.servings_count)
+            delta[row] = (frozenset(tag_key(tag) for tag in recipe.hashtags), recipe_tokens(recipe))
+        return FilterIndex(duration, servings, self.hashtags, self.tokens, dirty, delta)
+
+    def mask(self, filters: RecipeFilter, n_rows: int, token_lists: List[tuple] = ()) -> np.ndarray:
+        """
+            符合條件的列 (長度為 n_rows 的布林陣列)
+
+            token_lists 為 filters.ingredients 中每個食材斷詞後的詞 (由呼叫端以食材斷詞器產生)。
+        """
+        mask = np.ones(n_rows, dtype=bool)
+        size = min(n_rows, len(self.duration))
+        # NaN 的比較結果為 False，未知的料理時間與份量不符合條件
+        for values, low, high in ((self.duration, filters.min_duration, filters.max_duration),
+                                  (self.servings, filters.min_servings, filters.max_servings)):
+            if low is not None:
+                mask[:size] &= values[:size] >= low
+            if high is not None:
+                mask[:size] &= values[:size] <= high
+            if low is not None or high is not None:
+                mask[size:] = False
+
+        if filters.hashtags or token_lists:
+            base = np.ones(self.hashtags.n_rows, dtype=bool)
+            for tag in filters.hashtags:
+                base &= self.hashtags.mask(tag)
+            for tokens in token_lists:
+                for token in tokens:
+                    base &= self.tokens.mask(token)
+            matched = np.zeros(n_rows, dtype=bool)
+            matched[:len(base)] = base[:n_rows]
+            dirty = self.dirty[:n_rows]
+            matched[:len(dirty)] &= ~dirty
+            query_sets = [set(tokens) for tokens in token_lists]
+            for row, (tags, tokens) in self.delta.items():
+                if row < n_rows:
+                    matched[row] = all(tag in tags for tag in filters.hashtags) and \
+                        all(query <= tokens for query in query_sets)
+            mask &= matched
+        return mask
+
+    def stats(self) -> dict:
+        return {'rows': len(self.duration), 'delta': len(self.delta),
+                'hashtags': self.hashtags.stats(), 'tokens': self.tokens.stats()}
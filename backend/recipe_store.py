@@ -0,0 +1,387 @@
+import mmap
+import os
+import re
+import sys
+import tempfile
+import threading
+import unicodedata
+from array import array
+from typing import Dict, Iterable, Iterator, List
+import numpy as np
+import orjson
+
+# 數字 (可為範圍，例如 "2-3") 加上單位
+_NUMBER_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(?:\s*[-~～至到]\s*(\d+(?:\.\d+)?))?\s*([^\d\s.\-~～至到]*)")
+# 時間單位換算為分鐘，沒有單位時視為分鐘
+_DURATION_UNITS = {'小時': 60, '時': 60, 'h': 60, 'hr': 60, 'hrs': 60, 'hour': 60, 'hours': 60,
+                   '分鐘': 1, '分': 1, 'm': 1, 'min': 1, 'mins': 1, 'minute': 1, 'minutes': 1}
+
+
+def _numbers(text) -> List[tuple]:
+    """取出文字中的 [(下限, 上限, 單位)]"""
+    if isinstance(text, (int, float)) and not isinstance(text, bool):
+        return [(float(text), float(text), '')]
+    if not isinstance(text, str):
+        return []
+    return [(float(low), float(high or low), unit.lower())
+            for low, high, unit in _NUMBER_PATTERN.findall(unicodedata.normalize("NFKC", text))]
+
+
+def parse_duration(text) -> float | None:
+    """
+        將料理時間 ("30分鐘"、"1小時30分鐘"、"1.5 小時") 換算為分鐘，無法解析時回傳 None
+
+        範圍 ("20-30分鐘") 取上限，讓 "30 分鐘內" 之類的篩選不會納入可能超時的食譜。
+    """
+    total = None
+    for _, high, unit in _numbers(text):
+        factor = next((value for key, value in _DURATION_UNITS.items() if unit.startswith(key)), 1)
+        total = (total or 0.0) + high * factor
+    return total
+
+
+def parse_servings(text) -> float | None:
+    """將份量 ("4人份"、"2-3 人份") 轉為人數 (範圍取下限)，無法解析時回傳 None"""
+    numbers = _numbers(text)
+    return numbers[0][0] if numbers else None
+
+
+def normalize_recipe(recipe: dict) -> dict:
+    """確保搜尋需要的欄位都有值 (處理可能為 None 的欄位)，缺少 id 或格式錯誤時拋出 ValueError"""
+    if not isinstance(recipe, dict) or not isinstance(recipe.get('id'), str) or not recipe['id']:
+        raise ValueError("recipe must be an object with a non-empty string id")
+    ingredients = recipe.get('ingredients') or []
+    if not isinstance(ingredients, list) or not all(isinstance(ing, dict) for ing in ingredients):
+        raise ValueError(f"recipe {recipe['id']}: ingredients must be a list of objects")
+    recipe['name'] = recipe.get('name', '') or ''
+    recipe['description'] = recipe.get('description', '') or ''
+    recipe['hashtags'] = recipe.get('hashtags', []) or []
+    return recipe
+
+
+def _intern(value):
+    # 食材名稱、份量與標籤大量重複 ("鹽"、"適量")，共用同一個字串物件
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class RecipeFields:
+    """
+        搜尋用的食譜欄位 (不含步驟、圖片等只在回傳結果時需要的內容)
+
+        食材的名稱與份量分成兩個等長的 tuple (比每個食材一個 tuple 省記憶體)，名稱缺少時為空字串。
+        料理時間與份量在載入時解析為數字 (分鐘、人數)，無法解析時為 None。
+    """
+
+    __slots__ = ('id', 'name', 'description', 'hashtags', 'ingredient_names', 'ingredient_amounts',
+                 'duration_minutes', 'servings_count')
+
+    def __init__(self, recipe_id: str, name: str, description: str, hashtags: tuple,
+                 ingredient_names: tuple, ingredient_amounts: tuple,
+                 duration_minutes: float | None = None, servings_count: float | None = None):
+        self.id = recipe_id
+        self.name = name
+        self.description = description
+        self.hashtags = hashtags
+        self.ingredient_names = ingredient_names
+        self.ingredient_amounts = ingredient_amounts
+        self.duration_minutes = duration_minutes
+        self.servings_count = servings_count
+
+    @classmethod
+    def from_recipe(cls, recipe: dict):
+        """從已經過 normalize_recipe 的食譜取出搜尋欄位"""
+        ingredients = recipe.get('ingredients') or []
+        return cls(recipe['id'], recipe['name'], recipe['description'],
+                   tuple(_intern(str(tag)) for tag in recipe['hashtags']),
+                   tuple(_intern(ing.get('name') or '') for ing in ingredients),
+                   tuple(_intern(ing.get('amount', '適量')) for ing in ingredients),
+                   parse_duration(recipe.get('duration')), parse_servings(recipe.get('servings')))
+
+    def ingredients(self):
+        """逐一取得 (名稱, 份量)"""
+        return zip(self.ingredient_names, self.ingredient_amounts)
+
+    def to_record(self) -> list:
+        """可序列化的欄位列表 (write_mapped_store 寫入 fields.bin)"""
+        return [self.id, self.name, self.description, self.hashtags, self.ingredient_names, self.ingredient_amounts,
+                self.duration_minutes, self.servings_count]
+
+    @classmethod
+    def from_record(cls, record: list):
+        """由 to_record() 的結果還原"""
+        recipe_id, name, description, hashtags, names, amounts, duration, servings = record
+        return cls(recipe_id, name, description, tuple(hashtags), tuple(names), tuple(amounts), duration, servings)
+
+
+class RecipeBodyFile:
+    """
+        完整食譜內容的磁碟檔 (只附加寫入的 orjson 記錄，依 (offset, 長度) 讀取)
+
+        檔案建立後立即刪除 (匿名暫存檔)，行程結束時自動回收；更新或刪除的舊版本留在檔案中，
+        直到下次啟動重新載入語料。
+    """
+
+    def __init__(self, directory: str | None = None):
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = tempfile.TemporaryFile(prefix="recipe_bodies_", dir=directory or None)
+        self._size = 0
+        # 讀寫共用同一個檔案位置
+        self._lock = threading.Lock()
+
+    def append(self, recipe: dict) -> tuple:
+        """寫入一筆食譜，回傳 (offset, 長度)"""
+        data = orjson.dumps(recipe)
+        with self._lock:
+            offset = self._size
+            self._file.seek(offset)
+            self._file.write(data)
+            self._size += len(data)
+        return offset, len(data)
+
+    def read(self, offset: int, length: int) -> dict:
+        with self._lock:
+            self._file.seek(offset)
+            data = self._file.read(length)
+        return orjson.loads(data)
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+
+class RecipeStore:
+    """
+        以 id 為索引的食譜儲存區
+
+        每筆食譜都有一個固定的列號(row)，所有嵌入矩陣都依照同一個列順序排列，
+        因此搜尋結果可以直接用列號取回食譜，不需要再線性掃描整個資料集。
+        刪除的食譜只留下空位 (None)，其他食譜的列號不變，直到以 compact() 重新編號。
+
+        記憶體中只保留搜尋用的欄位 (records，RecipeFields)；完整的食譜 (含步驟) 寫入 bodies
+        磁碟檔，at() / get() 時才讀取並解碼，每次回傳新的 dict。
+        copy() / compact() 產生的儲存區共用同一個 bodies (只附加寫入，舊快照讀到的內容不會改變)。
+
+        base 為上次 compact() (或載入) 時的儲存區，copy() 衍生的儲存區共用同一個 base，
+        以 changes_since_base() 取得之後變動的列 (依建置時語料建立的索引只需補上這些列)。
+    """
+
+    def __init__(self, recipes: Iterable[dict] = (), bodies: RecipeBodyFile | None = None):
+        self.bodies = bodies if bodies is not None else RecipeBodyFile()
+        self.base: RecipeStore | None = None
+        self.records: List[RecipeFields | None] = []
+        # 第 row 列的完整內容位於 bodies 的 [offsets[row], offsets[row] + lengths[row])
+        self.offsets = array('q')
+        self.lengths = array('q')
+        self.id_to_row: Dict[str, int] = {}
+        for recipe in recipes:
+            self.put(recipe)
+
+    def put(self, recipe: dict) -> int:
+        """新增或覆蓋一筆食譜 (需已經過 normalize_recipe)，回傳其列號 (重複的 id 以後出現者為準)"""
+        fields = RecipeFields.from_recipe(recipe)
+        offset, length = self.bodies.append(recipe)
+        row = self.id_to_row.get(fields.id)
+        if row is None:
+            row = len(self.records)
+            self.id_to_row[fields.id] = row
+            self.records.append(fields)
+            self.offsets.append(offset)
+            self.lengths.append(length)
+        else:
+            self.records[row] = fields
+            self.offsets[row] = offset
+            self.lengths[row] = length
+        return row
+
+    def delete(self, recipe_id: str) -> int | None:
+        """刪除一筆食譜，回傳其原本的列號 (不存在時回傳 None)"""
+        row = self.id_to_row.pop(recipe_id, None)
+        if row is not None:
+            self.records[row] = None
+        return row
+
+    def copy(self):
+        """複製列表與索引 (食譜內容不複製)，用於建立更新後的快照"""
+        store = RecipeStore(bodies=self.bodies)
+        store.records = list(self.records)
+        store.offsets = array('q', self.offsets)
+        store.lengths = array('q', self.lengths)
+        store.id_to_row = dict(self.id_to_row)
+        store.base = self.base or self
+        return store
+
+    def compact(self):
+        """移除已刪除的空位並重新編號，回傳新的 RecipeStore"""
+        store = RecipeStore(bodies=self.bodies)
+        for row, fields in enumerate(self.records):
+            if fields is not None:
+                store.id_to_row[fields.id] = len(store.records)
+                store.records.append(fields)
+                store.offsets.append(self.offsets[row])
+                store.lengths.append(self.lengths[row])
+        return store
+
+    def changes_since_base(self) -> List[tuple]:
+        """與 base 相比新增、更新或刪除的列 [(列號, 舊版本, 新版本)]，版本為 RecipeFields (不存在時為 None)"""
+        base = self.base or self
+        changes = []
+        for row, fields in enumerate(self.records):
+            old = base.records[row] if row < len(base.records) else None
+            # 未變動的列與 base 共用同一個 RecipeFields 物件
+            if fields is not old:
+                changes.append((row, old, fields))
+        return changes
+
+    def __len__(self) -> int:
+        """列數 (包含已刪除的空位)"""
+        return len(self.records)
+
+    def __iter__(self) -> Iterator[dict]:
+        """依列順序逐一取得完整食譜 (略過已刪除的空位，每筆都會從磁碟讀取)"""
+        return (self.at(row) for row, fields in enumerate(self.records) if fields is not None)
+
+    def __contains__(self, recipe_id: str) -> bool:
+        return recipe_id in self.id_to_row
+
+    def live_rows(self) -> np.ndarray:
+        """未刪除的列號"""
+        return np.array([row for row, fields in enumerate(self.records) if fields is not None], dtype=np.int64)
+
+    def row_of(self, recipe_id: str) -> int | None:
+        """取得食譜的列號，找不到時回傳 None"""
+        return self.id_to_row.get(recipe_id)
+
+    def fields(self, row: int) -> RecipeFields | None:
+        """依列號取得搜尋欄位 (已刪除的列為 None)"""
+        return self.records[row]
+
+    def at(self, row: int) -> dict | None:
+        """依列號取得完整食譜 (已刪除的列為 None)"""
+        if self.records[row] is None:
+            return None
+        return self.bodies.read(self.offsets[row], self.lengths[row])
+
+    def get(self, recipe_id: str) -> dict | None:
+        """依 id 取得食譜，找不到時回傳 None"""
+        row = self.id_to_row.get(recipe_id)
+        return None if row is None else self.at(row)
+
+    def rows_of(self, recipe_ids: Iterable[str]) -> np.ndarray:
+        """批次取得列號 (不存在的 id 為 -1)"""
+        return np.array([self.id_to_row.get(recipe_id, -1) for recipe_id in recipe_ids], dtype=np.int64)
+
+    def get_many(self, recipe_ids: Iterable[str]) -> List[dict]:
+        """依 id 批次取得食譜，保留輸入順序並略過不存在的 id"""
+        recipes = []
+        for recipe_id in recipe_ids:
+            row = self.id_to_row.get(recipe_id)
+            if row is not None:
+                recipes.append(self.at(row))
+        return recipes
+
+
+def write_mapped_store(recipes: Iterable[dict], out_dir: str) -> int:
+    """
+        將食譜寫成 MappedRecipeStore 的檔案格式，回傳筆數
+
+        recipes.bin: 每筆食譜的 JSON 依列順序串接
+        offsets.npy: 第 row 列位於 recipes.bin 的 [offsets[row], offsets[row + 1])
+        fields.bin / fields_offsets.npy: 同樣格式的搜尋欄位 (RecipeFields.to_record())，
+        建立索引與查詢時取欄位不必解碼含步驟的完整食譜
+        ids.npy / id_rows.npy: 排序後的 id 與對應的列號
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    offsets = [0]
+    fields_offsets = [0]
+    ids = []
+    with open(os.path.join(out_dir, "recipes.bin"), "wb") as f, \
+            open(os.path.join(out_dir, "fields.bin"), "wb") as fields_file:
+        for recipe in recipes:
+            data = orjson.dumps(recipe)
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+            record = orjson.dumps(RecipeFields.from_recipe(recipe).to_record())
+            fields_file.write(record)
+            fields_offsets.append(fields_offsets[-1] + len(record))
+            ids.append(recipe['id'])
+    order = np.argsort(np.array(ids, dtype=str), kind='stable')
+    np.save(os.path.join(out_dir, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(out_dir, "fields_offsets.npy"), np.asarray(fields_offsets, dtype=np.int64))
+    np.save(os.path.join(out_dir, "ids.npy"), np.array(ids, dtype=str)[order])
+    np.save(os.path.join(out_dir, "id_rows.npy"), order.astype(np.int64))
+    return len(ids)
+
+
+def _map_file(path: str):
+    """以唯讀 mmap 開啟檔案 (空檔案無法 mmap，回傳 b"")"""
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+
+
+class MappedRecipeStore:
+    """
+        以 mmap 開啟的唯讀食譜儲存區 (介面與 RecipeStore 相同)
+
+        檔案由 write_mapped_store() 產生。多個 worker 行程開啟同一份檔案時共用作業系統的
+        分頁快取，不需各自解析整個 JSON；食譜在取用時才解碼，每次回傳新的 dict。
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._blob = _map_file(os.path.join(directory, "recipes.bin"))
+        self.offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode='r')
+        # 較早發佈的目錄沒有 fields.bin，改由完整食譜解碼
+        self._fields_blob = None
+        if os.path.exists(os.path.join(directory, "fields.bin")):
+            self._fields_blob = _map_file(os.path.join(directory, "fields.bin"))
+            self.fields_offsets = np.load(os.path.join(directory, "fields_offsets.npy"), mmap_mode='r')
+        self.ids = np.load(os.path.join(directory, "ids.npy"), mmap_mode='r')
+        self.id_rows = np.load(os.path.join(directory, "id_rows.npy"), mmap_mode='r')
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __iter__(self) -> Iterator[dict]:
+        return (self.at(row) for row in range(len(self)))
+
+    def __contains__(self, recipe_id: str) -> bool:
+        return self.row_of(recipe_id) is not None
+
+    def live_rows(self) -> np.ndarray:
+        return np.arange(len(self), dtype=np.int64)
+
+    def fields(self, row: int) -> RecipeFields:
+        """依列號取得搜尋欄位 (只解碼 fields.bin 中的欄位)"""
+        if self._fields_blob is None:
+            return RecipeFields.from_recipe(self.at(row))
+        return RecipeFields.from_record(
+            orjson.loads(self._fields_blob[int(self.fields_offsets[row]):int(self.fields_offsets[row + 1])]))
+
+    def at(self, row: int) -> dict:
+        """依列號取得食譜"""
+        return orjson.loads(self._blob[int(self.offsets[row]):int(self.offsets[row + 1])])
+
+    def row_of(self, recipe_id: str) -> int | None:
+        """取得食譜的列號，找不到時回傳 None"""
+        i = int(np.searchsorted(self.ids, recipe_id))
+        if i < len(self.ids) and self.ids[i] == recipe_id:
+            return int(self.id_rows[i])
+        return None
+
+    def rows_of(self, recipe_ids: Iterable[str]) -> np.ndarray:
+        """批次取得列號 (不存在的 id 為 -1)"""
+        keys = np.array(list(recipe_ids), dtype=str)
+        if len(self.ids) == 0 or len(keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.ids, keys), len(self.ids) - 1)
+        return np.where(self.ids[positions] == keys, self.id_rows[positions], -1).astype(np.int64)
+
+    def get(self, recipe_id: str) -> dict | None:
+        """依 id 取得食譜，找不到時回傳 None"""
+        row = self.row_of(recipe_id)
+        return None if row is None else self.at(row)
+
+    def get_many(self, recipe_ids: Iterable[str]) -> List[dict]:
+        """依 id 批次取得食譜，保留輸入順序並略過不存在的 id"""
+        return [self.at(row) for row in self.rows_of(recipe_ids) if row >= 0]
@@ -0,0 +1,214 @@
+"""
+    獨立的模型推論行程
+
+    以多個 uvicorn worker 部署時，每個 worker 各自載入 SentenceTransformer 與 CLIP 會讓記憶體
+    隨 worker 數線性成長。推論行程只載入一份模型，worker 透過 UNIX socket 送出查詢:
+
+    > python remote_inference.py --socket /tmp/recipe-inference.sock
+    > RECIPE_INFERENCE_SOCKET=/tmp/recipe-inference.sock uvicorn main:app --workers 4
+
+    訊息格式: 4 bytes 標頭長度 (big-endian) + JSON 標頭 + 二進位內容
+        文字請求: {"op": "text", "texts": [...]}
+        圖片請求: {"op": "image", "sizes": [[寬, 高], ...]}，內容為串接的 RGB 像素
+        回應: {"shape": [n, d]} + float32 矩陣，或 {"error": "..."}
+"""
+import argparse
+import os
+import socket
+import socketserver
+import struct
+import threading
+from typing import List
+import numpy as np
+import orjson
+from PIL import Image
+
+_HEADER = struct.Struct(">I")
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("inference connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_message(sock: socket.socket, header: dict, payload: bytes = b""):
+    data = orjson.dumps({**header, 'payload': len(payload)})
+    sock.sendall(_HEADER.pack(len(data)) + data + payload)
+
+
+def recv_message(sock: socket.socket) -> tuple:
+    """回傳 (標頭, 內容)"""
+    (length,) = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    header = orjson.loads(_recv_exact(sock, length))
+    return header, _recv_exact(sock, header['payload'])
+
+
+class InferenceClient:
+    """
+        推論行程的客戶端
+
+        每個執行緒使用各自的連線。連線或送出請求失敗時 (例如推論行程重新啟動) 重新連線再送一次；
+        讀取回應時逾時或中斷則不重送 (推論可能已在進行)，直接拋出例外。
+    """
+
+    def __init__(self, socket_path: str, timeout: float = 60.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self) -> socket.socket:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            conn.settimeout(self.timeout)
+            try:
+                conn.connect(self.socket_path)
+            except OSError:
+                conn.close()
+                raise
+            self._local.conn = conn
+        return conn
+
+    def _close(self):
+        # 關閉後不再使用，之後的請求會建立新的連線 (舊連線上遲到的回應也一併丟棄)
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            conn.close()
+
+    def _request(self, header: dict, payload: bytes = b"") -> np.ndarray:
+        for attempt in range(2):
+            try:
+                conn = self._connection()
+                send_message(conn, header, payload)
+                break
+            except OSError:
+                self._close()
+                if attempt:
+                    raise
+        try:
+            response, data = recv_message(conn)
+        except OSError:
+            self._close()
+            raise
+        if 'error' in response:
+            raise RuntimeError(f"inference server error: {response['error']}")
+        return np.frombuffer(data, dtype=np.float32).reshape(response['shape'])
+
+    def encode_texts(self, texts: List[str]) -> np.ndarray:
+        return self._request({'op': 'text', 'texts': list(texts)})
+
+    def encode_images(self, images: List[Image.Image]) -> np.ndarray:
+        images = [image.convert("RGB") for image in images]
+        return self._request({'op': 'image', 'sizes': [image.size for image in images]},
+                             b"".join(image.tobytes() for image in images))
+
+
+class RemoteSentenceModel:
+    """以推論行程取代 SentenceTransformer (只提供 encode)"""
+
+    def __init__(self, client: InferenceClient):
+        self.client = client
+
+    def encode(self, texts: List[str], batch_size: int = 64, **kwargs) -> np.ndarray:
+        texts = list(texts)
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.concatenate([self.client.encode_texts(texts[i:i + batch_size])
+                               for i in range(0, len(texts), batch_size)])
+
+
+class RemoteImageEncoder:
+    """以推論行程取代 CLIP 圖片編碼器"""
+
+    def __init__(self, client: InferenceClient):
+        self.client = client
+
+    def encode(self, images: List[Image.Image]) -> np.ndarray:
+        return self.client.encode_images(images)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                header, payload = recv_message(self.request)
+            except (ConnectionError, OSError):
+                return
+            try:
+                result = self.server.encode(header, payload)
+                response = ({'shape': list(result.shape)}, result.tobytes())
+            except Exception as e:
+                print(f"Error in inference request: {e}")
+                response = ({'error': str(e)}, b"")
+            try:
+                send_message(self.request, *response)
+            except OSError:
+                # 客戶端已放棄這個請求 (例如逾時) 並關閉連線
+                return
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+        載入編碼器並以 UNIX socket 提供推論 (sentence_model / image_encoder 見 encoders.py)
+
+        每個模型同時只處理一個請求 (torch 與 onnxruntime 本身都會使用多個執行緒)，
+        worker 端的 MicroBatcher 已將同時到達的查詢合併為批次。
+    """
+
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, sentence_model=None, image_encoder=None):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, _Handler)
+        self.sentence_model = sentence_model
+        self.image_encoder = image_encoder
+        self._text_lock = threading.Lock()
+        self._image_lock = threading.Lock()
+
+    def encode(self, header: dict, payload: bytes) -> np.ndarray:
+        if header['op'] == 'text':
+            with self._text_lock:
+                return np.asarray(self.sentence_model.encode(header['texts'], batch_size=max(len(header['texts']), 1)),
+                                  dtype=np.float32)
+        if header['op'] == 'image':
+            images, offset = [], 0
+            for width, height in header['sizes']:
+                size = width * height * 3
+                images.append(Image.frombytes("RGB", (width, height), payload[offset:offset + size]))
+                offset += size
+            with self._image_lock:
+                return np.asarray(self.image_encoder.encode(images), dtype=np.float32)
+        raise ValueError(f"unknown op: {header['op']}")
+
+
+if __name__ == "__main__":
+    import config
+    import encoders
+    from search_engine import CLIP_MODEL_NAME, TEXT_MODEL_NAME
+
+    parser = argparse.ArgumentParser(description="以 UNIX socket 提供文字與圖片模型推論")
+    parser.add_argument("--socket", default="/tmp/recipe-inference.sock")
+    parser.add_argument("--no-text", action="store_true", help="不載入文字模型")
+    parser.add_argument("--no-image", action="store_true", help="不載入 CLIP 模型")
+    args = parser.parse_args()
+
+    # 依 RECIPE_ENCODER_BACKEND 載入 PyTorch 或 ONNX 編碼器
+    backend = (config.ENCODER_BACKEND, config.ONNX_DIR, config.ONNX_INT8, config.ONNX_THREADS)
+    sentence_model = None if args.no_text else encoders.load_text_encoder(TEXT_MODEL_NAME, *backend)
+    image_encoder = None if args.no_image else encoders.load_image_encoder(CLIP_MODEL_NAME, *backend)
+
+    server = InferenceServer(args.socket, sentence_model, image_encoder)
+    print(f"推論服務已啟動: {args.socket}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(args.socket)
@@ -1,197 +1,705 @@
-import json
-from typing import List, Dict
+import threading
+import time
+from typing import Iterable, Iterator, List, Dict
 import numpy as np
-from gensim.models import Word2Vec
 from PIL import Image
-from transformers import CLIPProcessor, CLIPModel
-from sentence_transformers import SentenceTransformer
-import jieba
-from collections import defaultdict
-import requests
-import io
-from chromadb import PersistentClient
+import os
+from recipe_filter import FilterIndex, RecipeFilter
+from recipe_store import RecipeFields, RecipeStore, normalize_recipe
+from corpus_loader import load_store, write_json_array
+from corpus_snapshot import CorpusSnapshot, IngredientState, UpdateJournal, apply_update
+from remote_inference import RemoteImageEncoder, RemoteSentenceModel
+from shared_corpus import ReadOnlyCorpusError, SharedCorpus
+from suggest_index import SUGGEST_TYPES, SuggestIndex
+from tokenization import IngredientTokenizer
+from embedding_cache import TextEmbeddingCache
+from query_cache import LRUCache, normalize_query
+from projection import project_recipe
+import config
+import encoders
+import ingredient_model
+import metrics
+import quantization
+import vector_index
+from fusion import reciprocal_rank_fusion, top_k_indices, weighted_score_fusion
+from image_pipeline import COLLECTION_NAME, ImageFetcher, ImageVectorPipeline, filter_metadata_synced
+from modalities import MODALITIES, ModalityState, ModalityUnavailableError
+
+TEXT_MODEL_NAME = 'paraphrase-multilingual-MiniLM-L12-v2'
+CLIP_MODEL_NAME = 'openai/clip-vit-base-patch32'
+
+
+# 文字搜尋結果中的食譜欄位與缺少時的預設值
+TEXT_RESULT_FIELDS = {
+    'id': '', 'name': '', 'description': '', 'image': '', 'duration': '', 'servings': '',
+    'hashtags': [], 'ingredients': [], 'steps': [],
+}
+
+
+def _filter_key(filters: RecipeFilter | None) -> tuple | None:
+    """篩選條件在快取鍵中的部分"""
+    return filters.key() if filters else None
+
+
+def recipe_text(recipe: RecipeFields) -> str:
+    """組合食譜名稱、描述和標籤作為文字嵌入的輸入"""
+    text_parts = [
+        recipe.name,
+        recipe.description
+    ]
+    text_parts.extend(recipe.hashtags)
+    return ' '.join(text_parts)
+
 
 class RecipeSearchEngine:
-    def __init__(self, data_path: str, image_vector_reload = False):
-        # 載入食譜資料
-        with open(data_path, "r", encoding='utf-8') as f:
-            data = json.load(f)
-            # 過濾重複的id
-            self.data = list({d['id']: d for d in data}.values())
-
-        # 初始化模型
-        self.sentence_model = SentenceTransformer(
-            'paraphrase-multilingual-MiniLM-L12-v2')
-        self.clip_model = CLIPModel.from_pretrained(
-            "openai/clip-vit-base-patch32")
-        self.clip_processor = CLIPProcessor.from_pretrained(
-            "openai/clip-vit-base-patch32")
-        
-        # 初始化 ChromaDB，啟用持久化存儲
-        self.client = PersistentClient()
-        self.collection = self.client.get_or_create_collection("recipe_image_vectors")
+    def __init__(self, data_path: str, image_vector_reload = False, cache_dir: str = "./cache",
+                 modalities: Iterable[str] | None = None,
+                 sentence_model=None, clip_model=None, clip_processor=None, chroma_client=None,
+                 shared_dir: str | None = None, inference_client=None):
+        """
+            建立搜尋引擎，只載入食譜資料
+
+            各模態的模型在第一次使用時 (或呼叫 warmup() 時) 才載入，
+            modalities 指定要啟用的模態，預設依 config.MODALITIES。
+            sentence_model / clip_model / clip_processor / chroma_client 可傳入現成的物件
+            (例如 benchmark 使用的 stub) 取代預設模型；未傳入時依 config.ENCODER_BACKEND
+            載入 PyTorch 或 ONNX 編碼器 (encoders.py)。
 
-        # 初始化食材向量化
-        self.ingredient_tokenizer = jieba.Tokenizer()
-        # 加入常見的食材單位到停用詞
-        self.units = {'克', '公克', 'g', '條', '片', '個', '顆', '些', '適量',
-                      '份', '兩', '斤', '匙', '湯匙', '茶匙', '杯', 'ml', '毫升', '公升', '把'}
+            食譜與搜尋索引放在不可變的 CorpusSnapshot 中，增量更新時建立新的快照再整個替換，
+            查詢開始時取得的快照在查詢期間不會改變。
 
+            shared_dir 指向 shared_corpus.py 發佈的目錄時，食譜與各模態的資料直接以 mmap 附加
+            (忽略 data_path 與 cache_dir，語料為唯讀)；inference_client 不為 None 時
+            模型推論交給獨立的推論行程 (remote_inference.py)。
+        """
+        self.created_at = time.perf_counter()
+        self.ready_at: float | None = None
+
+        # 載入食譜資料 (共用模式下直接附加 loader 發佈的食譜)
+        self.shared = SharedCorpus(shared_dir) if shared_dir else None
+        with metrics.startup_phase('load_corpus'):
+            if self.shared is not None:
+                self.snapshot = CorpusSnapshot(self.shared.store)
+                cache_dir = self.shared.manifest['cache_dir']
+            else:
+                self.snapshot = CorpusSnapshot(self._load_corpus(data_path, cache_dir))
+        # 更新與快照替換互斥，讀取端不需要鎖
+        self._write_lock = threading.Lock()
+        # 同時間只有一個重新建置；建置期間進來的更新另外記在 _pending_updates [(op, payload)]
+        self._rebuild_lock = threading.Lock()
+        self._pending_updates: List[tuple] | None = None
+        # 自動完成與篩選索引只建立一次
+        self._index_lock = threading.Lock()
+        self.data_path = data_path
+        self.journal = UpdateJournal(data_path + ".updates.jsonl")
+        self.corpus_load_seconds = time.perf_counter() - self.created_at
+
+        # 搜尋結果與查詢嵌入快取，語料或模型變動時以 cache_generation 使其失效
+        self.cache_generation = 0
+        self.result_cache = LRUCache(config.RESULT_CACHE_SIZE, config.RESULT_CACHE_TTL)
+        self.query_embedding_cache = LRUCache(config.EMBEDDING_CACHE_SIZE, config.EMBEDDING_CACHE_TTL)
+
+        self.cache_dir = cache_dir
+        self.inference_client = inference_client
+        if sentence_model is None and inference_client is not None:
+            sentence_model = RemoteSentenceModel(inference_client)
+        self.sentence_model = sentence_model
+        # CLIP 圖片編碼器 (提供 encode(images))
+        self.image_encoder = None
+        if inference_client is not None:
+            self.image_encoder = RemoteImageEncoder(inference_client)
+        elif clip_model is not None and clip_processor is not None:
+            self.image_encoder = encoders.ClipImageEncoder(clip_model, clip_processor)
+        self.client = chroma_client
+        self.image_vector_reload = image_vector_reload
+        self.text_embedding_cache = TextEmbeddingCache(
+            cache_dir, encoders.text_cache_name(TEXT_MODEL_NAME, config.ENCODER_BACKEND, config.ONNX_INT8))
+
+        # 初始化食材向量化 (含自訂食材詞典與斷詞快取，單位詞在清理時移除)
+        self.ingredient_tokenizer = IngredientTokenizer(config.INGREDIENT_DICT)
+        self.units = self.ingredient_tokenizer.units
+        self.ingredient_model_dir = os.path.join(cache_dir, "ingredient_model")
+        self.image_checkpoint_path = os.path.join(cache_dir, "image_vectors.checkpoint")
+
+        # 各模態延遲載入
+        enabled = set(config.MODALITIES if modalities is None else modalities)
+        loaders = {'text': self._load_text, 'ingredient': self._load_ingredient, 'image': self._load_image}
+        self.modalities = {name: ModalityState(name, loaders[name], name in enabled, config.MODALITY_RETRY_SECONDS)
+                           for name in MODALITIES}
+
+    @staticmethod
+    def _load_corpus(data_path: str, body_dir: str) -> RecipeStore:
+        # 串流載入並去除重複的 id，所有嵌入矩陣都依照 store 的列順序排列
+        # (完整的食譜內容寫入 body_dir 下的暫存檔，記憶體中只保留搜尋欄位)
+        store = load_store(data_path, body_dir)
+        # 重播上次重新建置之後透過 API 進行的更新 (不重新編號，store.base 仍是資料檔中的語料)
+        updated = store.copy()
+        if UpdateJournal(data_path + ".updates.jsonl").replay(updated):
+            store = updated
+        return store
+
+    @property
+    def store(self) -> RecipeStore:
+        """目前快照的食譜儲存區"""
+        return self.snapshot.store
+
+    def iter_recipes(self) -> Iterator[dict]:
+        """依列順序逐一取得目前所有的食譜 (每次從磁碟讀取一筆，不會一次載入整個語料)"""
+        store = self.snapshot.store
+        return (store.at(row) for row in store.live_rows().tolist())
+
+    def _load_text(self):
+        """載入文字編碼器並建立 (或從快取載入) 文本嵌入"""
+        if self.sentence_model is None:
+            self.sentence_model = encoders.load_text_encoder(
+                TEXT_MODEL_NAME, config.ENCODER_BACKEND, config.ONNX_DIR, config.ONNX_INT8, config.ONNX_THREADS)
         # 預處理所有食譜文字
         self.preprocess_recipe_texts()
 
+    def _load_image(self):
+        """載入 CLIP 圖片編碼器與 ChromaDB"""
+        if self.image_encoder is None:
+            self.image_encoder = encoders.load_image_encoder(
+                CLIP_MODEL_NAME, config.ENCODER_BACKEND, config.ONNX_DIR, config.ONNX_INT8, config.ONNX_THREADS)
+
+        # 初始化 ChromaDB，啟用持久化存儲
+        if self.client is None:
+            from chromadb import PersistentClient
+
+            self.client = PersistentClient()
+        self.collection = self.client.get_or_create_collection(COLLECTION_NAME)
+
         # 預處理所有圖片
-        if image_vector_reload: self.precompute_image_vectors()
-     
-        # 初始化食材向量化
+        if self.image_vector_reload: self._precompute_image_vectors()
+        else: self._sync_image_metadata()
+
+    def _load_ingredient(self):
+        """載入食材 Word2Vec 產物"""
         self.initialize_ingredients()
-    
-    def _fetch_image(self, url: str) -> io.BytesIO:
+
+    def ensure_modality(self, name: str):
+        """確保模態已載入，停用或載入失敗時拋出 ModalityUnavailableError"""
+        self.modalities[name].ensure()
+        if self.ready_at is None and self.is_ready():
+            self.ready_at = time.perf_counter()
+
+    def warmup(self, background: bool = True) -> List[threading.Thread]:
+        """載入所有啟用的模態並建立自動完成與篩選索引，background 為 True 時各自在背景執行緒中載入"""
+        def load(name):
+            try:
+                self.ensure_modality(name)
+            except Exception:
+                pass
+
+        names = [name for name, state in self.modalities.items() if state.enabled]
+        if not background:
+            for name in names:
+                self.ensure_modality(name)
+            self.ensure_suggest_index()
+            self.ensure_filter_index()
+            return []
+        threads = [threading.Thread(target=load, args=(name,), name=f"warmup-{name}", daemon=True)
+                   for name in names]
+        threads.append(threading.Thread(target=self.ensure_suggest_index, name="warmup-suggest", daemon=True))
+        threads.append(threading.Thread(target=self.ensure_filter_index, name="warmup-filters", daemon=True))
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def is_ready(self) -> bool:
+        """所有啟用的模態是否都已載入"""
+        return all(state.ready for state in self.modalities.values() if state.enabled)
+
+    def modality_status(self) -> dict:
+        """各模態的載入狀態與時間"""
+        return {
+            'ready': self.is_ready(),
+            'corpus_load_seconds': self.corpus_load_seconds,
+            'shared': self.shared is not None,
+            'cold_start_seconds': self.ready_at - self.created_at if self.ready_at is not None else None,
+            'modalities': {name: state.to_dict() for name, state in self.modalities.items()},
+            'indexes': {name: index.stats() for name, index in
+                        (('text', self.snapshot.text),
+                         ('ingredient', self.snapshot.ingredient and self.snapshot.ingredient.vectors))
+                        if index is not None}
+        }
+
+    def _load_vector_index(self, vectors, path: str, source_id: str):
+        """依設定建立 (或從磁碟載入) 向量搜尋索引"""
+        return vector_index.load_or_build(
+            vectors, path, source_id, config.VECTOR_INDEX, config.ANN_MIN_ROWS,
+            M=config.HNSW_M, ef_construction=config.HNSW_EF_CONSTRUCTION, ef=config.HNSW_EF)
+
+    def _install(self, name: str, build):
+        """
+            以 build(store) 建立模態的索引並放入快照
+
+            建立期間若有其他更新替換了快照，就以新的 store 重新建立，避免遺失更新。
         """
-            从给定的URL下载图片并显示。
+        while True:
+            store = self.snapshot.store
+            state = build(store)
+            with self._write_lock:
+                if self.snapshot.store is store:
+                    self.snapshot = self.snapshot.replace(**{name: state})
+                    return
+
+    def invalidate_caches(self):
+        """語料或模型變動後清除搜尋結果與查詢嵌入快取"""
+        self.cache_generation += 1
+        self.result_cache.clear()
+        self.query_embedding_cache.clear()
+
+    def cache_stats(self) -> dict:
+        """快取命中統計"""
+        return {
+            'generation': self.cache_generation,
+            'results': self.result_cache.stats(),
+            'query_embeddings': self.query_embedding_cache.stats()
+        }
 
-            参数:
-            url (str): 图片的URL地址
-         """
-        response = requests.get(url)
-        return io.BytesIO(response.content)
+    def get_recipe(self, recipe_id: str) -> dict | None:
+        """依 id 取得食譜，找不到時回傳 None"""
+        return self.store.get(recipe_id)
 
+    def get_recipes(self, recipe_ids: List[str]) -> List[dict]:
+        """依 id 批次取得食譜，保留輸入順序"""
+        return self.store.get_many(recipe_ids)
 
     def preprocess_recipe_texts(self):
         """預處理所有食譜文字,建立文本嵌入"""
-        texts = []
-        # 確保所有必要欄位都有值
-        for recipe in self.data:
-            # 處理可能為 None 的欄位
-            recipe['name'] = recipe.get('name', '') or ''
-            recipe['description'] = recipe.get('description', '') or ''
-            recipe['hashtags'] = recipe.get('hashtags', []) or []
-
-            # 組合食譜名稱、描述和標籤
-            text_parts = [
-                recipe['name'],
-                recipe['description']
-            ]
-            text_parts.extend(recipe['hashtags'])
-
-            texts.append(' '.join(text_parts))
-
-        # 使用 sentence-transformer 產生文本嵌入
-        self.text_embeddings = self.sentence_model.encode(texts)
+        with metrics.startup_phase('preprocess_recipe_texts'):
+            self._preprocess_recipe_texts()
+        self.invalidate_caches()
+
+    def _preprocess_recipe_texts(self):
+        self._install('text', self._build_text_index)
+
+    def _build_text_index(self, store: RecipeStore) -> vector_index.OverlayIndex:
+        """為 store 中的所有食譜建立文字嵌入索引"""
+        if self.shared is not None:
+            # 直接附加 loader 建立的嵌入矩陣
+            rows = np.arange(len(store), dtype=np.int64)
+            text_embeddings = self.text_embedding_cache.load_published(self.shared.text_digest)
+        else:
+            rows = store.live_rows()
+            texts = [recipe_text(store.fields(row)) for row in rows]
+
+            # 使用 sentence-transformer 產生文本嵌入，只重新編碼快取中沒有的文字
+            text_embeddings = self.text_embedding_cache.load(
+                texts, lambda batch: self.sentence_model.encode(batch, batch_size=64))
+        # 依設定改以 float16 / int8 儲存 (text_embeddings 可能是 ndarray 或 QuantizedMatrix)
+        mode = config.TEXT_VECTOR_DTYPE
+        digest = self.text_embedding_cache.digest()
+        text_embeddings = quantization.load_or_quantize(
+            text_embeddings, self.text_embedding_cache.quantized_prefix(mode), mode,
+            digest, config.QUANTIZATION_MIN_RECALL)
+        index = self._load_vector_index(
+            text_embeddings, self.text_embedding_cache.index_prefix(), f"{digest}:{mode}")
+        return vector_index.OverlayIndex(index, np.asarray(rows, dtype=np.int64))
     
-    def precompute_image_vectors(self):
-        """將所有圖片轉為向量並存儲到 ChromaDB"""
-        for recipe in self.data:
-            if recipe.get("image"):
-                try:
-                    image = Image.open(self._fetch_image(recipe["image"]))
-                    inputs = self.clip_processor(images=image, return_tensors="pt")
-                    image_features = self.clip_model.get_image_features(**inputs).detach().numpy()
-                    
-                    # 將向量存儲到 ChromaDB 中
-                    self.collection.add(
-                        ids=[recipe["id"]],
-                        embeddings=image_features.tolist(),
-                        metadatas=[{"name": recipe["name"], "description": recipe["description"]}]
-                    )
-                except Exception as e:
-                    print(f"Error processing image for recipe {recipe['id']}: {e}")
+    def precompute_image_vectors(self, image_dir: str | None = None, base_url: str | None = None,
+                                 download_workers: int = 8, batch_size: int = 32) -> dict:
+        """
+            將所有圖片轉為向量並存儲到 ChromaDB
+
+            已存在於 collection 中的食譜會被略過，可中斷後繼續執行。
+            image_dir / base_url 可改由本機目錄或替代的 HTTP 伺服器取得圖片。
+        """
+        self.ensure_modality('image')
+        return self._precompute_image_vectors(image_dir, base_url, download_workers, batch_size)
+
+    def _precompute_image_vectors(self, image_dir: str | None = None, base_url: str | None = None,
+                                  download_workers: int = 8, batch_size: int = 32) -> dict:
+        pipeline = ImageVectorPipeline(
+            self.image_encoder,
+            self.collection,
+            ImageFetcher(image_dir=image_dir, base_url=base_url, pool_size=download_workers),
+            download_workers=download_workers,
+            batch_size=batch_size,
+            checkpoint_path=self.image_checkpoint_path,
+        )
+        with metrics.startup_phase('precompute_image_vectors'):
+            return pipeline.run(self.store)
+
+    def _sync_image_metadata(self):
+        """
+            舊版建立的 collection 沒有 duration / servings metadata，載入時補寫一次 (不重新計算向量)
+
+            補寫完成前 (或失敗時) 圖片搜尋的數值條件改以 mask 篩選，不交給 ChromaDB。
+        """
+        if not filter_metadata_synced(self.collection):
+            pipeline = self._image_pipeline()
+            try:
+                with metrics.startup_phase('sync_image_metadata'):
+                    pipeline.sync_metadata(recipe for recipe in self.iter_recipes() if recipe.get("image"))
+                    pipeline.mark_metadata_synced()
+            except Exception as e:
+                print(f"Error syncing image metadata: {e}")
+
+    def _image_filter_where(self, filters: RecipeFilter) -> dict | None:
+        """數值條件的 ChromaDB where，collection 的 metadata 還沒有篩選欄位時為 None"""
+        if not filter_metadata_synced(self.collection):
+            return None
+        return filters.chroma_where()
+
+    def _image_pipeline(self) -> ImageVectorPipeline:
+        return ImageVectorPipeline(self.image_encoder, self.collection, ImageFetcher(),
+                                   checkpoint_path=self.image_checkpoint_path)
 
     def clean_ingredient_name(self, name: str) -> str:
         """清理食材名稱，移除單位詞"""
-        if not name:
-            return ""
-        tokens = list(self.ingredient_tokenizer.cut(name))
-        return "".join([t for t in tokens if t not in self.units])
+        return self.ingredient_tokenizer.clean(name)
+
+    def ingredient_tokens(self, name: str) -> List[str]:
+        """將食材名稱清理後斷詞"""
+        return list(self.ingredient_tokenizer.tokens(name))
 
     def initialize_ingredients(self):
-        """初始化並訓練食材的Word2Vec模型"""
-        # 收集所有食材列表
-        all_ingredients = []
-        self.ingredient_to_recipes = defaultdict(list)
-        self.recipe_ingredients = {}  # 儲存每個食譜的原始食材資訊
-
-        for recipe in self.data:
-            if 'ingredients' in recipe and recipe['ingredients']:
-                # 儲存原始食材資訊
-                self.recipe_ingredients[recipe['id']] = recipe['ingredients']
-
-                # 處理食材名稱
-                recipe_ingredients = []
-                for ing in recipe['ingredients']:
-                    if ing.get('name'):
-                        clean_name = self.clean_ingredient_name(ing['name'])
-                        if clean_name:
-                            tokens = list(
-                                self.ingredient_tokenizer.cut(clean_name))
-                            recipe_ingredients.extend(tokens)
-                            # 建立食材到食譜的映射
-                            for token in tokens:
-                                self.ingredient_to_recipes[token].append({
-                                    'recipe_id': recipe['id'],
-                                    'amount': ing.get('amount', '適量')
-                                })
-
-                if recipe_ingredients:
-                    all_ingredients.append(recipe_ingredients)
-
-        # 訓練Word2Vec模型
-        self.ingredient_model = Word2Vec(
-            sentences=all_ingredients,
-            vector_size=100,
-            window=5,
-            min_count=1,
-            workers=4
-        )
+        """載入食材的Word2Vec模型產物 (語料變動時才重新訓練)"""
+        self._install('ingredient', self._build_ingredient_state)
+        self.invalidate_caches()
+
+    def _build_ingredient_state(self, store: RecipeStore) -> IngredientState:
+        """
+            為 store 中的所有食譜載入 (或建置) 食材模型產物與食譜向量索引
+
+            產物對應 store.base (上次重新建置時的語料)，之後的更新 (包含啟動時重播的 journal)
+            與執行期間的更新一樣以 IngredientState.with_updates 補上，只有 rebuild() 會重新訓練。
+        """
+        base = store
+        with metrics.startup_phase('initialize_ingredients'):
+            if self.shared is not None:
+                rows = np.arange(len(store), dtype=np.int64)
+                artifact = ingredient_model.IngredientArtifact.load(
+                    self.ingredient_model_dir, self.shared.ingredient_fingerprint)
+                if artifact is None:
+                    raise RuntimeError("ingredient artifact does not match the shared corpus, re-run shared_corpus.py")
+            else:
+                base = store.base or store
+                rows = base.live_rows()
+                artifact = ingredient_model.load_or_build(
+                    [base.fields(row) for row in rows], self.ingredient_tokenizer, self.ingredient_model_dir,
+                    config.TOKENIZE_WORKERS)
+
+        # 預計算且已正規化的食譜食材向量矩陣 (以 mmap 載入，多個 worker 共用同一份記憶體分頁)
+        mode = config.INGREDIENT_VECTOR_DTYPE
+        recipe_vector_matrix = quantization.load_or_quantize(
+            artifact.recipe_vectors, os.path.join(self.ingredient_model_dir, f"recipe_vectors.{mode}"), mode,
+            artifact.fingerprint, config.QUANTIZATION_MIN_RECALL)
+        index = self._load_vector_index(
+            recipe_vector_matrix, os.path.join(self.ingredient_model_dir, "recipe_vectors.index"),
+            f"{artifact.fingerprint}:{mode}")
+        # 每一個食譜向量對應的 store 列號 (base 之後沒有重新編號，列號相同)
+        vector_rows = base.rows_of(artifact.recipe_ids)
+
+        # 食材倒排索引: 食材詞 -> 全域食材編號，改以 store 列號排列 (已刪除的列沒有食材)
+        counts = np.zeros(len(store), dtype=np.int64)
+        counts[rows] = np.diff(artifact.ingredient_offsets)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        state = IngredientState(artifact, vector_index.OverlayIndex(index, vector_rows), offsets)
+        if base is not store:
+            changes = store.changes_since_base()
+            state = state.with_updates([(row, self._ingredient_entries(new)) for row, _, new in changes])
+        return state
+
+    def _ingredient_entries(self, recipe: RecipeFields | None) -> List[tuple] | None:
+        """食譜的每個食材斷詞結果 [(位置, 詞列表)]，食譜為 None 時回傳 None"""
+        if recipe is None:
+            return None
+        entries = []
+        for position, name in enumerate(recipe.ingredient_names):
+            if name:
+                tokens = self.ingredient_tokens(name)
+                if tokens:
+                    entries.append((position, tokens))
+        return entries
+
+    def _apply_updates(self, snap: CorpusSnapshot, store: RecipeStore, changes: List[tuple]) -> CorpusSnapshot:
+        """
+            依 changes [(store 列號, 舊版本, 新版本)] 建立新的快照 (不修改 snap)，版本為 RecipeFields
+
+            新增時舊版本為 None，刪除時新版本為 None。尚未載入的模態在載入時會直接以新的 store 建立。
+        """
+        text = snap.text
+        if text is not None:
+            upserts = [(row, new) for row, _, new in changes if new is not None]
+            vectors = np.empty((0, text.dim), dtype=np.float32)
+            if upserts:
+                vectors = np.asarray(self.sentence_model.encode(
+                    [recipe_text(recipe) for _, recipe in upserts], batch_size=64), dtype=np.float32)
+            text = text.with_updates([row for row, _ in upserts], list(vectors),
+                                     [row for row, _, new in changes if new is None])
+
+        ingredient = snap.ingredient
+        if ingredient is not None:
+            ingredient = ingredient.with_updates([(row, self._ingredient_entries(new)) for row, _, new in changes])
+
+        suggest = snap.suggest
+        if suggest is not None:
+            suggest = suggest.with_updates([(old, new) for _, old, new in changes], self._clean_corpus_name)
+
+        filters = snap.filters
+        if filters is not None:
+            filters = filters.with_updates([(row, new) for row, _, new in changes], self._recipe_tokens)
+
+        return CorpusSnapshot(store, text, ingredient, suggest, filters)
+
+    def _publish(self, snapshot: CorpusSnapshot):
+        """替換目前的快照 (需持有 _write_lock)"""
+        self.snapshot = snapshot
+        self.invalidate_caches()
+
+    def _record_update(self, op: str, payload):
+        """將更新寫入 journal，重新建置期間同時記下來以便套用到新的快照 (需持有 _write_lock)"""
+        self.journal.append(op, payload)
+        if self._pending_updates is not None:
+            self._pending_updates.append((op, payload))
+
+    def _image_collection(self):
+        """取得可寫入的 ChromaDB collection，圖片模態停用或無法載入時回傳 None"""
+        if not self.modalities['image'].enabled:
+            return None
+        try:
+            self.ensure_modality('image')
+        except ModalityUnavailableError as e:
+            print(f"略過圖片向量更新: {e}")
+            return None
+        return self.collection
+
+    def _check_writable(self):
+        if self.shared is not None:
+            raise ReadOnlyCorpusError("corpus is read-only in shared mode, re-run shared_corpus.py to publish changes")
+
+    def upsert_recipes(self, recipes: List[dict]) -> List[dict]:
+        """
+            新增或更新食譜 (依 id 判斷)，回傳寫入的食譜
+
+            文字嵌入、食材向量與倒排索引在新的快照中更新後一次替換；
+            詞彙外的新食材詞以估計向量代替，直到 rebuild() 重新訓練 Word2Vec。
+            圖片向量在快照替換後寫入 ChromaDB (只處理新增或圖片網址改變的食譜)。
+        """
+        self._check_writable()
+        # 同一批中重複的 id 以後出現者為準
+        recipes = list({recipe['id']: recipe for recipe in map(normalize_recipe, recipes)}.values())
+        if not recipes:
+            return []
+        with self._write_lock:
+            snap = self.snapshot
+            store = snap.store.copy()
+            previous = [snap.store.get(recipe['id']) for recipe in recipes]
+            changes = []
+            for recipe, old in zip(recipes, previous):
+                row = store.put(recipe)
+                changes.append((row, old and RecipeFields.from_recipe(old), store.fields(row)))
+            snapshot = self._apply_updates(snap, store, changes)
+            self._record_update('put', recipes)
+            self._publish(snapshot)
+
+        changed_images = [recipe for recipe, old in zip(recipes, previous)
+                          if recipe.get('image') and (old is None or old.get('image') != recipe['image'])]
+        if changed_images and self._image_collection() is not None:
+            self._image_pipeline().run(changed_images, force=True)
+        return recipes
+
+    def delete_recipes(self, recipe_ids: List[str]) -> List[str]:
+        """刪除食譜，回傳實際刪除的 id"""
+        self._check_writable()
+        with self._write_lock:
+            snap = self.snapshot
+            store = snap.store.copy()
+            changes = []
+            for recipe_id in dict.fromkeys(recipe_ids):
+                row = store.delete(recipe_id)
+                if row is not None:
+                    changes.append((row, snap.store.fields(row), None))
+            if not changes:
+                return []
+            deleted = [old.id for _, old, _ in changes]
+            snapshot = self._apply_updates(snap, store, changes)
+            self._record_update('delete', deleted)
+            self._publish(snapshot)
+
+        collection = self._image_collection()
+        if collection is not None:
+            collection.delete(ids=deleted)
+        return deleted
+
+    def rebuild(self) -> dict:
+        """
+            以目前的食譜重新建置所有已載入的索引
+
+            重新訓練 Word2Vec (新的食材詞從此有自己的向量)、移除刪除留下的空位與累積的 delta，
+            並將食譜寫回資料檔。
+
+            新的索引在 _write_lock 之外建置，期間查詢照常使用舊的快照，新增、更新與刪除也不會被擋住；
+            建置完成後才取得鎖，把建置期間進來的更新套用到新的快照再替換，journal 只留下這些更新。
+        """
+        self._check_writable()
+        start = time.perf_counter()
+        builders = {'text': self._build_text_index, 'ingredient': self._build_ingredient_state,
+                    'suggest': self._build_suggest_index, 'filters': self._build_filter_index}
+        with self._rebuild_lock:
+            with self._write_lock:
+                snap = self.snapshot
+                self._pending_updates = []
+            try:
+                store = snap.store.compact()
+                data_tmp_path = self.data_path + ".rebuild"
+                write_json_array(store, data_tmp_path)
+                built = {}
+                current = snap
+                while True:
+                    # 建置期間才載入的模態也要以新的 store 建立
+                    for name, build in builders.items():
+                        if name not in built and getattr(current, name) is not None:
+                            built[name] = build(store)
+                    with self._write_lock:
+                        current = self.snapshot
+                        if any(name not in built and getattr(current, name) is not None for name in builders):
+                            continue
+                        updated = store.copy()
+                        for op, payload in self._pending_updates:
+                            apply_update(updated, op, payload)
+                        snapshot = CorpusSnapshot(store, **built)
+                        changes = updated.changes_since_base()
+                        if changes:
+                            snapshot = self._apply_updates(snapshot, updated, changes)
+                        os.replace(data_tmp_path, self.data_path)
+                        self.journal.reset(self._pending_updates)
+                        self._pending_updates = None
+                        self._publish(snapshot)
+                        break
+            finally:
+                with self._write_lock:
+                    self._pending_updates = None
+        return {'recipes': len(store), 'seconds': time.perf_counter() - start}
+
+    def _clean_corpus_name(self, name: str) -> str:
+        return self.ingredient_tokenizer.clean(name, cached=False)
 
-        # 預計算所有食譜的食材向量
-        self.recipe_ingredient_vectors = {}
-        for recipe in self.data:
-            if 'ingredients' in recipe and recipe['ingredients']:
-                vectors = []
-                for ing in recipe['ingredients']:
-                    if ing.get('name'):
-                        clean_name = self.clean_ingredient_name(ing['name'])
-                        if clean_name:
-                            tokens = list(
-                                self.ingredient_tokenizer.cut(clean_name))
-                            # 取每個食材詞的平均向量
-                            token_vectors = []
-                            for token in tokens:
-                                if token in self.ingredient_model.wv:
-                                    token_vectors.append(
-                                        self.ingredient_model.wv[token])
-                            if token_vectors:
-                                vectors.append(np.mean(token_vectors, axis=0))
-
-                if vectors:
-                    self.recipe_ingredient_vectors[recipe['id']] = np.mean(
-                        vectors, axis=0)
-
-    def get_similar_ingredients(self, ingredient: str, top_k: int = 5) -> List[Dict]:
-        """找出相似的食材，並返回使用這些食材的食譜"""
-        clean_ing = self.clean_ingredient_name(ingredient)
-        tokens = list(self.ingredient_tokenizer.cut(clean_ing))
-        similar_ingredients = []
-
-        for token in tokens:
-            if token in self.ingredient_model.wv:
-                # 找出相似的食材詞
-                similar = self.ingredient_model.wv.most_similar(
-                    token, topn=top_k)
-                for word, score in similar:
-                    # 找出使用該食材的食譜
-                    # 只取前5個食譜
-                    recipe_refs = self.ingredient_to_recipes[word][:5]
+    def _build_suggest_index(self, store: RecipeStore) -> SuggestIndex:
+        """以 store 中的食譜名稱、標籤與清理後的食材名稱建立自動完成索引"""
+        with metrics.startup_phase('build_suggest_index'):
+            return SuggestIndex.build(map(store.fields, store.live_rows()), self._clean_corpus_name)
+
+    def suggest_ready(self) -> bool:
+        """自動完成索引是否已建立"""
+        return self.snapshot.suggest is not None
+
+    def _ensure_index(self, name: str, build):
+        # 快照中還沒有該索引時建立一次 (不需要載入任何模型)
+        if getattr(self.snapshot, name) is None:
+            with self._index_lock:
+                if getattr(self.snapshot, name) is None:
+                    self._install(name, build)
+
+    def ensure_suggest_index(self):
+        """建立自動完成索引"""
+        self._ensure_index('suggest', self._build_suggest_index)
+
+    def _recipe_tokens(self, recipe: RecipeFields) -> frozenset:
+        """食譜所有食材的食材詞"""
+        return frozenset(token for name in recipe.ingredient_names if name
+                         for token in self.ingredient_tokens(name) if token.strip())
+
+    def _build_filter_index(self, store: RecipeStore) -> FilterIndex:
+        """以 store 中的料理時間、份量、標籤與食材詞建立篩選索引"""
+        with metrics.startup_phase('build_filter_index'):
+            rows = store.live_rows()
+            records = [store.fields(row) for row in rows]
+            # 語料中的食材名稱先放進 token table (與食材模型共用)，之後逐筆查表
+            self.ingredient_tokenizer.token_table(
+                (name for recipe in records for name in recipe.ingredient_names), config.TOKENIZE_WORKERS)
+            return FilterIndex.build(len(store), zip(rows.tolist(), records), self._recipe_tokens)
+
+    def ensure_filter_index(self):
+        """建立屬性篩選索引"""
+        self._ensure_index('filters', self._build_filter_index)
+
+    def _filter_mask(self, snap: CorpusSnapshot, filters: RecipeFilter | None) -> np.ndarray | None:
+        """符合篩選條件的 store 列 (布林陣列)，沒有條件時回傳 None (呼叫端需先 ensure_filter_index)"""
+        if not filters:
+            return None
+        with metrics.stage('filter.mask'):
+            token_lists = [tokens for tokens in
+                           (tuple(token for token in self.ingredient_tokens(name) if token.strip())
+                            for name in filters.ingredients) if tokens]
+            return snap.filters.mask(filters, len(snap.store), token_lists)
+
+    def _filtered_snapshot(self, filters: RecipeFilter | None):
+        """取得目前的快照與篩選遮罩"""
+        if filters:
+            self.ensure_filter_index()
+        snap = self.snapshot
+        return snap, self._filter_mask(snap, filters)
+
+    def suggest(self, prefix: str, limit: int = 10, type: str | None = None) -> List[dict]:
+        """
+            搜尋框的自動完成建議 [{'text', 'type', 'count'}]，依含有該詞的食譜數排序
+
+            type 為 'recipe' 時只建議食譜名稱與標籤，'ingredient' 時只建議食材，None 時全部。
+        """
+        if type not in SUGGEST_TYPES:
+            raise ValueError(f"unknown suggest type: {type}")
+        self.ensure_suggest_index()
+        with metrics.stage('suggest.lookup'):
+            return self.snapshot.suggest.suggest(prefix, limit, SUGGEST_TYPES[type])
+
+    def get_similar_ingredients(self, ingredient: str, top_k: int = 5,
+                                filters: RecipeFilter | None = None) -> List[Dict]:
+        """找出相似的食材，並返回使用這些食材的食譜 (查詢中的每個詞各取 top_k 個相似食材)"""
+        return [item for group in self.similar_ingredient_groups(ingredient, top_k, filters) for item in group]
+
+    def similar_ingredient_groups(self, ingredient: str, top_k: int = 5,
+                                  filters: RecipeFilter | None = None) -> List[List[Dict]]:
+        """
+            查詢中每個詞最相似的 top_k 個食材與使用它們的食譜，每個詞一組 (結果會被快取，請勿修改)
+
+            filters 只影響每個食材列出的食譜。
+        """
+        with metrics.stage('similar.clean'):
+            clean_ing = self.clean_ingredient_name(normalize_query(ingredient))
+        key = ('similar', self.cache_generation, clean_ing, top_k, _filter_key(filters))
+        cached = self.result_cache.get(key)
+        if cached is not None:
+            return cached
+        groups = self._get_similar_ingredients(clean_ing, top_k, filters)
+        self.result_cache.put(key, groups)
+        return groups
+
+    def _get_similar_ingredients(self, clean_ing: str, top_k: int,
+                                 filters: RecipeFilter | None = None) -> List[List[Dict]]:
+        self.ensure_modality('ingredient')
+        snap, mask = self._filtered_snapshot(filters)
+        ingredient = snap.ingredient
+        with metrics.stage('similar.tokenize'):
+            tokens = self.ingredient_tokenizer.cut(clean_ing)
+
+        # 查詢建置時預先計算的相似詞表 (詞彙外的新食材詞以估計向量查詢)
+        with metrics.stage('similar.score'):
+            similar = []
+            for token in tokens:
+                neighbors = ingredient.artifact.neighbors(token, top_k)
+                if neighbors is not None:
+                    similar.append(neighbors)
+                elif token in ingredient.oov_vectors:
+                    similar.append(ingredient.wv.similar_by_vector(ingredient.oov_vectors[token], topn=top_k))
+
+        groups = []
+        with metrics.stage('similar.build_results'):
+            for neighbors in similar:
+                similar_ingredients = []
+                for word, score in neighbors:
+                    # 找出使用該食材的食譜 (只取前5個食譜)
                     recipes = []
-                    for ref in recipe_refs:
-                        recipe = next(
-                            (r for r in self.data if r['id'] == ref['recipe_id']), None)
+                    for row, position in ingredient.recipe_refs(word, ingredient_model.RECIPES_PER_INGREDIENT, mask):
+                        recipe = snap.store.fields(row)
                         if recipe:
                             recipes.append({
-                                'id': recipe['id'],
-                                'name': recipe['name'],
-                                'amount': ref['amount']
+                                'id': recipe.id,
+                                'name': recipe.name,
+                                'amount': recipe.ingredient_amounts[position]
                             })
 
                     similar_ingredients.append({
@@ -199,147 +707,295 @@ class RecipeSearchEngine:
                         'similarity': float(score),
                         'recipes': recipes
                     })
+                groups.append(similar_ingredients)
 
-        return similar_ingredients
+        return groups
+
+    def ingredient_based_search(self, ingredients: List[str], top_k: int = 10,
+                                filters: RecipeFilter | None = None, fields: tuple | None = None) -> List[dict]:
+        """
+            基於食材相似度的搜尋 (結果會被快取，請勿修改)
 
-    def ingredient_based_search(self, ingredients: List[str], top_k: int = 10) -> List[dict]:
-        """基於食材相似度的搜尋"""
+            fields 為結果中要保留的食譜欄位 (projection.parse_fields 的結果)，None 表示全部。
+        """
+        # 結果與食材順序無關，以排序後的清理過食材名稱作為快取鍵
+        with metrics.stage('ingredient.clean'):
+            cleaned = tuple(sorted(self.clean_ingredient_name(normalize_query(ing)) for ing in ingredients))
+        key = ('ingredient', self.cache_generation, cleaned, top_k, _filter_key(filters), fields)
+        cached = self.result_cache.get(key)
+        if cached is not None:
+            return cached
+        results = self._ingredient_based_search(cleaned, top_k, filters, fields)
+        self.result_cache.put(key, results)
+        return results
+
+    def _ingredient_based_search(self, ingredients: List[str], top_k: int,
+                                 filters: RecipeFilter | None = None, fields: tuple | None = None) -> List[dict]:
+        """依已清理的食材名稱計算搜尋結果"""
+        self.ensure_modality('ingredient')
+        snap, mask = self._filtered_snapshot(filters)
+        with metrics.stage('ingredient.tokenize'):
+            token_lists = [self.ingredient_tokenizer.cut(clean_ing) for clean_ing in ingredients]
+
+        with metrics.stage('ingredient.score'):
+            scored = self._score_ingredients(snap, token_lists, top_k, mask)
+        if scored is None:
+            return []
+        rows, similarities, matched, delta_matches, keys = scored
+        offsets = snap.ingredient.ingredient_offsets
+
+        # 只為最後的 top_k 建立結果
+        results = []
+        with metrics.stage('ingredient.build_results'):
+            for i in top_k_indices(keys, top_k):
+                row = int(rows[i])
+                recipe = snap.store.at(row)
+                if row in delta_matches or row >= len(offsets) - 1:
+                    positions = delta_matches.get(row, [])
+                else:
+                    start, end = offsets[row], offsets[row + 1]
+                    lo, hi = np.searchsorted(matched, [start, end])
+                    positions = matched[lo:hi] - start
+                matching_ingredients = [recipe['ingredients'][position] for position in positions]
+
+                results.append({
+                    **project_recipe(recipe, fields),
+                    'similarity': float(similarities[i]),
+                    'matching_ingredients': matching_ingredients,
+                    'total_ingredients': len(recipe.get('ingredients', []))
+                })
+
+        return results
+
+    def _score_ingredients(self, snap: CorpusSnapshot, token_lists: List[List[str]], top_k: int,
+                           mask: np.ndarray | None = None):
+        """
+            計算候選食譜的排序鍵，沒有可用的查詢向量也沒有匹配到食材時回傳 None
+
+            mask 不為 None 時只保留 mask 中的食譜 (在取 top-k 之前篩選)。
+
+            回傳 (候選的 store 列號, 相似度, 匹配到的全域食材編號, 更新後食譜匹配到的食材位置, 排序鍵)
+        """
+        ingredient = snap.ingredient
         query_vectors = []
 
         # 計算查詢食材的平均向量
-        for ing in ingredients:
-            clean_ing = self.clean_ingredient_name(ing)
-            tokens = list(self.ingredient_tokenizer.cut(clean_ing))
-            token_vectors = []
-            for token in tokens:
-                if token in self.ingredient_model.wv:
-                    token_vectors.append(self.ingredient_model.wv[token])
+        for tokens in token_lists:
+            token_vectors = [vector for vector in map(ingredient.token_vector, tokens) if vector is not None]
             if token_vectors:
                 query_vectors.append(np.mean(token_vectors, axis=0))
 
-        if not query_vectors:
-            return []
+        # 從倒排索引找出含有該食材的食譜食材
+        matched, delta_matches = ingredient.match(
+            [index_tokens for index_tokens in ([token for token in tokens if token.strip()] for tokens in token_lists)
+             if index_tokens])
+        index = ingredient.vectors
+        query_norm = np.linalg.norm(np.mean(query_vectors, axis=0)) if query_vectors else 0
+        if query_norm == 0 or len(index) == 0:
+            # 詞彙外且無法估計向量的食材只能以名稱匹配 (只有更新後加入的食譜會含有這類食材)
+            if not delta_matches:
+                return None
+            rows = np.array(sorted(delta_matches), dtype=np.int64)
+            if mask is not None:
+                rows = rows[mask[rows]]
+            match_counts = np.array([len(delta_matches[row]) for row in rows])
+            similarities = np.zeros(len(rows), dtype=np.float32)
+            return rows, similarities, matched, delta_matches, match_counts * 4.0
+
+        query_vector = np.mean(query_vectors, axis=0) / query_norm
+        if index.backend == 'exact':
+            # 一次矩陣乘法計算與所有食譜的餘弦相似度 (食譜向量已正規化)
+            rows, similarities = index.score_all(query_vector)
+        else:
+            # 近似索引只取相似度最高的 top_k 個候選，再加上所有匹配到食材的食譜
+            # (匹配食材數優先於相似度，這些食譜一定要參與排序)
+            nearest, _ = index.search(query_vector, top_k, mask, config.FILTER_EXACT_MAX_ROWS)
+            matched_rows = np.concatenate([np.unique(ingredient.ingredient_row[matched]),
+                                           np.fromiter(delta_matches, dtype=np.int64, count=len(delta_matches))])
+            rows = np.union1d(nearest, matched_rows[index.has_vector(matched_rows)])
+            similarities = index.score_rows(query_vector, rows)
+
+        if mask is not None:
+            keep = mask[rows]
+            rows, similarities = rows[keep], similarities[keep]
+
+        # 每個食譜匹配到的食材數
+        match_counts = np.bincount(ingredient.ingredient_row[matched], minlength=len(snap.store))
+        for row, positions in delta_matches.items():
+            match_counts[row] += len(positions)
+
+        # 先依匹配食材數、再依相似度排序 (相似度介於 -1 與 1，乘上 4 可維持字典序)
+        keys = match_counts[rows] * 4.0 + similarities
+        return rows, similarities, matched, delta_matches, keys
+
+    def encode_texts(self, texts: List[str]) -> np.ndarray:
+        """將一批查詢文字編碼為嵌入矩陣"""
+        self.ensure_modality('text')
+        with metrics.stage('text.encode'):
+            return np.asarray(self.sentence_model.encode(texts, batch_size=max(len(texts), 1)))
 
-        query_vector = np.mean(query_vectors, axis=0)
-
-        # 計算與所有食譜的相似度
-        similarities = []
-        for recipe_id, recipe_vector in self.recipe_ingredient_vectors.items():
-            similarity = float(np.dot(query_vector, recipe_vector) /
-                               (np.linalg.norm(query_vector) * np.linalg.norm(recipe_vector)))
-            # 取得該食譜的完整資訊
-            recipe = next(r for r in self.data if r['id'] == recipe_id)
-            # 計算食材匹配度
-            matching_ingredients = []
-            for ing in recipe.get('ingredients', []):
-                if any(q_ing in ing.get('name', '') for q_ing in ingredients):
-                    matching_ingredients.append(ing)
-
-            similarities.append({
-                **recipe,
-                'similarity': similarity,
-                'matching_ingredients': matching_ingredients,
-                'total_ingredients': len(recipe.get('ingredients', []))
-            })
-
-        # 排序並返回結果
-        similarities.sort(key=lambda x: (
-            len(x['matching_ingredients']), x['similarity']), reverse=True)
-        return similarities[:top_k]
-
-    def text_search(self, query: str, top_k: int = 10) -> List[dict]:
-        """基於文字相似度的搜尋"""
+    def encode_images(self, images: List[Image.Image]) -> np.ndarray:
+        """將一批查詢圖片編碼為 CLIP 特徵矩陣"""
+        self.ensure_modality('image')
+        with metrics.stage('image.encode'):
+            return self.image_encoder.encode(images)
+
+    def text_query_embedding(self, query: str) -> np.ndarray | None:
+        """從快取取得查詢文字的嵌入，沒有時回傳 None"""
+        return self.query_embedding_cache.get(('text', self.cache_generation, normalize_query(query)))
+
+    def image_query_embedding(self, digest: str) -> np.ndarray | None:
+        """依圖片內容雜湊從快取取得 CLIP 特徵，沒有時回傳 None"""
+        return self.query_embedding_cache.get(('image', self.cache_generation, digest))
+
+    def cache_image_embedding(self, digest: str, image_embedding: np.ndarray):
+        """以圖片內容雜湊快取 CLIP 特徵，重複上傳時可略過模型"""
+        self.query_embedding_cache.put(('image', self.cache_generation, digest), image_embedding)
+
+    def cached_text_search(self, query: str, top_k: int = 10, filters: RecipeFilter | None = None,
+                           fields: tuple | None = None) -> List[dict] | None:
+        """從快取取得文字搜尋結果，沒有時回傳 None"""
+        return self.result_cache.get(('text', self.cache_generation, normalize_query(query), top_k,
+                                      _filter_key(filters), fields))
+
+    def _text_candidates(self, snap: CorpusSnapshot, query: str, k: int, query_embedding: np.ndarray | None = None,
+                         mask: np.ndarray | None = None):
+        """
+            回傳文字相似度最高的 k 個 (store 列號, 相似度)，依相似度由高到低排序 (呼叫端需先載入文字模態)
+
+            mask 不為 None 時只在 mask 中的食譜裡取 top-k。
+        """
+        # 對查詢文字進行編碼 (呼叫端可傳入已批次編碼好的嵌入)
+        if query_embedding is None:
+            query_embedding = self.text_query_embedding(query)
+        if query_embedding is None:
+            query_embedding = self.encode_texts([query])[0]
+        self.query_embedding_cache.put(('text', self.cache_generation, query), query_embedding)
+
+        # 計算相似度 (暴力內積或 HNSW 近似搜尋)
+        with metrics.stage('text.score'):
+            return snap.text.search(query_embedding, k, mask, config.FILTER_EXACT_MAX_ROWS)
+
+    def _image_candidates(self, snap: CorpusSnapshot, image: Image.Image | None, k: int,
+                          image_embedding: np.ndarray | None = None,
+                          filters: RecipeFilter | None = None, mask: np.ndarray | None = None):
+        """
+            回傳圖片距離最近的 k 個 (store 列號, 距離)，依距離由近到遠排序
+
+            料理時間與份量條件以 where 交給 ChromaDB 在搜尋時篩選；標籤與食材條件無法寫成 metadata
+            條件 (collection 還沒有篩選用的 metadata 時數值條件也是)，依 mask 中符合的比例多取候選後再以 mask 篩選。
+        """
+        self.ensure_modality('image')
+        # 處理輸入圖片 (呼叫端可傳入已批次編碼好的特徵)
+        if image_embedding is None:
+            image_embedding = self.encode_images([image])[0]
+
+        n_results, where = k, None
+        if filters:
+            where = self._image_filter_where(filters)
+            allowed = int(np.count_nonzero(mask))
+            if allowed == 0:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+            if filters.has_sets or (where is None and filters.chroma_where() is not None):
+                n_results = min(-(-k * len(mask) // allowed) * 2, max(self.collection.count(), 1))
+
+        # 使用 ChromaDB 搜尋相似向量
+        with metrics.stage('image.chroma_query'):
+            results = self.collection.query(
+                query_embeddings=[np.asarray(image_embedding).tolist()],
+                n_results=n_results,
+                where=where,
+                include=["distances"]
+            )
+
+        rows, distances = [], []
+        for recipe_id, distance in zip(results.get("ids")[0], results.get("distances")[0]):
+            # 已刪除的食譜可能還留在 collection 中
+            row = snap.store.row_of(recipe_id)
+            if row is not None and (mask is None or mask[row]):
+                rows.append(row)
+                distances.append(distance)
+        return np.array(rows[:k], dtype=np.int64), np.array(distances[:k], dtype=np.float64)
+
+    def text_search(self, query: str, top_k: int = 10, query_embedding: np.ndarray | None = None,
+                    filters: RecipeFilter | None = None, fields: tuple | None = None) -> List[dict]:
+        """
+            基於文字相似度的搜尋 (結果會被快取，請勿修改)
+
+            fields 為結果中要保留的食譜欄位 (projection.parse_fields 的結果)，None 表示 TEXT_RESULT_FIELDS 全部。
+        """
+        query = normalize_query(query)
         if not query:
             return []
 
-        # 對查詢文字進行編碼
-        query_embedding = self.sentence_model.encode([query])[0]
+        key = ('text', self.cache_generation, query, top_k, _filter_key(filters), fields)
+        cached = self.result_cache.get(key)
+        if cached is not None:
+            return cached
 
-        # 計算相似度
-        similarities = np.dot(self.text_embeddings, query_embedding)
-        top_indices = np.argsort(similarities)[-top_k:][::-1]
+        self.ensure_modality('text')
+        snap, mask = self._filtered_snapshot(filters)
+        top_indices, scores = self._text_candidates(snap, query, top_k, query_embedding, mask)
 
         # 回傳最相關的食譜
+        names = list(TEXT_RESULT_FIELDS) if fields is None else [name for name in fields if name in TEXT_RESULT_FIELDS]
         results = []
-        for idx in top_indices:
-            recipe = self.data[idx].copy()
-            recipe['similarity_score'] = float(similarities[idx])
-            # 標註匹配到的部分
-            recipe['matched_parts'] = []
-
-            # 確保所有字串比較都是安全的
-            recipe_name = str(recipe.get('name', ''))
-            recipe_description = str(recipe.get('description', ''))
-            recipe_hashtags = list(recipe.get('hashtags', []))
-
-            if query in recipe_name:
-                recipe['matched_parts'].append('name')
-            if query in recipe_description:
-                recipe['matched_parts'].append('description')
-            if any(query in str(tag) for tag in recipe_hashtags):
-                recipe['matched_parts'].append('hashtags')
-
-            # 確保回傳的資料格式正確
-            result = {
-                'id': recipe.get('id', ''),
-                'name': recipe_name,
-                'description': recipe_description,
-                'image': recipe.get('image', ''),
-                'duration': recipe.get('duration', ''),
-                'servings': recipe.get('servings', ''),
-                'hashtags': recipe_hashtags,
-                'ingredients': recipe.get('ingredients', []),
-                'steps': recipe.get('steps', []),
-                'similarity_score': recipe['similarity_score'],
-                'matched_parts': recipe['matched_parts']
-            }
-            results.append(result)
-
-        return results
+        with metrics.stage('text.build_results'):
+            for idx, score in zip(top_indices, scores):
+                recipe = snap.store.at(idx)
+                # 標註匹配到的部分
+                matched_parts = []
 
-    def image_search(self, image: Image.Image, top_k: int = 10) -> List[dict]:
-        """基於圖片相似度的搜尋"""
-        # 處理輸入圖片
-        inputs = self.clip_processor(images=image, return_tensors="pt")
-        image_features = self.clip_model.get_image_features(**inputs).detach().numpy()
+                # 確保所有字串比較都是安全的
+                recipe_name = str(recipe.get('name', ''))
+                recipe_description = str(recipe.get('description', ''))
+                recipe_hashtags = list(recipe.get('hashtags', []))
 
-        # 使用 ChromaDB 搜尋相似向量
-        results = self.collection.query(
-            query_embeddings=image_features.tolist(),
-            n_results=top_k
-        )
+                if query in recipe_name:
+                    matched_parts.append('name')
+                if query in recipe_description:
+                    matched_parts.append('description')
+                if any(query in str(tag) for tag in recipe_hashtags):
+                    matched_parts.append('hashtags')
 
-        ids = results.get("ids")[0]
-        distances = results.get("distances")[0]
-        id_distance = {id:distance for id, distance in zip(ids, distances)}
+                # 確保回傳的資料格式正確 (只建立要求的欄位)
+                normalized = {'name': recipe_name, 'description': recipe_description, 'hashtags': recipe_hashtags}
+                result = {name: normalized[name] if name in normalized else recipe.get(name, TEXT_RESULT_FIELDS[name])
+                          for name in names}
+                result['similarity_score'] = float(score)
+                result['matched_parts'] = matched_parts
+                results.append(result)
 
-        search_results = []
-        for recipe in self.data:
-            if recipe["id"] in ids:
-                search_results.append({**recipe,"distance":id_distance[recipe["id"]]})
-        
-        search_results = sorted(search_results, key=lambda x : x["distance"])
+        self.result_cache.put(key, results)
+        return results
 
-        return search_results
-    
-    def normalize_scores(self, scores: List[float]) -> List[float]:
-            """將分數正規化到 0-1 範圍"""
-            if not scores:
-                return scores
-            min_score = min(scores)
-            max_score = max(scores)
-            if max_score == min_score:
-                return [1.0] * len(scores)
-            return [(s - min_score) / (max_score - min_score) for s in scores]
+    def image_search(self, image: Image.Image | None, top_k: int = 10,
+                     image_embedding: np.ndarray | None = None, filters: RecipeFilter | None = None,
+                     fields: tuple | None = None) -> List[dict]:
+        """基於圖片相似度的搜尋 (fields 為結果中要保留的食譜欄位，None 表示全部)"""
+        snap, mask = self._filtered_snapshot(filters)
+        rows, distances = self._image_candidates(snap, image, top_k, image_embedding, filters, mask)
+        with metrics.stage('image.build_results'):
+            return [{**project_recipe(snap.store.at(row), fields), "distance": float(distance)}
+                    for row, distance in zip(rows, distances)]
 
     def multimodal_search(self, 
                         image: Image.Image | None = None, 
                         text: str | None = None, 
                         top_k: int = 10,
                         image_weight: float = 0.5,
-                        text_weight: float = 0.5) -> List[dict]:
+                        text_weight: float = 0.5,
+                        fusion: str = "weighted",
+                        candidate_k: int | None = None,
+                        image_embedding: np.ndarray | None = None,
+                        text_embedding: np.ndarray | None = None,
+                        filters: RecipeFilter | None = None,
+                        fields: tuple | None = None) -> List[dict]:
         """
         結合圖片和文字的混合搜尋
+
+        每個模態只取有限數量的候選，以陣列進行分數融合後只建立最後 top_k 筆結果，
+        因此延遲不會隨資料量成長。
         
         Args:
             image: 搜尋用的圖片
@@ -347,61 +1003,65 @@ class RecipeSearchEngine:
             top_k: 返回結果數量
             image_weight: 圖片搜尋結果的權重 (0-1)
             text_weight: 文字搜尋結果的權重 (0-1)
+            fusion: "weighted" (正規化分數加權) 或 "rrf" (Reciprocal Rank Fusion)
+            candidate_k: 每個模態的候選數量，預設為 max(top_k * 5, 50)
+            image_embedding / text_embedding: 已編碼好的查詢嵌入，提供時不再呼叫模型
+            filters: 篩選條件，在各模態取候選之前套用
+            fields: 結果中要保留的食譜欄位 (projection.parse_fields 的結果)，None 表示全部
             
         Returns:
             搜尋結果列表
         """
-        if not image and not text:
+        if image is None and image_embedding is None and not text:
             return []
             
         # 確保權重和為 1
         total_weight = image_weight + text_weight
+        if total_weight <= 0:
+            image_weight = text_weight = total_weight = 1.0
         image_weight = image_weight / total_weight
         text_weight = text_weight / total_weight
-        
-        # 儲存所有食譜的綜合分數
-        recipe_scores = defaultdict(lambda: {'image_score': 0.0, 'text_score': 0.0})
-        
-        # 進行圖片搜尋
-        if image:
-            image_results = self.image_search(image, top_k=len(self.data))
-            # 收集所有圖片距離分數
-            image_distances = [r['distance'] for r in image_results]
-            # 將距離轉換為相似度分數並正規化（距離越小越相似）
-            normalized_distances = self.normalize_scores([1 - d/max(image_distances) for d in image_distances])
-            for result, norm_score in zip(image_results, normalized_distances):
-                recipe_scores[result['id']]['image_score'] = norm_score
-        
-        # 進行文字搜尋
+
+        if candidate_k is None:
+            candidate_k = max(top_k * 5, 50)
+
         if text:
-            text_results = self.text_search(text, top_k=len(self.data))
-            # 收集所有文字相似度分數
-            text_similarities = [r['similarity_score'] for r in text_results]
-            # 正規化文字相似度分數
-            normalized_similarities = self.normalize_scores(text_similarities)
-            for result, norm_score in zip(text_results, normalized_similarities):
-                recipe_scores[result['id']]['text_score'] = norm_score
-        
+            self.ensure_modality('text')
+        snap, mask = self._filtered_snapshot(filters)
+
+        candidates, weights, score_names = [], [], []
+        # 圖片候選 (距離越小越相似，取負值使分數越高越相似)
+        if image is not None or image_embedding is not None:
+            rows, distances = self._image_candidates(snap, image, candidate_k, image_embedding, filters, mask)
+            candidates.append((rows, -distances))
+            weights.append(image_weight)
+            score_names.append('image_score')
+        # 文字候選
+        if text:
+            rows, similarities = self._text_candidates(snap, normalize_query(text), candidate_k, text_embedding, mask)
+            candidates.append((rows, similarities))
+            weights.append(text_weight)
+            score_names.append('text_score')
+
         # 結合分數
+        with metrics.stage('multimodal.fusion'):
+            if fusion == "rrf":
+                rows, combined, modality_scores = reciprocal_rank_fusion(candidates, weights)
+            else:
+                rows, combined, modality_scores = weighted_score_fusion(candidates, weights)
+            top_indices = top_k_indices(combined, top_k)
+
+        # 根據綜合分數排序，只為最後的 top_k 建立結果
         final_results = []
-        for recipe_id, scores in recipe_scores.items():
-            recipe = next(r for r in self.data if r['id'] == recipe_id)
-            
-            # 計算加權分數
-            weighted_score = 0.0
-            if image:
-                weighted_score += scores['image_score'] * image_weight
-            if text:
-                weighted_score += scores['text_score'] * text_weight
-            
-            final_results.append({
-                **recipe,
-                'combined_score': weighted_score,
-                'image_score': scores['image_score'],
-                'text_score': scores['text_score']
-            })
-        
-        # 根據綜合分數排序
-        final_results.sort(key=lambda x: x['combined_score'], reverse=True)
-        
-        return final_results[:top_k]
\ No newline at end of file
+        with metrics.stage('multimodal.build_results'):
+            for i in top_indices:
+                scores = {'image_score': 0.0, 'text_score': 0.0}
+                for m, name in enumerate(score_names):
+                    scores[name] = float(modality_scores[m, i])
+                final_results.append({
+                    **project_recipe(snap.store.at(rows[i]), fields),
+                    'combined_score': float(combined[i]),
+                    **scores
+                })
+
+        return final_results
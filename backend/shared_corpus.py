@@ -0,0 +1,102 @@
+"""
+    多 worker 部署時共用的唯讀資料
+
+    loader 行程載入語料並建置所有模態的資料 (文字嵌入、量化矩陣、向量索引、食材產物)，
+    再將食譜寫成可 mmap 的格式並寫入 manifest。之後各 worker 以 RECIPE_SHARED_DIR 指向
+    發佈目錄，直接以 mmap 附加這些檔案，不再各自解析 JSON 或重新計算；作業系統的分頁快取
+    讓所有 worker 共用同一份記憶體 (放在 /dev/shm 之類的 tmpfs 上則完全不經過磁碟)。
+
+    > python shared_corpus.py --data ./icook_recipe/recipe_data.json --cache-dir ./cache
+    > RECIPE_SHARED_DIR=./cache/shared uvicorn main:app --workers 4
+
+    HNSW 索引與 ChromaDB 由各 worker 自行載入 (hnswlib 不支援 mmap)。
+    共用模式下語料是唯讀的，更新食譜後需重新執行 loader 並重啟 worker。
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+from recipe_store import MappedRecipeStore, write_mapped_store
+
+MANIFEST_VERSION = 1
+
+
+class ReadOnlyCorpusError(RuntimeError):
+    """共用模式下不允許修改語料"""
+
+
+class SharedCorpus:
+    """
+        已發佈的唯讀資料
+
+        manifest 記錄發佈時的文字嵌入快取雜湊與食材產物指紋，worker 以此確認
+        cache 目錄中的檔案與發佈的食譜一致。
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        manifest_path = os.path.join(directory, "manifest.json")
+        with open(manifest_path, "r", encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('version') != MANIFEST_VERSION:
+            raise RuntimeError(f"unsupported shared corpus version in {manifest_path}, re-run shared_corpus.py")
+        self.store = MappedRecipeStore(os.path.join(directory, "store"))
+
+    @property
+    def text_digest(self) -> str | None:
+        return self.manifest.get('text_digest')
+
+    @property
+    def ingredient_fingerprint(self) -> str | None:
+        return self.manifest.get('ingredient_fingerprint')
+
+
+def publish(data_path: str, cache_dir: str, out_dir: str | None = None, modalities=('text', 'ingredient'),
+            image_dir: str | None = None) -> dict:
+    """
+        建置所有模態的資料並發佈到 out_dir (預設為 cache_dir/shared)
+
+        image_dir 不為 None 時一併預計算圖片向量 (從本機目錄讀取圖片)。
+    """
+    from search_engine import RecipeSearchEngine
+
+    out_dir = out_dir or os.path.join(cache_dir, "shared")
+    start = time.perf_counter()
+    engine = RecipeSearchEngine(data_path, cache_dir=cache_dir, modalities=modalities)
+    engine.warmup(background=False)
+    if image_dir is not None:
+        engine.precompute_image_vectors(image_dir=image_dir)
+    snap = engine.snapshot
+
+    # 先寫入暫存目錄再替換，worker 不會讀到寫到一半的檔案
+    tmp_dir = out_dir.rstrip('/\\') + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    count = write_mapped_store(snap.store, os.path.join(tmp_dir, "store"))
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'recipes': count,
+        'cache_dir': os.path.abspath(cache_dir),
+        'text_digest': engine.text_embedding_cache.digest() if snap.text is not None else None,
+        'ingredient_fingerprint': snap.ingredient.artifact.fingerprint if snap.ingredient is not None else None,
+        'published_at': time.time(),
+    }
+    with open(os.path.join(tmp_dir, "manifest.json"), "w", encoding='utf-8') as f:
+        json.dump(manifest, f)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    print(f"已發佈 {count} 筆食譜到 {out_dir}，耗時 {time.perf_counter() - start:.1f} 秒")
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="建置並發佈多 worker 共用的唯讀資料")
+    parser.add_argument("--data", default="./icook_recipe/recipe_data.json")
+    parser.add_argument("--cache-dir", default="./cache")
+    parser.add_argument("--out", default=None, help="發佈目錄 (預設為 <cache-dir>/shared)")
+    parser.add_argument("--modalities", default="text,ingredient")
+    parser.add_argument("--image-dir", default=None, help="一併從本機目錄預計算圖片向量")
+    args = parser.parse_args()
+
+    publish(args.data, args.cache_dir, args.out,
+            [m.strip() for m in args.modalities.split(",") if m.strip()], args.image_dir)
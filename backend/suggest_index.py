@@ -0,0 +1,155 @@
+"""
+    搜尋框自動完成用的前綴索引
+
+    每一類詞 (食譜名稱、標籤、清理後的食材名稱) 各有一個依正規化鍵排序的陣列，
+    前綴查詢以 bisect 找出範圍後依文件頻率 (含有該詞的食譜數) 取前幾名，不經過任何模型。
+    增量更新時只複製頻率陣列；語料中沒有的新詞放在 delta，直到重新建置。
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List
+import numpy as np
+from query_cache import normalize_query
+from recipe_store import RecipeFields
+
+KINDS = ('name', 'hashtag', 'ingredient')
+# /api/suggest 的 type 參數對應的詞類
+SUGGEST_TYPES = {
+    None: KINDS,
+    'recipe': ('name', 'hashtag'),
+    'ingredient': ('ingredient',),
+}
+
+
+def suggest_key(text: str) -> str:
+    """前綴比對用的鍵 (全形轉半形、合併空白、不分大小寫)"""
+    key = normalize_query(text).casefold()
+    # 鍵與原字串相同時共用同一個字串物件
+    return text if key == text else key
+
+
+def recipe_terms(recipe: RecipeFields, clean: Callable[[str], str]) -> Dict[str, set]:
+    """食譜中每一類的詞 (同一食譜中重複的詞只算一次)"""
+    return {
+        'name': {recipe.name} if recipe.name else set(),
+        'hashtag': {tag for tag in recipe.hashtags if tag},
+        'ingredient': {cleaned for cleaned in map(clean, recipe.ingredient_names) if cleaned},
+    }
+
+
+class _TermTable:
+    """同一類詞的排序陣列: keys[i] 的顯示文字為 terms[i]，文件頻率為 counts[i]"""
+
+    def __init__(self, keys: List[str], terms: List[str], counts: np.ndarray):
+        self.keys = keys
+        self.terms = terms
+        self.counts = counts
+
+    def position(self, key: str) -> int | None:
+        i = bisect_left(self.keys, key)
+        return i if i < len(self.keys) and self.keys[i] == key else None
+
+    def top(self, prefix: str, limit: int) -> List[tuple]:
+        """以 prefix 開頭且頻率大於 0 的詞中頻率最高的 limit 個 [(頻率, 鍵, 顯示文字)]"""
+        lo = bisect_left(self.keys, prefix)
+        # 以 prefix 開頭的鍵都小於 prefix + 最大的 code point
+        hi = bisect_left(self.keys, prefix + "\U0010ffff", lo)
+        if lo >= hi:
+            return []
+        counts = self.counts[lo:hi]
+        # 先排除已被刪光 (頻率 <= 0) 的詞再取前幾名，以免它們佔掉名額
+        positive = np.flatnonzero(counts > 0)
+        if len(positive) > limit:
+            picked = positive[np.argpartition(-counts[positive], limit)[:limit]]
+        else:
+            picked = positive
+        return [(int(counts[i]), self.keys[lo + i], self.terms[lo + i]) for i in picked]
+
+
+class SuggestIndex:
+    """
+        名稱、標籤與食材名稱的前綴索引
+
+        tables: 每一類詞的排序陣列 (建置時的語料)
+        delta: 每一類詞在建置後才出現的詞 {鍵: [顯示文字, 頻率]}
+    """
+
+    def __init__(self, tables: Dict[str, _TermTable], delta: Dict[str, Dict[str, list]] | None = None):
+        self.tables = tables
+        self.delta = delta or {kind: {} for kind in KINDS}
+
+    @classmethod
+    def build(cls, recipes: Iterable[RecipeFields], clean: Callable[[str], str]):
+        """由語料建立索引，clean 為食材名稱的清理函式"""
+        cleaned = {}
+
+        def clean_once(name):
+            # 每個不同的食材名稱只清理一次
+            if name not in cleaned:
+                cleaned[name] = clean(name)
+            return cleaned[name]
+
+        counts = {kind: defaultdict(int) for kind in KINDS}
+        terms = {kind: {} for kind in KINDS}
+        for recipe in recipes:
+            for kind, words in recipe_terms(recipe, clean_once).items():
+                for word in words:
+                    key = suggest_key(word)
+                    counts[kind][key] += 1
+                    terms[kind].setdefault(key, word)
+
+        tables = {}
+        for kind in KINDS:
+            keys = sorted(counts[kind])
+            tables[kind] = _TermTable(keys, [terms[kind][key] for key in keys],
+                                      np.array([counts[kind][key] for key in keys], dtype=np.int32))
+        return cls(tables)
+
+    def with_updates(self, changes: List[tuple], clean: Callable[[str], str]):
+        """
+            回傳套用更新後的新索引
+
+            changes 中每一項為 (舊版本, 新版本) 的 RecipeFields，新增時舊版本為 None，刪除時新版本為 None。
+        """
+        tables = {kind: _TermTable(table.keys, table.terms, table.counts.copy())
+                  for kind, table in self.tables.items()}
+        delta = {kind: {key: list(entry) for key, entry in entries.items()} for kind, entries in self.delta.items()}
+        for old, new in changes:
+            for recipe, step in ((old, -1), (new, 1)):
+                if recipe is None:
+                    continue
+                for kind, words in recipe_terms(recipe, clean).items():
+                    for word in words:
+                        key = suggest_key(word)
+                        position = tables[kind].position(key)
+                        if position is not None:
+                            tables[kind].counts[position] += step
+                        else:
+                            delta[kind].setdefault(key, [word, 0])[1] += step
+        return SuggestIndex(tables, delta)
+
+    def suggest(self, prefix: str, limit: int = 10, kinds: Iterable[str] = KINDS) -> List[dict]:
+        """依文件頻率排序的自動完成建議，同樣的文字只保留頻率最高的一類"""
+        prefix = suggest_key(prefix)
+        if not prefix or limit <= 0:
+            return []
+        candidates = []
+        for kind in kinds:
+            candidates.extend((count, key, term, kind) for count, key, term in self.tables[kind].top(prefix, limit))
+            candidates.extend((count, key, term, kind) for key, (term, count) in self.delta[kind].items()
+                              if count > 0 and key.startswith(prefix))
+        # 頻率高的優先，同頻率時較短的詞優先
+        candidates.sort(key=lambda c: (-c[0], len(c[1]), c[1]))
+
+        suggestions, seen = [], set()
+        for count, key, term, kind in candidates:
+            if key in seen:
+                continue
+            seen.add(key)
+            suggestions.append({'text': term, 'type': kind, 'count': count})
+            if len(suggestions) == limit:
+                break
+        return suggestions
+
+    def stats(self) -> dict:
+        return {kind: {'terms': len(self.tables[kind].keys), 'delta': len(self.delta[kind])} for kind in KINDS}
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# backend 的模組以平面方式匯入 (與 uvicorn main:app 相同)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,51 @@
+"""
+    ONNX 與 PyTorch 編碼器的輸出比對
+
+    沒有安裝 torch / transformers / sentence_transformers / onnxruntime 時略過。
+    預設會匯出模型到暫存目錄；設定 RECIPE_ONNX_TEST_DIR 時改用該目錄中已匯出的模型。
+"""
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("sentence_transformers")
+pytest.importorskip("onnxruntime")
+
+import onnx_export
+from search_engine import CLIP_MODEL_NAME, TEXT_MODEL_NAME
+
+TOLERANCE = 1e-4
+ATOL = 1e-4
+
+
+@pytest.fixture(scope="module")
+def onnx_dir(tmp_path_factory):
+    out_dir = os.environ.get("RECIPE_ONNX_TEST_DIR")
+    if out_dir:
+        return out_dir
+    out_dir = str(tmp_path_factory.mktemp("onnx"))
+    onnx_export.export_text(TEXT_MODEL_NAME, os.path.join(out_dir, "text"))
+    onnx_export.export_clip(CLIP_MODEL_NAME, os.path.join(out_dir, "clip_vision"), os.path.join(out_dir, "clip_text"))
+    return out_dir
+
+
+@pytest.fixture(scope="module")
+def outputs(onnx_dir):
+    texts = onnx_export.sample_texts(None, 0) + ["紅燒牛肉麵的做法", "a photo of fried rice"]
+    images = onnx_export.sample_images(None, 4)
+    return (onnx_export.reference_vectors(TEXT_MODEL_NAME, CLIP_MODEL_NAME, texts, images),
+            onnx_export.onnx_vectors(onnx_dir, texts, images))
+
+
+@pytest.mark.parametrize("name", ["text", "clip_vision", "clip_text"])
+def test_onnx_matches_torch(outputs, name):
+    references, candidates = outputs
+    reference = np.asarray(references[name], dtype=np.float32)
+    candidate = np.asarray(candidates[name], dtype=np.float32)
+    assert candidate.shape == reference.shape
+
+    result = onnx_export.compare(reference, candidate)
+    assert result['min_cosine'] >= 1 - TOLERANCE, result
+    np.testing.assert_allclose(candidate, reference, rtol=1e-3, atol=ATOL)
@@ -0,0 +1,140 @@
+"""
+    食材名稱的清理與斷詞
+
+    不同的食材名稱遠少於食材出現的次數 ("鹽"、"醬油" 在語料中出現上萬次)，
+    因此以食材字串為鍵記錄斷詞結果: 語料中的食材名稱放在 token table，Word2Vec 訓練、
+    食譜向量與增量更新共用同一份；查詢字串則放在有容量上限的 LRU 快取。
+
+    jieba 會載入自訂的食材與單位詞典 (ingredient_dict.txt)，避免 "櫻花蝦"、"湯匙" 之類的詞被切開。
+    建置產物時的語料斷詞可分給多個行程平行處理。
+"""
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Tuple
+import jieba
+from query_cache import LRUCache
+
+# 常見的食材單位 (清理食材名稱時移除)，需包含 ingredient_dict.txt 中所有詞性為 q 的詞
+INGREDIENT_UNITS = {'克', '公克', 'g', '條', '片', '個', '顆', '些', '適量', '少許',
+                    '份', '兩', '斤', '匙', '湯匙', '茶匙', '大匙', '小匙', '杯', 'ml', '毫升', '公升', '把'}
+
+DEFAULT_DICT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ingredient_dict.txt")
+
+# 食材名稱少於此數量時不使用行程池 (每個行程都要重新載入 jieba 詞典，約需 1 秒)
+PARALLEL_MIN_NAMES = 20000
+
+
+class IngredientTokenizer:
+    """
+        附帶快取的食材斷詞器
+
+        參數:
+        dict_path: jieba 自訂詞典，None 或檔案不存在時只使用 jieba 內建詞典
+        units: 清理時移除的單位詞
+        cache_size: 查詢字串快取的容量
+    """
+
+    def __init__(self, dict_path: str | None = DEFAULT_DICT_PATH, units=INGREDIENT_UNITS, cache_size: int = 65536):
+        self.dict_path = dict_path if dict_path and os.path.exists(dict_path) else None
+        self.units = frozenset(units)
+        self.tokenizer = jieba.Tokenizer()
+        # 語料中食材名稱 -> 斷詞結果
+        self.table: Dict[str, Tuple[str, ...]] = {}
+        self._cache = LRUCache(cache_size, float('inf'))
+        self._dict_loaded = self.dict_path is None
+        self._dict_lock = threading.Lock()
+
+    def _jieba(self) -> jieba.Tokenizer:
+        # 第一次使用時才載入詞典 (與 jieba 本身的延遲初始化一致，不拖慢啟動)
+        if not self._dict_loaded:
+            with self._dict_lock:
+                if not self._dict_loaded:
+                    self.tokenizer.load_userdict(self.dict_path)
+                    self._dict_loaded = True
+        return self.tokenizer
+
+    def signature(self) -> str:
+        """詞典與單位的雜湊，斷詞規則改變時讓食材產物失效"""
+        digest = hashlib.sha1(repr(sorted(self.units)).encode('utf-8'))
+        if self.dict_path:
+            with open(self.dict_path, "rb") as f:
+                digest.update(f.read())
+        return digest.hexdigest()
+
+    def cut(self, text: str) -> Tuple[str, ...]:
+        """斷詞 (不移除單位詞)"""
+        if not text:
+            return ()
+        key = ('cut', text)
+        tokens = self._cache.get(key)
+        if tokens is None:
+            tokens = tuple(self._jieba().cut(text))
+            self._cache.put(key, tokens)
+        return tokens
+
+    def clean(self, name: str, cached: bool = True) -> str:
+        """
+            清理食材名稱，移除單位詞
+
+            cached 為 False 時 (走訪整個語料) 不經過查詢快取，避免擠掉熱門查詢；
+            名稱已在 token table 中時直接由斷詞結果組回 (jieba 斷詞不會增減字元)。
+        """
+        if not name:
+            return ""
+        if not cached:
+            tokens = self.table.get(name)
+            if tokens is not None:
+                return "".join(tokens)
+            return "".join(t for t in self._jieba().cut(name) if t not in self.units)
+        return "".join(t for t in self.cut(name) if t not in self.units)
+
+    def tokens(self, name: str) -> Tuple[str, ...]:
+        """將食材名稱清理後斷詞"""
+        tokens = self.table.get(name)
+        if tokens is None:
+            tokens = self.cut(self.clean(name))
+        return tokens
+
+    def _split(self, name: str) -> Tuple[str, ...]:
+        # 語料斷詞不經過查詢快取，避免擠掉熱門查詢
+        clean_name = self.clean(name, cached=False)
+        return tuple(self._jieba().cut(clean_name)) if clean_name else ()
+
+    def token_table(self, names: Iterable[str], workers: int = 1) -> Dict[str, Tuple[str, ...]]:
+        """
+            將語料中的食材名稱加入 token table 並回傳 (每個不同的名稱只斷詞一次)
+
+            workers 大於 1 且名稱數量夠多時以多個行程平行斷詞。
+        """
+        start = time.perf_counter()
+        distinct = [name for name in dict.fromkeys(names) if name and name not in self.table]
+        if workers > 1 and len(distinct) >= PARALLEL_MIN_NAMES:
+            size = -(-len(distinct) // workers)
+            chunks = [distinct[i:i + size] for i in range(0, len(distinct), size)]
+            # 服務中可能有其他執行緒，以 spawn 建立行程避免 fork 複製到持有中的鎖
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_init_worker, initargs=(self.dict_path, tuple(self.units))) as pool:
+                for chunk, results in zip(chunks, pool.map(_tokenize_chunk, chunks)):
+                    self.table.update(zip(chunk, results))
+        else:
+            for name in distinct:
+                self.table[name] = self._split(name)
+        if distinct:
+            print(f"食材斷詞: {len(distinct)} 種食材名稱, 耗時 {time.perf_counter() - start:.1f} 秒")
+        return self.table
+
+
+_worker_tokenizer: IngredientTokenizer | None = None
+
+
+def _init_worker(dict_path: str | None, units: tuple):
+    global _worker_tokenizer
+    _worker_tokenizer = IngredientTokenizer(dict_path, units, cache_size=0)
+
+
+def _tokenize_chunk(names: list) -> list:
+    return [_worker_tokenizer._split(name) for name in names]
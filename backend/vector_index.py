@@ -0,0 +1,437 @@
+"""
+    向量索引 (內積相似度)
+
+    ExactIndex 對整個矩陣做內積並以 argpartition 取 top-k，適合小型語料；
+    HNSWIndex 使用 hnswlib (隨 chromadb 安裝的 chroma-hnswlib) 的近似最近鄰搜尋，
+    查詢成本不隨資料量線性成長。兩者有相同的介面並可存到磁碟，
+    建置 HNSW 時會以 ExactIndex 為基準計算 recall@k。
+
+    搜尋可傳入可選位置的布林遮罩 (屬性篩選)，遮罩在取 top-k 之前套用:
+    ExactIndex 直接篩選分數陣列；HNSW 在圖上搜尋時略過不符合的點 (hnswlib 的 filter)。
+
+    比較不同 ef 的 recall 與延遲:
+    > python vector_index.py --cache-dir ./cache --ef 16,64,256
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from typing import List
+import numpy as np
+from fusion import top_k_indices
+import quantization
+
+
+class ExactIndex:
+    """暴力內積搜尋，vectors 可為 ndarray 或 QuantizedMatrix"""
+
+    backend = 'exact'
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    def search(self, query: np.ndarray, k: int, allowed: np.ndarray | None = None):
+        """回傳內積最高的 k 個 (列號, 分數)，依分數由高到低排序 (allowed 為可選列的布林遮罩)"""
+        scores = self.vectors.dot(query)
+        if allowed is not None:
+            positions = np.flatnonzero(allowed)
+            scores = scores[positions]
+            top = top_k_indices(scores, k)
+            return positions[top], scores[top]
+        top = top_k_indices(scores, k)
+        return top, scores[top]
+
+    def score(self, query: np.ndarray, positions: np.ndarray | None = None) -> np.ndarray:
+        """計算指定列 (None 為全部) 與查詢向量的內積"""
+        return _score(self.vectors, query, positions)
+
+    def save(self, path: str, meta: dict | None = None):
+        if isinstance(self.vectors, quantization.QuantizedMatrix):
+            self.vectors.save(path + ".exact", meta or {})
+            return
+        np.save(path + ".exact.tmp.npy", np.asarray(self.vectors, dtype=np.float32))
+        os.replace(path + ".exact.tmp.npy", path + ".exact.npy")
+        _write_meta(path, {**(meta or {}), 'backend': self.backend, 'count': len(self)})
+
+    @classmethod
+    def load(cls, path: str):
+        quantized, _ = quantization.QuantizedMatrix.load(path + ".exact")
+        if quantized is not None:
+            return cls(quantized)
+        return cls(np.load(path + ".exact.npy", mmap_mode='r'))
+
+    def stats(self) -> dict:
+        return {'backend': self.backend, 'count': len(self)}
+
+
+class HNSWIndex:
+    """
+        hnswlib 的 HNSW 索引 (space='ip'，分數 = 1 - 距離)
+
+        M / ef_construction 決定建置品質與記憶體，ef 決定查詢時的搜尋廣度 (至少為 k)。
+        k 大於 ef 的查詢只在該次查詢中調高 ef，查完恢復為設定值。
+        vectors 為原始向量矩陣，score() 以它計算指定列的精確分數。
+    """
+
+    backend = 'hnsw'
+
+    def __init__(self, index, vectors, ef: int, meta: dict | None = None):
+        self.index = index
+        self.vectors = vectors
+        self.dim = vectors.shape[1]
+        self.ef = ef
+        self.meta = meta or {}
+        # set_ef 作用於整個索引，暫時調高 ef 的查詢彼此互斥
+        self._ef_lock = threading.Lock()
+        index.set_ef(ef)
+
+    @classmethod
+    def build(cls, vectors, M: int = 16, ef_construction: int = 200, ef: int = 64,
+              batch_rows: int = 100000, threads: int = -1):
+        import hnswlib
+
+        dim = vectors.shape[1]
+        index = hnswlib.Index(space='ip', dim=dim)
+        index.init_index(max_elements=max(len(vectors), 1), M=M, ef_construction=ef_construction, random_seed=42)
+        # 分批加入，量化矩陣或 mmap 矩陣不需要一次全部還原
+        for start in range(0, len(vectors), batch_rows):
+            end = min(start + batch_rows, len(vectors))
+            block = vectors.block(start, end) if isinstance(vectors, quantization.QuantizedMatrix) \
+                else np.asarray(vectors[start:end], dtype=np.float32)
+            index.add_items(block, np.arange(start, end), num_threads=threads)
+        return cls(index, vectors, ef, {'M': M, 'ef_construction': ef_construction})
+
+    def __len__(self) -> int:
+        return self.index.get_current_count()
+
+    def search(self, query: np.ndarray, k: int, allowed: np.ndarray | None = None):
+        k = min(k, len(self) if allowed is None else int(np.count_nonzero(allowed)))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query = np.asarray(query, dtype=np.float32)
+        if k <= self.ef:
+            return self._query(query, k, allowed)
+        # ef 必須不小於 k，否則可能找不到足夠的結果 (同時進行的一般查詢只是暫時多搜尋一些點)
+        with self._ef_lock:
+            self.index.set_ef(k)
+            try:
+                return self._query(query, k, allowed)
+            finally:
+                self.index.set_ef(self.ef)
+
+    def _query(self, query: np.ndarray, k: int, allowed: np.ndarray | None):
+        if allowed is None:
+            labels, distances = self.index.knn_query(query, k=k, num_threads=1)
+        else:
+            try:
+                labels, distances = self.index.knn_query(query, k=k, num_threads=1,
+                                                         filter=lambda label: bool(allowed[label]))
+            except RuntimeError:
+                # 可選的點在圖上太分散，找不到 k 個時改為計算所有可選點的精確分數
+                positions = np.flatnonzero(allowed)
+                scores = self.score(query, positions)
+                top = top_k_indices(scores, k)
+                return positions[top], scores[top]
+        return labels[0].astype(np.int64), (1.0 - distances[0]).astype(np.float32)
+
+    def score(self, query: np.ndarray, positions: np.ndarray | None = None) -> np.ndarray:
+        return _score(self.vectors, query, positions)
+
+    def save(self, path: str, meta: dict | None = None):
+        self.index.save_index(path + ".hnsw.tmp")
+        os.replace(path + ".hnsw.tmp", path + ".hnsw")
+        self.meta = {**self.meta, **(meta or {}), 'backend': self.backend, 'dim': self.dim, 'count': len(self)}
+        _write_meta(path, self.meta)
+
+    @classmethod
+    def load(cls, path: str, vectors, ef: int = 64):
+        import hnswlib
+
+        meta = _read_meta(path)
+        index = hnswlib.Index(space='ip', dim=meta['dim'])
+        index.load_index(path + ".hnsw", max_elements=meta['count'])
+        return cls(index, vectors, ef, meta)
+
+    def stats(self) -> dict:
+        return {'backend': self.backend, 'count': len(self), 'ef': self.ef,
+                'M': self.meta.get('M'), 'ef_construction': self.meta.get('ef_construction'),
+                'recall': self.meta.get('recall'), 'recall_k': self.meta.get('recall_k')}
+
+
+class OverlayIndex:
+    """
+        基底索引加上執行期間新增或更新的向量
+
+        base 的第 i 個向量屬於 store 列 base_rows[i]；dirty[row] 為 True 的列其基底向量已失效
+        (食譜被刪除或更新)，更新後的向量放在 delta 中以暴力內積搜尋。
+        更新時以 with_updates() 建立新的物件 (copy-on-write)，正在使用舊物件的查詢不受影響。
+        delta 會一直累積到下次重新建置索引為止。
+    """
+
+    def __init__(self, base, base_rows: np.ndarray, dirty: np.ndarray | None = None,
+                 delta_rows: np.ndarray | None = None, delta_vectors: np.ndarray | None = None,
+                 base_pos: np.ndarray | None = None):
+        self.base = base
+        self.base_rows = np.asarray(base_rows, dtype=np.int64)
+        self.dim = base.vectors.shape[1]
+        self.dirty = dirty if dirty is not None else np.zeros(0, dtype=bool)
+        self.delta_rows = delta_rows if delta_rows is not None else np.empty(0, dtype=np.int64)
+        self.delta_vectors = delta_vectors if delta_vectors is not None else np.empty((0, self.dim), dtype=np.float32)
+        if base_pos is None:
+            # store 列號 -> 基底向量位置 (沒有向量的列為 -1)
+            base_pos = np.full(int(self.base_rows.max()) + 1 if len(self.base_rows) else 0, -1, dtype=np.int64)
+            base_pos[self.base_rows] = np.arange(len(self.base_rows))
+        self.base_pos = base_pos
+        self.delta_pos = np.full(max(len(self.dirty), len(base_pos)), -1, dtype=np.int64)
+        self.delta_pos[self.delta_rows] = np.arange(len(self.delta_rows))
+        # 基底中已失效的向量數，搜尋基底時需要多取這麼多筆
+        self.stale = int(np.count_nonzero(self.is_dirty(self.base_rows)))
+
+    @property
+    def backend(self) -> str:
+        return self.base.backend
+
+    def __len__(self) -> int:
+        return len(self.base) - self.stale + len(self.delta_rows)
+
+    def is_dirty(self, rows: np.ndarray) -> np.ndarray:
+        rows = np.asarray(rows, dtype=np.int64)
+        mask = np.zeros(len(rows), dtype=bool)
+        inside = rows < len(self.dirty)
+        mask[inside] = self.dirty[rows[inside]]
+        return mask
+
+    def has_vector(self, rows: np.ndarray) -> np.ndarray:
+        """各列目前是否有可搜尋的向量"""
+        rows = np.asarray(rows, dtype=np.int64)
+        in_base = np.zeros(len(rows), dtype=bool)
+        inside = rows < len(self.base_pos)
+        in_base[inside] = self.base_pos[rows[inside]] >= 0
+        in_delta = np.zeros(len(rows), dtype=bool)
+        inside = rows < len(self.delta_pos)
+        in_delta[inside] = self.delta_pos[rows[inside]] >= 0
+        return (in_base & ~self.is_dirty(rows)) | in_delta
+
+    def search(self, query: np.ndarray, k: int, mask: np.ndarray | None = None, exact_rows: int = 20000):
+        """
+            回傳內積最高的 k 個 (store 列號, 分數)，依分數由高到低排序
+
+            mask 為依 store 列號的布林陣列時只搜尋 mask 為 True 的列；近似索引在可選的列
+            不超過 exact_rows 時直接計算這些列的精確分數 (條件嚴格時比在圖上略過大部分的點快)。
+        """
+        query = np.asarray(query, dtype=np.float32)
+        if mask is not None:
+            return self._search_masked(query, k, mask, exact_rows)
+        positions, scores = self.base.search(query, k + self.stale)
+        rows = self.base_rows[positions]
+        if self.stale:
+            keep = ~self.is_dirty(rows)
+            rows, scores = rows[keep], scores[keep]
+        if len(self.delta_rows):
+            rows = np.concatenate([rows, self.delta_rows])
+            scores = np.concatenate([scores, self.delta_vectors @ query])
+        top = top_k_indices(scores, k)
+        return rows[top], scores[top]
+
+    def _search_masked(self, query: np.ndarray, k: int, mask: np.ndarray, exact_rows: int):
+        allowed = _mask_rows(mask, self.base_rows)
+        if self.stale:
+            allowed &= ~self.is_dirty(self.base_rows)
+        count = int(np.count_nonzero(allowed))
+        if self.base.backend == 'exact' or count <= exact_rows:
+            positions = np.flatnonzero(allowed)
+            # 可選的列少時只取出這些列計算，多時整個矩陣相乘較快
+            scores = self.base.score(query, positions) if count * 4 < len(allowed) else self.base.score(query)[positions]
+        else:
+            positions, scores = self.base.search(query, k, allowed)
+        rows = self.base_rows[positions]
+        if len(self.delta_rows):
+            keep = _mask_rows(mask, self.delta_rows)
+            rows = np.concatenate([rows, self.delta_rows[keep]])
+            scores = np.concatenate([scores, self.delta_vectors[keep] @ query])
+        top = top_k_indices(scores, k)
+        return rows[top], scores[top]
+
+    def score_all(self, query: np.ndarray):
+        """回傳所有有向量的 (store 列號, 內積)"""
+        query = np.asarray(query, dtype=np.float32)
+        rows, scores = self.base_rows, self.base.score(query)
+        if self.stale:
+            keep = ~self.is_dirty(rows)
+            rows, scores = rows[keep], scores[keep]
+        if len(self.delta_rows):
+            rows = np.concatenate([rows, self.delta_rows])
+            scores = np.concatenate([scores, self.delta_vectors @ query])
+        return rows, scores
+
+    def score_rows(self, query: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """計算指定列 (必須有向量) 與查詢向量的內積"""
+        query = np.asarray(query, dtype=np.float32)
+        rows = np.asarray(rows, dtype=np.int64)
+        scores = np.empty(len(rows), dtype=np.float32)
+        delta = np.full(len(rows), -1, dtype=np.int64)
+        inside = rows < len(self.delta_pos)
+        delta[inside] = self.delta_pos[rows[inside]]
+        in_delta = delta >= 0
+        scores[in_delta] = self.delta_vectors[delta[in_delta]] @ query
+        scores[~in_delta] = self.base.score(query, self.base_pos[rows[~in_delta]])
+        return scores
+
+    def with_updates(self, rows: List[int], vectors: List[np.ndarray | None], deleted_rows: List[int] = ()):
+        """
+            回傳套用更新後的新索引
+
+            rows / vectors: 新增或更新的列與其向量 (None 代表該列沒有向量)
+            deleted_rows: 刪除的列
+        """
+        changed = np.asarray(list(rows) + list(deleted_rows), dtype=np.int64)
+        if len(changed) == 0:
+            return self
+        dirty = np.zeros(max(len(self.dirty), int(changed.max()) + 1), dtype=bool)
+        dirty[:len(self.dirty)] = self.dirty
+        dirty[changed] = True
+
+        keep = ~np.isin(self.delta_rows, changed)
+        added = [(row, vector) for row, vector in zip(rows, vectors) if vector is not None]
+        delta_rows = np.concatenate([self.delta_rows[keep], np.array([row for row, _ in added], dtype=np.int64)])
+        delta_vectors = np.concatenate([
+            self.delta_vectors[keep],
+            np.asarray([vector for _, vector in added], dtype=np.float32).reshape(len(added), self.dim)])
+        return OverlayIndex(self.base, self.base_rows, dirty, delta_rows, delta_vectors, self.base_pos)
+
+    def stats(self) -> dict:
+        return {**self.base.stats(), 'delta': len(self.delta_rows), 'stale': self.stale}
+
+
+def _mask_rows(mask: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """取出 rows 在 mask 中的值 (超出 mask 長度的列為 False)"""
+    values = np.zeros(len(rows), dtype=bool)
+    inside = rows < len(mask)
+    values[inside] = mask[rows[inside]]
+    return values
+
+
+def _score(vectors, query: np.ndarray, positions: np.ndarray | None) -> np.ndarray:
+    query = np.asarray(query, dtype=np.float32)
+    if positions is None:
+        return np.asarray(vectors.dot(query), dtype=np.float32)
+    if isinstance(vectors, quantization.QuantizedMatrix):
+        return vectors.take(positions) @ query
+    return np.asarray(vectors[positions], dtype=np.float32) @ query
+
+
+def _write_meta(path: str, meta: dict):
+    with open(path + ".json.tmp", "w", encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(path + ".json.tmp", path + ".json")
+
+
+def _read_meta(path: str) -> dict:
+    with open(path + ".json", "r", encoding='utf-8') as f:
+        return json.load(f)
+
+
+def hnsw_available() -> bool:
+    try:
+        import hnswlib  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def recall_at_k(index, exact: ExactIndex, queries: np.ndarray, k: int = 10) -> float:
+    """索引的 top-k 與暴力搜尋 top-k 的平均重疊比例"""
+    if len(exact) == 0 or len(queries) == 0:
+        return 1.0
+    hits = 0
+    for query in queries:
+        expected, _ = exact.search(query, k)
+        found, _ = index.search(query, k)
+        hits += len(set(expected.tolist()).intersection(found.tolist()))
+    return hits / (len(queries) * min(k, len(exact)))
+
+
+def load_or_build(vectors, path: str, source_id: str, backend: str = 'auto', min_rows: int = 100000,
+                  M: int = 16, ef_construction: int = 200, ef: int = 64, recall_k: int = 10):
+    """
+        取得向量的搜尋索引
+
+        backend 為 auto 時資料量小於 min_rows 使用 ExactIndex，否則使用 HNSW。
+        ExactIndex 直接使用傳入的 (已 mmap 的) 矩陣；HNSW 索引以 source_id 判斷是否需要重建，
+        建置後以抽樣查詢計算 recall@k 並記錄在索引的 meta 中。
+    """
+    if backend == 'auto':
+        backend = 'hnsw' if len(vectors) >= min_rows else 'exact'
+    if backend == 'hnsw' and not hnsw_available():
+        print("hnswlib is not installed, falling back to exact search")
+        backend = 'exact'
+    if backend == 'exact':
+        return ExactIndex(vectors)
+    if backend != 'hnsw':
+        raise ValueError(f"unknown vector index backend: {backend}")
+
+    if os.path.exists(path + ".json"):
+        try:
+            meta = _read_meta(path)
+            if meta.get('source_id') == source_id and meta.get('M') == M \
+                    and meta.get('ef_construction') == ef_construction and meta.get('count') == len(vectors):
+                index = HNSWIndex.load(path, vectors, ef)
+                print(f"{os.path.basename(path)}: 載入 HNSW 索引 ({len(index)} 筆, recall@{meta.get('recall_k')} = "
+                      f"{meta.get('recall', float('nan')):.3f})")
+                return index
+        except (OSError, ValueError, KeyError, RuntimeError) as e:
+            print(f"Error loading HNSW index: {e}")
+
+    start = time.perf_counter()
+    index = HNSWIndex.build(vectors, M=M, ef_construction=ef_construction, ef=ef)
+    build_seconds = time.perf_counter() - start
+    recall = recall_at_k(index, ExactIndex(vectors), quantization.sample_queries(vectors), recall_k)
+    index.save(path, {'source_id': source_id, 'recall': recall, 'recall_k': recall_k,
+                      'build_seconds': build_seconds})
+    print(f"{os.path.basename(path)}: 建置 HNSW 索引 ({len(index)} 筆, {build_seconds:.1f} 秒, "
+          f"recall@{recall_k} = {recall:.3f})")
+    return index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="比較 HNSW 索引在不同 ef 下相對暴力搜尋的 recall@k")
+    parser.add_argument("--cache-dir", default="./cache")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--M", type=int, default=16)
+    parser.add_argument("--ef-construction", type=int, default=200)
+    parser.add_argument("--ef", default="16,32,64,128,256")
+    args = parser.parse_args()
+
+    matrices = {}
+    for name in sorted(os.listdir(args.cache_dir)):
+        if name.startswith("text_embeddings_") and name.endswith(".npy") and name.count(".") == 1:
+            matrices['text'] = np.load(os.path.join(args.cache_dir, name), mmap_mode='r')
+    ingredient_vectors = os.path.join(args.cache_dir, "ingredient_model", "recipe_vectors.npy")
+    if os.path.exists(ingredient_vectors):
+        matrices['ingredient'] = np.load(ingredient_vectors, mmap_mode='r')
+
+    for modality, matrix in matrices.items():
+        exact = ExactIndex(matrix)
+        queries = quantization.sample_queries(matrix, args.queries)
+        start = time.perf_counter()
+        for query in queries:
+            exact.search(query, args.k)
+        exact_ms = (time.perf_counter() - start) / len(queries) * 1000
+        start = time.perf_counter()
+        index = HNSWIndex.build(matrix, M=args.M, ef_construction=args.ef_construction)
+        print(f"== {modality} {matrix.shape}  exact {exact_ms:.2f} ms/query, "
+              f"HNSW 建置 {time.perf_counter() - start:.1f} 秒")
+        for ef in [int(e) for e in args.ef.split(",")]:
+            index.ef = ef
+            index.index.set_ef(ef)
+            recall = recall_at_k(index, exact, queries, args.k)
+            start = time.perf_counter()
+            for query in queries:
+                index.search(query, args.k)
+            print(f"  ef={ef:<5} recall@{args.k} {recall:.4f}  "
+                  f"{(time.perf_counter() - start) / len(queries) * 1000:.3f} ms/query")